@@ -0,0 +1,3 @@
+"""
+Throughput benchmarks of the csv models, see run.py
+"""
@@ -0,0 +1,123 @@
+"""
+Generate synthetic csv files for the models of the test app.
+
+    python -m benchmarks.generate albums 100000 albums.csv --invalid 0.01
+
+Relation columns reference the objects created by create_lookups(), and
+a fraction of the rows can be made invalid (a value which can't be
+converted or found) or repeat the key of a previous row.
+"""
+import argparse
+import csv
+import datetime
+import random
+
+# Objects referenced by the generated rows
+NUM_MUSICIANS = 1000
+NUM_TARGETS = 1000
+NUM_ALBUMS = 1000
+
+BASE_DATE = datetime.date(1950, 1, 1)
+
+
+def musician_name(i):
+    return 'musician-%d' % i
+
+
+def target_name(i):
+    return 'target-%d' % i
+
+
+def album_row(i, rng, invalid):
+    row = [
+        'album-%d' % i,
+        musician_name(rng.randrange(NUM_MUSICIANS)),
+        (BASE_DATE + datetime.timedelta(days=rng.randrange(25000))).isoformat(),
+        str(rng.randint(1, 5)),
+    ]
+    if invalid:
+        column = rng.randrange(1, 4)
+        row[column] = ['unknown-%d' % i, 'not a date', 'many'][column - 1]
+    return row
+
+
+def musician_row(i, rng, invalid):
+    # the first NUM_MUSICIANS names already exist
+    return [musician_name(i), '' if invalid else rng.choice(['guitar', 'piano', 'drums', 'bass'])]
+
+
+def song_row(i, rng, invalid):
+    if invalid:
+        album = 'unknown-%d' % i
+    elif rng.random() < 0.2:
+        # singles
+        album = ''
+    else:
+        album = 'album-%d' % rng.randrange(NUM_ALBUMS)
+    return ['song-%d' % i, album]
+
+
+def source_row(i, rng, invalid):
+    target = 'unknown-%d' % i if invalid else target_name(rng.randrange(NUM_TARGETS))
+    return ['source-%d' % i, target]
+
+
+# shape: (header, function which builds a row)
+SHAPES = {
+    'albums': (['name', 'artist', 'release_date', 'num_stars'], album_row),
+    'musicians': (['name', 'instrument'], musician_row),
+    'songs': (['name', 'album'], song_row),
+    'sources': (['name', 'target'], source_row),
+}
+
+
+def generate(path, shape, rows, invalid=0.0, duplicates=0.0, seed=0, delimiter=';'):
+    """
+    Write a csv file of rows rows of the given shape. invalid and
+    duplicates are the fractions of invalid and repeated rows.
+    """
+    header, build_row = SHAPES[shape]
+    rng = random.Random(seed)
+    with open(path, 'w', newline='', encoding='utf-8') as csv_file:
+        writer = csv.writer(csv_file, delimiter=delimiter)
+        writer.writerow(header)
+        for i in range(rows):
+            if i and rng.random() < duplicates:
+                # same values as a previous row
+                i = rng.randrange(i)
+            writer.writerow(build_row(i, rng, rng.random() < invalid))
+
+
+def create_lookups():
+    """
+    Create the objects referenced by the generated rows.
+    """
+    from tests.models import Album, ForeignKeyTarget, Musician
+
+    Musician.objects.bulk_create([
+        Musician(name=musician_name(i), instrument='guitar') for i in range(NUM_MUSICIANS)
+    ])
+    artist = Musician.objects.get(name=musician_name(0))
+    Album.objects.bulk_create([
+        Album(name='album-%d' % i, release_date=BASE_DATE, num_stars=3, artist=artist)
+        for i in range(NUM_ALBUMS)
+    ])
+    ForeignKeyTarget.objects.bulk_create([
+        ForeignKeyTarget(name=target_name(i)) for i in range(NUM_TARGETS)
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('shape', choices=sorted(SHAPES))
+    parser.add_argument('rows', type=int)
+    parser.add_argument('path')
+    parser.add_argument('--invalid', type=float, default=0.0, help='fraction of invalid rows')
+    parser.add_argument('--duplicates', type=float, default=0.0, help='fraction of repeated rows')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    generate(args.path, args.shape, args.rows, invalid=args.invalid, duplicates=args.duplicates, seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+"""
+Measure the throughput and memory of the csv models.
+
+    python -m benchmarks.run --rows 1000 100000 --output results.json
+    python -m benchmarks.run --scenario chunked --rows 1000000 --compare results.json
+
+For each scenario (see scenarios.py) and number of rows, a csv file is
+generated and imported on an empty database: is_valid() and save() are
+timed, and the peak memory allocated by Python is measured with
+tracemalloc on a second run (unless --no-memory, it slows the run down).
+Results are written as JSON. With --compare, the rows per second are
+checked against a previous result, and the exit code is 1 if any
+scenario is slower than allowed by --threshold.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import django
+from django.conf import settings
+
+
+def setup_django(database):
+    settings.configure(
+        DATABASES={
+            'default': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': database,
+            }
+        },
+        INSTALLED_APPS=(
+            'django.contrib.auth',
+            'django.contrib.contenttypes',
+            'djimporter',
+            'tests',
+        ),
+        SECRET_KEY='not very secret in benchmarks',
+        USE_TZ=False,
+    )
+    django.setup()
+
+    from django.core.management import call_command
+    call_command('migrate', run_syncdb=True, verbosity=0)
+
+
+def reset_database():
+    from django.db import connection
+
+    from benchmarks.generate import create_lookups
+    from djimporter import cache
+    from tests.models import Album, ForeignKeySource, ForeignKeyTarget, Musician, Song
+
+    # the deletion collector would take longer than most imports
+    models = (Song, Album, ForeignKeySource, ForeignKeyTarget, Musician)
+    with connection.cursor() as cursor:
+        for model in models:
+            cursor.execute('DELETE FROM %s' % connection.ops.quote_name(model._meta.db_table))
+    create_lookups()
+    # neither deletes nor bulk_create send signals
+    for model in models:
+        cache.invalidate(model)
+
+
+def run_import(scenario, path):
+    importer = scenario.csv_model(path, **scenario.options)
+
+    started = time.perf_counter()
+    valid = importer.is_valid()
+    validated = time.perf_counter()
+    importer.save()
+    saved = time.perf_counter()
+    return importer, valid, validated - started, saved - validated
+
+
+def measure_memory(scenario, path):
+    reset_database()
+    tracemalloc.start()
+    try:
+        run_import(scenario, path)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_scenario(scenario, rows, directory, memory=True):
+    from benchmarks.generate import generate
+
+    path = os.path.join(directory, '%s-%s.csv' % (scenario.name, rows))
+    generate(path, scenario.shape, rows, **scenario.file_options)
+
+    reset_database()
+    importer, valid, validate_seconds, save_seconds = run_import(scenario, path)
+    seconds = validate_seconds + save_seconds
+    result = {
+        'scenario': scenario.name,
+        'rows': rows,
+        'valid': valid,
+        'errors': importer.errors.total,
+        'validate_seconds': round(validate_seconds, 4),
+        'save_seconds': round(save_seconds, 4),
+        'rows_per_second': round(rows / seconds, 1) if seconds else None,
+        'peak_memory_bytes': measure_memory(scenario, path) if memory else None,
+        'timings': importer.timings.as_dict(),
+    }
+    os.remove(path)
+    return result
+
+
+def get_environment():
+    import djimporter
+    from django.db import connection
+
+    return {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'djimporter': djimporter.get_version(),
+        'database': '%s %s' % (connection.vendor, connection.Database.sqlite_version),
+        'platform': platform.platform(),
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Return the results which are more than threshold (a fraction)
+    slower than the same scenario and rows of baseline.
+    """
+    previous = {(r['scenario'], r['rows']): r['rows_per_second'] for r in baseline['results']}
+    regressions = []
+    for result in results:
+        before = previous.get((result['scenario'], result['rows']))
+        if not before or not result['rows_per_second']:
+            continue
+        change = result['rows_per_second'] / before - 1
+        if change < -threshold:
+            regressions.append(dict(result, baseline_rows_per_second=before, change=round(change, 3)))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000],
+                        help='number of rows of the files, e.g. 1000 100000 1000000')
+    parser.add_argument('--scenario', nargs='+', help='scenarios to run (all by default)')
+    parser.add_argument('--database', default=':memory:', help='sqlite database file')
+    parser.add_argument('--no-memory', action='store_true', help="don't measure the peak memory")
+    parser.add_argument('--output', help='file to write the results to (stdout by default)')
+    parser.add_argument('--compare', help='results of a previous run')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown reported as a regression (default 0.1, 10%%)')
+    args = parser.parse_args(argv)
+
+    setup_django(args.database)
+    from benchmarks.scenarios import SCENARIOS
+
+    scenarios = [s for s in SCENARIOS if not args.scenario or s.name in args.scenario]
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for scenario in scenarios:
+            for rows in args.rows:
+                result = run_scenario(scenario, rows, directory, memory=not args.no_memory)
+                print('%(scenario)s %(rows)s: %(rows_per_second)s rows/s' % result, file=sys.stderr)
+                results.append(result)
+
+    output = {'environment': get_environment(), 'results': results}
+    if args.compare:
+        with open(args.compare) as baseline:
+            output['regressions'] = compare(results, json.load(baseline), args.threshold)
+
+    data = json.dumps(output, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(data + '\n')
+    else:
+        print(data)
+
+    return 1 if output.get('regressions') else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
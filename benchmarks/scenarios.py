@@ -0,0 +1,104 @@
+"""
+Csv models measured by the benchmarks.
+
+Each scenario is a csv model, the shape of the file it imports (see
+generate.py), the options of the generated file and the arguments of
+the csv model.
+"""
+from collections import namedtuple
+
+from djimporter import fields, importers
+
+from tests.models import Album, ForeignKeySource, ForeignKeyTarget, Musician, Song
+
+Scenario = namedtuple('Scenario', ['name', 'csv_model', 'shape', 'file_options', 'options'])
+
+
+class AlbumCsv(importers.CsvModel):
+    artist = fields.SlugRelatedField(slug_field='name', queryset=Musician.objects.all())
+
+    class Meta:
+        dbModel = Album
+        fields = ['name', 'release_date', 'num_stars', 'artist']
+        encoding = 'utf-8'
+
+
+class AlbumCachedCsv(AlbumCsv):
+    artist = fields.CachedSlugRelatedField(slug_field='name', queryset=Musician.objects.all())
+
+    class Meta(AlbumCsv.Meta):
+        pass
+
+
+class AlbumCachedPkCsv(AlbumCsv):
+    artist = fields.CachedSlugRelatedField(slug_field='name', queryset=Musician.objects.all(), pk_only=True)
+
+    class Meta(AlbumCsv.Meta):
+        pass
+
+
+class AlbumDateCsv(AlbumCachedCsv):
+    release_date = fields.DateField()
+
+    class Meta(AlbumCachedCsv.Meta):
+        pass
+
+
+class AlbumFloatCsv(AlbumCachedCsv):
+    num_stars = fields.FloatField()
+
+    class Meta(AlbumCachedCsv.Meta):
+        pass
+
+
+class AlbumUniqueTogetherCsv(AlbumCachedCsv):
+    class Meta(AlbumCachedCsv.Meta):
+        unique_together = ['name', 'artist']
+
+
+class AlbumChunkedCsv(AlbumCachedCsv):
+    class Meta(AlbumCachedCsv.Meta):
+        chunk_size = 1000
+
+
+class MusicianAppendCsv(importers.CsvModel):
+    class Meta:
+        dbModel = Musician
+        fields = ['name', 'instrument']
+        encoding = 'utf-8'
+        append_mode = True
+
+
+class SongCsv(importers.CsvModel):
+    # empty values are allowed because the model field is nullable
+    album = fields.SlugRelatedField(slug_field='name', queryset=Album.objects.all())
+
+    class Meta:
+        dbModel = Song
+        fields = ['name', 'album']
+        encoding = 'utf-8'
+
+
+class SourceCsv(importers.CsvModel):
+    target = fields.CachedSlugRelatedField(slug_field='name', queryset=ForeignKeyTarget.objects.all())
+
+    class Meta:
+        dbModel = ForeignKeySource
+        fields = ['name', 'target']
+        encoding = 'utf-8'
+
+
+SCENARIOS = [
+    Scenario('slug_related', AlbumCsv, 'albums', {}, {}),
+    Scenario('cached_slug_related', AlbumCachedCsv, 'albums', {}, {}),
+    Scenario('cached_slug_related_pk_only', AlbumCachedPkCsv, 'albums', {}, {}),
+    Scenario('date_field', AlbumDateCsv, 'albums', {}, {}),
+    Scenario('float_field', AlbumFloatCsv, 'albums', {}, {}),
+    Scenario('unique_together', AlbumUniqueTogetherCsv, 'albums', {}, {}),
+    Scenario('chunked', AlbumChunkedCsv, 'albums', {}, {}),
+    Scenario('warning_mode', AlbumCachedCsv, 'albums', {'invalid': 0.05}, {'warning_mode': True}),
+    # the first rows exist already and are skipped
+    Scenario('append_mode', MusicianAppendCsv, 'musicians', {}, {}),
+    Scenario('nullable_slug_related', SongCsv, 'songs', {}, {}),
+    Scenario('foreign_key_source', SourceCsv, 'sources', {}, {}),
+]
@@ -1,5 +1,6 @@
 from django.apps import AppConfig
 from django.core import checks
+from django.db.models.signals import post_delete, post_save
 
 from .checks import check_importlog_model
 
@@ -9,3 +10,11 @@ class ImporterConfig(AppConfig):
 
     def ready(self):
         checks.register(check_importlog_model, checks.Tags.models)
+
+        from . import get_importlog_model, profiling, progress
+        from .models import delete_log_errors
+        importlog_model = get_importlog_model()
+        post_delete.connect(delete_log_errors, sender=importlog_model)
+        post_delete.connect(profiling.delete_log_profile, sender=importlog_model)
+        # wake up the status views waiting for changes
+        post_save.connect(progress.log_saved, sender=importlog_model)
@@ -0,0 +1,190 @@
+"""
+Lookup caches shared by all the imports run by a process.
+
+CachedSlugRelatedField used to keep its cache on the field, which is a class
+attribute, so it was loaded again by every new class and never refreshed on
+long-lived workers. Caches are now kept here and are dropped when an object
+of the referenced model is saved or deleted, or when they expire.
+
+Settings:
+    DJIMPORTER_LOOKUP_CACHE_TIMEOUT: seconds a lookup is kept (None: no expiration)
+    DJIMPORTER_LOOKUP_CACHE_ALIAS: django cache used to share lookups between
+        workers (None: only process memory)
+    DJIMPORTER_WARM_UP_IMPORTERS: dotted paths of the importers loaded by warm_up()
+"""
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import EmptyResultSet
+from django.db.models.signals import post_delete, post_save
+from django.utils.module_loading import import_string
+
+DEFAULT_TIMEOUT = 300
+
+_lookups = {}
+_versions = {}
+_connected_models = set()
+_lock = threading.RLock()
+
+
+def get_timeout():
+    return getattr(settings, 'DJIMPORTER_LOOKUP_CACHE_TIMEOUT', DEFAULT_TIMEOUT)
+
+
+def get_shared_cache():
+    alias = getattr(settings, 'DJIMPORTER_LOOKUP_CACHE_ALIAS', None)
+    if alias is None:
+        return None
+    return caches[alias]
+
+
+def get_model_label(model):
+    return model._meta.label_lower
+
+
+def get_version(model):
+    """
+    Return the number of times that the lookups of model have been invalidated.
+    """
+    label = get_model_label(model)
+    shared = get_shared_cache()
+    if shared is not None:
+        return shared.get('djimporter:lookup-version:%s' % label, 0)
+    return _versions.get(label, 0)
+
+
+def invalidate(model):
+    label = get_model_label(model)
+    with _lock:
+        _versions[label] = _versions.get(label, 0) + 1
+
+    shared = get_shared_cache()
+    if shared is not None:
+        key = 'djimporter:lookup-version:%s' % label
+        shared.add(key, 0, timeout=None)
+        try:
+            shared.incr(key)
+        except ValueError:
+            # key has been evicted meanwhile
+            shared.set(key, 1, timeout=None)
+
+
+def invalidate_handler(sender, **kwargs):
+    invalidate(sender)
+
+
+def connect_signals(model):
+    label = get_model_label(model)
+    with _lock:
+        if label in _connected_models:
+            return
+        uid = 'djimporter-lookup-cache-%s' % label
+        post_save.connect(invalidate_handler, sender=model, weak=False, dispatch_uid=uid)
+        post_delete.connect(invalidate_handler, sender=model, weak=False, dispatch_uid=uid)
+        _connected_models.add(label)
+
+
+class LookupCache:
+    """
+    Map the values of `slug_field` to the objects of queryset (or to
+    their primary keys if `pk_only` is true).
+    """
+
+    def __init__(self, queryset, slug_field, pk_only=False):
+        self.queryset = queryset
+        self.slug_field = slug_field
+        self.pk_only = pk_only
+        self.model = queryset.model
+
+        self.data = None
+        self.version = None
+        self.expires_at = None
+
+        connect_signals(self.model)
+
+    def get_shared_key(self, version):
+        key = get_lookup_key(self.queryset, self.slug_field, self.pk_only)
+        digest = hashlib.md5(repr(key).encode('utf-8')).hexdigest()
+        return 'djimporter:lookup:%s:%s' % (digest, version)
+
+    def is_expired(self):
+        return self.expires_at is not None and time.monotonic() >= self.expires_at
+
+    def get(self):
+        version = get_version(self.model)
+        if self.data is None or self.version != version or self.is_expired():
+            with _lock:
+                self.load(version)
+        return self.data
+
+    def load(self, version):
+        timeout = get_timeout()
+        shared = get_shared_cache()
+        data = None
+        if shared is not None:
+            data = shared.get(self.get_shared_key(version))
+
+        if data is None:
+            data = self.fetch()
+            if shared is not None:
+                shared.set(self.get_shared_key(version), data, timeout=timeout)
+
+        self.data = data
+        self.version = version
+        self.expires_at = None if timeout is None else time.monotonic() + timeout
+
+    def fetch(self):
+        # NOTE: cast to str dict key because CSV value by default its a string
+        queryset = self.queryset.all()
+        if self.pk_only:
+            values = queryset.values_list(self.slug_field, 'pk').iterator()
+            return {str(slug): pk for slug, pk in values}
+
+        return {str(getattr(obj, self.slug_field)): obj for obj in queryset}
+
+
+def get_lookup_key(queryset, slug_field, pk_only):
+    try:
+        query = str(queryset.query)
+    except EmptyResultSet:
+        query = None
+    return (get_model_label(queryset.model), queryset.db, query, slug_field, pk_only)
+
+
+def get_lookup_cache(queryset, slug_field, pk_only=False):
+    key = get_lookup_key(queryset, slug_field, pk_only)
+    with _lock:
+        if key not in _lookups:
+            _lookups[key] = LookupCache(queryset, slug_field, pk_only=pk_only)
+        return _lookups[key]
+
+
+def clear():
+    """
+    Drop all the lookups kept on process memory.
+    """
+    with _lock:
+        _lookups.clear()
+
+
+def warm_up(*importers):
+    """
+    Load the lookups used by the CachedSlugRelatedFields of importers,
+    e.g. when a worker starts. By default DJIMPORTER_WARM_UP_IMPORTERS
+    are loaded. Importers can be classes or dotted paths.
+    """
+    from .fields import CachedSlugRelatedField
+
+    if not importers:
+        importers = getattr(settings, 'DJIMPORTER_WARM_UP_IMPORTERS', [])
+
+    for importer in importers:
+        if isinstance(importer, str):
+            importer = import_string(importer)
+        for name in importer.Meta.fields:
+            field = getattr(importer, name, None)
+            if isinstance(field, CachedSlugRelatedField):
+                field.get_lookup_cache().get()
@@ -0,0 +1,109 @@
+"""
+Detect the encoding of csv files.
+
+Only bounded samples of a file are read, so detection doesn't depend on
+its size:
+
+    1. a byte order mark gives the encoding,
+    2. otherwise the first and the last DJIMPORTER_ENCODING_SAMPLE_SIZE
+       bytes are decoded with each candidate, and the first one which
+       decodes both is used. Candidates are the guess of libmagic, if
+       python-magic is installed, and DJIMPORTER_ENCODINGS.
+
+The other candidates which decode the samples are kept as fallbacks:
+while a file has only ascii, which they all decode alike, readers
+switch to the next one if some bytes can't be decoded (see readers.py).
+
+Settings:
+    DJIMPORTER_ENCODINGS: encodings tried, in order (default utf-8, cp1252, latin-1)
+    DJIMPORTER_ENCODING_SAMPLE_SIZE: bytes read from each end of the file (default 64 KiB)
+"""
+import codecs
+import os
+
+from django.conf import settings
+
+try:
+    from magic import Magic
+except ImportError:
+    Magic = None
+
+DEFAULT_ENCODINGS = ('utf-8', 'cp1252', 'latin-1')
+DEFAULT_SAMPLE_SIZE = 64 * 1024
+
+# longer marks first, the utf-32-le one starts like the utf-16-le one
+BOMS = (
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+
+# guesses of libmagic which don't name an encoding, or a too narrow one
+MAGIC_IGNORED = ('binary', 'unknown-8bit', 'us-ascii')
+
+
+def detect(path):
+    """
+    Return the encoding of the file at path.
+    """
+    return get_encodings(path)[0]
+
+
+def get_encodings(path):
+    """
+    Return the encodings which can decode the file at path, most likely first.
+    """
+    sample_size = getattr(settings, 'DJIMPORTER_ENCODING_SAMPLE_SIZE', DEFAULT_SAMPLE_SIZE)
+    with open(path, 'rb') as stream:
+        head = stream.read(sample_size)
+        tail = b''
+        size = os.fstat(stream.fileno()).st_size
+        if size > sample_size:
+            stream.seek(max(sample_size, size - sample_size))
+            tail = stream.read()
+
+    for bom, encoding in BOMS:
+        if head.startswith(bom):
+            return [encoding]
+
+    encodings = []
+    for encoding in get_candidates(head):
+        if encoding in encodings:
+            continue
+        if can_decode(head, encoding) and can_decode(tail, encoding, partial=True):
+            encodings.append(encoding)
+    # latin-1 decodes anything
+    if 'latin-1' not in encodings:
+        encodings.append('latin-1')
+    return encodings
+
+
+def get_candidates(sample):
+    candidates = []
+    if Magic is not None:
+        guess = Magic(mime_encoding=True).from_buffer(sample)
+        if guess and guess not in MAGIC_IGNORED:
+            candidates.append(guess)
+    candidates.extend(getattr(settings, 'DJIMPORTER_ENCODINGS', DEFAULT_ENCODINGS))
+    return candidates
+
+
+def can_decode(sample, encoding, partial=False):
+    """
+    Check that sample can be decoded. Samples are cut at any byte, so
+    the last character can be incomplete and, if partial, the first one.
+    """
+    try:
+        decoder = codecs.getincrementaldecoder(encoding)()
+    except LookupError:
+        return False
+    # skip the bytes of a character which started before the sample
+    for start in range(4 if partial else 1):
+        try:
+            decoder.decode(sample[start:], final=False)
+            return True
+        except UnicodeDecodeError:
+            decoder.reset()
+    return False
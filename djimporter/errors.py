@@ -0,0 +1,140 @@
+"""
+Store the errors found while importing a file.
+
+A badly formatted file can have errors on every row, so they are not kept
+as a whole: only the first DJIMPORTER_MAX_ERRORS errors are kept verbatim
+and the rest are counted by field and message. Messages usually include
+the invalid value, so only DJIMPORTER_MAX_ERROR_KEYS distinct messages are
+counted, and the following ones are counted as "Other errors" of their
+field. When the import has a log,
+the errors are written to ImportLogError while the file is processed,
+instead of being serialized on the errors field of the log.
+
+Settings:
+    DJIMPORTER_MAX_ERRORS: number of errors kept verbatim (default 1000,
+        None keeps all of them)
+    DJIMPORTER_MAX_ERROR_KEYS: number of distinct (field, message) counted
+        (default 100, None counts all of them)
+"""
+from collections import Counter
+
+from django.conf import settings
+from django.db import router, transaction
+from django.utils.translation import gettext as _
+
+DEFAULT_MAX_ERRORS = 1000
+DEFAULT_MAX_ERROR_KEYS = 100
+
+# Errors are written in batches of this size
+FLUSH_SIZE = 500
+
+# max_length of ImportLogError.field
+FIELD_LENGTH = 255
+
+
+def get_max_errors():
+    return getattr(settings, 'DJIMPORTER_MAX_ERRORS', DEFAULT_MAX_ERRORS)
+
+
+def get_max_error_keys():
+    return getattr(settings, 'DJIMPORTER_MAX_ERROR_KEYS', DEFAULT_MAX_ERROR_KEYS)
+
+
+class ErrorStore(list):
+    """
+    List of the errors of an import, dicts with line, field and message.
+
+    Errors beyond max_errors are not added to the list but counted on
+    overflow by (field, message); total is the number of errors found
+    and summary counts all of them by (field, message). Beyond
+    max_error_keys messages, errors are counted by field.
+    """
+
+    def __init__(self, log=None):
+        super().__init__()
+        self.log = log
+        self.max_errors = get_max_errors()
+        self.max_error_keys = get_max_error_keys()
+        self.total = 0
+        self.overflow = Counter()
+        self.summary = Counter()
+        # errors kept and not written yet
+        self.pending = []
+
+    def __bool__(self):
+        return self.total > 0
+
+    def get_key(self, error):
+        key = (str(error['field']), str(error['message']))
+        # overflow only has keys of the summary
+        if key in self.summary or self.max_error_keys is None or len(self.summary) < self.max_error_keys:
+            return key
+        return (key[0], _("Other errors"))
+
+    def append(self, error):
+        key = self.get_key(error)
+        self.total += 1
+        self.summary[key] += 1
+        if self.max_errors is not None and len(self) >= self.max_errors:
+            self.overflow[key] += 1
+            return
+        super().append(error)
+        if self.log is not None:
+            self.pending.append(error)
+
+    def extend(self, errors):
+        for error in errors:
+            self.append(error)
+
+    def get_summary(self):
+        """
+        Return the number of lines of each error, as stored
+        on the error_summary field of the logs.
+        """
+        return [
+            {'field': field, 'message': message, 'line_count': count}
+            for (field, message), count in self.summary.items()
+        ]
+
+    def get_model(self):
+        from .models import ImportLogError
+        return ImportLogError
+
+    def flush(self):
+        """
+        Write the pending errors, unless they would be written inside
+        a transaction which could still be rolled back.
+        """
+        if len(self.pending) < FLUSH_SIZE:
+            return
+        using = router.db_for_write(self.get_model())
+        if transaction.get_connection(using).in_atomic_block:
+            return
+        self.write()
+
+    def write(self):
+        model = self.get_model()
+        model.objects.bulk_create([
+            model(
+                log_id=self.log.pk,
+                line=error['line'],
+                field=str(error['field'])[:FIELD_LENGTH],
+                message=str(error['message']),
+                count=error.get('count', 1),
+            )
+            for error in self.pending
+        ])
+        self.pending = []
+
+    def close(self):
+        """
+        Write the pending errors and the counters of the overflow.
+        """
+        if self.log is None:
+            return
+        self.pending.extend(
+            {'line': None, 'field': field, 'message': message, 'count': count}
+            for (field, message), count in self.overflow.items()
+        )
+        self.overflow = Counter()
+        self.write()
@@ -1,12 +1,15 @@
 from datetime import datetime
 
+from django.core.exceptions import FieldError as LookupFieldError
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
-from django.db.models import Manager
+from django.db.models import F, Manager
 from django.db.models import Model as djangoModel
 from django.db.models import TimeField as django_TimeField
 from django.db.models.query import QuerySet
 from django.utils.translation import gettext_lazy as _
 
+from .cache import get_lookup_cache
+
 
 class FieldError(ValueError):
     pass
@@ -33,6 +36,61 @@ class ListGeoException(Exception):
         Exception.__init__(self, message)
 
 
+# Maximum number of values looked up by each query of a bulk lookup
+MAX_LOOKUP_PARAMS = 900
+
+
+def lookup_in_bulk(queryset, lookup, values):
+    """
+    Fetch the objects of queryset whose `lookup` matches any of values.
+
+    Return a dict which maps the values (as strings) to its object. Values
+    without an unambiguous match are left out, so callers can fall back to
+    a regular get() which raises the proper exception.
+    """
+    values = list(values)
+    found = {}
+    repeated = set()
+    try:
+        for i in range(0, len(values), MAX_LOOKUP_PARAMS):
+            batch = values[i:i + MAX_LOOKUP_PARAMS]
+            objs = queryset.filter(**{lookup + '__in': batch}).annotate(_lookup_value=F(lookup))
+            for obj in objs:
+                key = str(obj._lookup_value)
+                if key in found:
+                    repeated.add(key)
+                found[key] = obj
+    except (TypeError, ValueError, ValidationError):
+        # some value cannot be converted to the type of the lookup field
+        return {}
+    except LookupFieldError:
+        # lookup isn't a path of fields (e.g. name__iexact), values are
+        # compared to the objects with get()
+        return {}
+
+    for key in repeated:
+        del found[key]
+    return found
+
+
+def get_prefetch(field):
+    """
+    Return the method which resolves the values of field in bulk, unless
+    its class overrides how values are resolved (to_python or get) after
+    defining it, which would be skipped by the bulk lookup.
+    """
+    prefetch = getattr(field, 'prefetch', None)
+    if prefetch is None:
+        return None
+
+    field_class = type(field)
+    owner = next(cls for cls in field_class.__mro__ if 'prefetch' in vars(cls))
+    for name in ('to_python', 'get'):
+        if getattr(field_class, name, None) is not getattr(owner, name, None):
+            return None
+    return prefetch
+
+
 MISSING_ERROR_MESSAGE = (
     'ValidationError raised by `{class_name}`, but error key `{key}` does '
     'not exist in the `error_messages` dictionary.'
@@ -179,6 +237,9 @@ class DateField(Field):
 
 class ForeignKey(Field):
     field_name = "ForeignKey"
+    # value is fetched from the database, so it doesn't need
+    # to be checked again while validating the model
+    is_relation = True
 
     def __init__(self, *args, **kwargs):
         self.pk = kwargs.pop('pk', 'pk')
@@ -192,6 +253,12 @@ class ForeignKey(Field):
             raise TypeError("The first argument should be a django model class.")
         super(ForeignKey, self).__init__(**kwargs)
 
+    def prefetch(self, values):
+        """
+        Resolve the values of a chunk of rows with a single query.
+        """
+        return lookup_in_bulk(self.model.objects.all(), self.pk, values)
+
     def to_python(self, value):
         try:
             return self.model.objects.get(**{self.pk: value})
@@ -208,6 +275,7 @@ class SlugRelatedField(Field):
     # not the id or pk
     field_name = "Slug_Related_Field"
     queryset = None
+    is_relation = True
 
     def __init__(self, *args, **kwargs):
         super().__init__(**kwargs)
@@ -242,6 +310,14 @@ class SlugRelatedField(Field):
         # wee split in this function for help to RelatedFromUniquesField
         return self.get_queryset().get(**{self.slug_field: value.strip()})
 
+    def prefetch(self, values):
+        """
+        Resolve the values of a chunk of rows with a single query.
+
+        Unlike CachedSlugRelatedField only the referenced objects are loaded.
+        """
+        return lookup_in_bulk(self.get_queryset(), self.slug_field, {value.strip() for value in values})
+
     def to_python(self, value):
         # handle empty values depending of this field is nullable
         if not value:
@@ -275,8 +351,15 @@ class CachedSlugRelatedField(Field):
     SlugRelatedField which caches queryset on memory to boost importer speed.
 
     It performs a single "big" database query instead of N "small" queries
-    where N is the number of rows to be imported.
+    where N is the number of rows to be imported. The cache is shared by the
+    following imports until the referenced model changes (see cache.py).
+
+    With `pk_only=True` only the slug and the primary key of each object are
+    cached, and the importer sets `<field>_id` instead of the related object.
+    It is much faster and lighter for big lookup tables.
     """
+    is_relation = True
+
     def __init__(self, *args, null=False, **kwargs):
         queryset = kwargs.pop('queryset')
         slug_field = kwargs.pop('slug_field')
@@ -284,19 +367,33 @@ class CachedSlugRelatedField(Field):
         self.queryset = queryset
         self.slug_field = slug_field
         self.model = queryset.model
+        # to_python returns the primary key instead of the object
+        self.pk_only = kwargs.pop('pk_only', False)
+        self.lookup_cache = None
 
         super().__init__(*args, null=null, **kwargs)
 
-    def to_python(self, value):
-        if not hasattr(self, 'cached_queryset'):
-            # NOTE: cast to str dict key because CSV value by default its a string
-            self.cached_queryset = {
-                str(getattr(obj, self.slug_field)): obj for obj in self.queryset
-            }
+    def get_lookup_cache(self):
+        # the cache is shared by all the imports run by this process,
+        # finding it compiles the query, so it's done once
+        if self.lookup_cache is None:
+            self.lookup_cache = get_lookup_cache(self.queryset, self.slug_field, pk_only=self.pk_only)
+        return self.lookup_cache
 
+    def prefetch(self, values):
+        """
+        Return the whole cached lookup, it is checked once per chunk
+        to know if it has been invalidated.
+        """
+        return self.get_lookup_cache().get()
+
+    def to_python(self, value):
         value = value.strip()
+        lookup_cache = self.get_lookup_cache()
+        # the lookup loaded by prefetch(), which checks it once per chunk
+        data = lookup_cache.data if lookup_cache.data is not None else lookup_cache.get()
         try:
-            return self.cached_queryset[value]
+            return data[value]
         except KeyError:
             msg = "No match found for '%(model)s' with value '%(value)s' on field '%(slug)s'"
             params = {'model': self.model.__name__, 'value': value, 'slug': self.slug_field}
@@ -308,6 +405,8 @@ class RelatedFromUniquesField(SlugRelatedField):
     # from fields of unique together
 
     field_name = "Related_Uniques_together_field"
+    # values are dictionaries, they cannot be looked up in bulk
+    prefetch = None
 
     def get(self, dvalue):
         d = {k: dvalue[self.slug_field[k]].strip() for k in self.slug_field}
@@ -395,6 +494,9 @@ class CsvFieldLink(Field):
 
 
 class ComposedKeyField(ForeignKey):
+    # values are dictionaries, they cannot be looked up in bulk
+    prefetch = None
+
     def to_python(self, value):
         try:
             return self.model.objects.get(**value)
@@ -411,6 +513,8 @@ class MultiSlugRelatedField(SlugRelatedField):
     """
 
     field_name = "MultiSlugRelatedField"
+    # values are dictionaries, they cannot be looked up in bulk
+    prefetch = None
 
     def __init__(self, *args, **kwargs):
         super(MultiSlugRelatedField, self).__init__(*args, **kwargs)
@@ -13,6 +13,14 @@ class CsvImportForm(forms.Form):
         label='Allow partial imports (warn user instead of fail)',
         required=False,
     )
+    dry_run = forms.BooleanField(
+        label='Only validate the file (dry run)',
+        required=False,
+    )
+    profile = forms.BooleanField(
+        label='Profile the import',
+        required=False,
+    )
 
 
 class UploadDataCsvGuessForm(CsvImportForm):
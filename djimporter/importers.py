@@ -2,14 +2,26 @@
 Define the csv model base classe
 """
 import csv
-import io
 import os
 import sys
+import time
+from contextlib import contextmanager
 
-from django.core.exceptions import ObjectDoesNotExist, ValidationError
-from django.db import DatabaseError, transaction
+from asgiref.sync import sync_to_async
+from django.core.exceptions import NON_FIELD_ERRORS, ObjectDoesNotExist, ValidationError
+from django.db import DatabaseError, connection, transaction
+from django.db.models import Q
 from django.utils.translation import gettext as _
-from magic import Magic
+
+from . import cache, encoding, parallel, progress, signals, writers
+from .errors import ErrorStore
+from .fields import MAX_LOOKUP_PARAMS
+from .readers import CsvFileReader, RowLine
+from .spec import CELL, FIXED, ImporterSpec
+from .timings import Timings
+
+# Number of rows processed together when Meta.chunk_size is not defined
+DEFAULT_CHUNK_SIZE = 1000
 
 
 class MetaFieldException(Exception):
@@ -39,10 +51,7 @@ class ErrorMixin(object):
         self.errors.append(self.build_err_dict(line_number, field.replace('__all__', 'all fields'), message))
 
     def get_csv_field(self, field):
-        for csv_field, real_field in self.mapping.items():
-            if field == real_field:
-                return csv_field
-        return field
+        return self.spec.reverse_mapping.get(field, field)
 
     @staticmethod
     def build_err_dict(line_number, field, message):
@@ -60,64 +69,98 @@ class CsvModelMetaclass(type):
         for attr_name, attr_value in attrs.items():
             if isinstance(attr_value, Field) and not hasattr(attr_value, 'source'):
                 setattr(attr_value, 'source', attr_name)
+        new_class._spec = None
         return new_class
 
+    @property
+    def spec(cls):
+        # compiled on first use because models may not be loaded
+        # yet when the class is defined
+        if cls._spec is None:
+            cls._spec = ImporterSpec(cls)
+        return cls._spec
+
 
 class CsvModel(ErrorMixin, metaclass=CsvModelMetaclass):
 
     def __init__(self, csvfile, context=None, delimiter=None, headers_mapping=None,
-                 log=None, warning_mode=False, default_values=None):
+                 log=None, warning_mode=False, default_values=None, dry_run=False):
+        self.spec = type(self).spec
         self.file = csvfile
         self.context = context or {}
         self.Meta.context = context
         self.log = log
         self.warning_mode = warning_mode
+        # only validate the file: nothing is written and post_save methods don't run
+        self.dry_run = dry_run
 
-        self.errors = []
+        # only the first DJIMPORTER_MAX_ERRORS errors are kept (see errors.py)
+        self.errors = ErrorStore(log)
         self.list_tasks = []
         self.list_objs = []
+        self.num_rows = 0
+        self.bytes_processed = 0
+        # seconds spent on each phase of the import (see timings.py)
+        self.timings = Timings(per_field=self.spec.field_timings)
         self.dict_error = {}
+        self.unique_together_seen = set()
+        self.repeated_unique_together = []
+        # unique keys of the rows validated on dry runs, which aren't written
+        self.dry_run_keys = {}
         self._meta = None
 
         self.fields = self.get_fields()
-        self.extra_fields = getattr(self.Meta, 'extra_fields', [])
+        self.extra_fields = list(self.spec.extra_fields)
         self.headers_mapping = headers_mapping
         self.default_values = default_values or {}
+        self.plan = self.spec.bind(self.context, self.default_values)
 
         self.mapping = self.get_mapping()
-        self.encoding = getattr(self.Meta, 'encoding', None)
-
-        self.delimiter = delimiter if delimiter is not None else getattr(self.Meta, 'delimiter', ';')
-        self.dbModel = self.Meta.dbModel
-        self.post_save = hasattr(self.Meta, 'post_save')
-        self.has_save = hasattr(self.Meta, 'save') and self.Meta.save
-        self.not_create_model = hasattr(self.Meta, 'create_model') and not self.Meta.create_model
-        self.unique_together = hasattr(self.Meta, 'unique_together')
-        self.validate_unique = not hasattr(self.Meta, 'unique_together')
-        self.append_mode = getattr(self.Meta, 'append_mode', False)
-        self.exclude_fields = getattr(self.Meta, 'exclude_fields', None)
+        self.encoding = self.spec.encoding
+
+        self.delimiter = delimiter if delimiter is not None else self.spec.delimiter
+        self.dbModel = self.spec.db_model
+        self.post_save = self.spec.has_post_save
+        self.has_save = self.spec.has_save
+        self.not_create_model = not self.spec.create_model
+        self.unique_together = self.spec.unique_together is not None
+        self.upsert = self.spec.import_mode == 'upsert'
+        # on upsert mode existing objects are updated, not reported
+        self.validate_unique = not (self.unique_together or self.upsert)
+        self.append_mode = self.spec.append_mode
+        self.exclude_fields = self.spec.exclude_fields
+        # If defined, rows are validated, written and released in blocks
+        # of chunk_size rows, so memory doesn't grow with the file
+        self.chunk_size = self.spec.chunk_size
+        self.keep_rows = (
+            bool(self.spec.post_save or self.spec.post_save_batch)
+            and not self.has_save
+            and not self.dry_run
+        )
+        # number of processes used to validate the file (see parallel.py)
+        self.workers = self.spec.workers
+        # 'import' writes the whole file in a transaction, 'chunk' commits each chunk
+        self.commit_scope = self.spec.commit_scope
+        self.writer = None
 
         assert not (self.unique_together and self.append_mode), (
             "Cannot set both 'unique_together' and 'append_mode' attributes: append mode will not work."
         )
+        assert self.commit_scope in ('import', 'chunk'), (
+            "Unknown commit_scope '%s'." % self.commit_scope
+        )
+        assert self.spec.import_mode in ('insert', 'upsert'), (
+            "Unknown import_mode '%s'." % self.spec.import_mode
+        )
+        assert not self.upsert or self.spec.conflict_fields, (
+            "Set the 'conflict_fields' attribute to use the upsert import_mode."
+        )
+        assert not (self.upsert and (self.has_save or self.append_mode)), (
+            "Cannot use the upsert import_mode with 'save' or 'append_mode' attributes."
+        )
 
     def get_user_visible_fields(self):
-        # extra fields is used to capture the names of the columns used in the pre_save and
-        # post_save methods each csvmodel. Is neccesary define in every Meta of csvmodel one list
-        # of this names if is used in pre_save or post_save
-        # This method get_user_visible_fields is used for validated the header of the file
-        head = self.extra_fields.copy()
-        for f in self.mapping.keys():
-            field = self.fields[f]
-            if hasattr(field, 'in_csv') and not field.in_csv:
-                continue
-
-            if f in self.context:
-                continue
-
-            head.append(f)
-
-        return head
+        return self.spec.get_user_visible_fields(self.context, extra_fields=self.extra_fields)
 
     def set_extra_fields(self, extra_fields):
         self.extra_fields = extra_fields
@@ -126,28 +169,7 @@ class CsvModel(ErrorMixin, metaclass=CsvModelMetaclass):
         return self.delimiter
 
     def get_fields(self):
-        """
-        Only get the names than exist in the field
-        if not exist names enough for build the object
-        when the it try validate the object to do crash
-        """
-        if hasattr(self, 'fields'):
-            return self.fields
-
-        attributes = {}
-        dbModel = self.Meta.dbModel
-        dmodel = {a.name: a for a in dbModel._meta.get_fields()}
-        # Get all fields than is defined in the class
-        for f in self.Meta.fields:
-            if hasattr(self, f):
-                field = getattr(self, f)
-                # inject model on field to be able to access it
-                field.csv_model = self.Meta.dbModel
-                attributes[f] = field
-            else:
-                attributes[f] = dmodel[f]
-
-        return attributes
+        return dict(self.spec.fields)
 
     def get_mapping(self):
         """
@@ -155,14 +177,7 @@ class CsvModel(ErrorMixin, metaclass=CsvModelMetaclass):
         the names of the columns and the value is the names
         of the fields of the model
         """
-        match = {}
-        for k, v in self.get_fields().items():
-            if hasattr(v, 'match'):
-                match[k] = v.match
-            else:
-                match[k] = k
-
-        return match
+        return dict(self.spec.mapping)
 
     def get_dict_error(self):
         if self.dict_error:
@@ -172,20 +187,36 @@ class CsvModel(ErrorMixin, metaclass=CsvModelMetaclass):
         self.dict_error = {i: (msg % i) for i in self.get_user_visible_fields()}
         return self.dict_error
 
-    def open_file(self, path):
-        if self.encoding is None:
-            me = Magic(mime_encoding=True)
-            enc = me.from_file(path)
-        else:
-            enc = self.encoding
-        txt = open(path, encoding=enc).read()
-        csv = bytes(txt, encoding='utf-8')
-        return io.BytesIO(csv)
-
-    def change_headers_mapping(self):
-        reader = csv.DictReader(self.csv_file, delimiter=self.delimiter)
-        fieldnames = reader.fieldnames
-
+    def get_encodings(self, path):
+        """
+        Return the encodings tried to decode the file, in order.
+        """
+        if self.encoding is not None:
+            return [self.encoding]
+        # the encoding which decoded the file on a previous run of the import
+        if self.log is not None and self.log.encoding:
+            return [self.log.encoding]
+        return encoding.get_encodings(path)
+
+    def store_encoding(self, csv_file):
+        """
+        Keep the encoding which decoded the whole file on the log.
+        """
+        if self.encoding is not None or self.log is None or self.log.encoding:
+            return
+        self.log.encoding = csv_file.encoding
+        if self.log.pk is not None:
+            # kept even if the import doesn't finish
+            type(self.log)._default_manager.filter(pk=self.log.pk).update(encoding=csv_file.encoding)
+
+    def open_file(self, csvfile):
+        if isinstance(csvfile, str):
+            with self.timings.measure('encoding'):
+                encodings = self.get_encodings(csvfile)
+            return CsvFileReader(csvfile, encoding=encodings[0], fallbacks=encodings[1:])
+        return CsvFileReader(csvfile, encoding=self.encoding or 'utf-8')
+
+    def change_headers_mapping(self, fieldnames):
         if self.headers_mapping is None:
             return fieldnames
 
@@ -200,51 +231,340 @@ class CsvModel(ErrorMixin, metaclass=CsvModelMetaclass):
         return new_fieldnames
 
     def is_valid(self, log=None):
+        if self.dry_run:
+            # nothing is written by the csv model, but pre_save
+            # methods could write, so undo anything they do
+            with transaction.atomic():
+                valid = self.validate_file(log)
+                transaction.set_rollback(True)
+            return valid
+
+        if not self.needs_import_transaction():
+            return self.validate_file(log)
+
+        # Rows are written while the file is being processed,
+        # so undo them if at the end the file is not valid
+        with transaction.atomic():
+            valid = self.validate_file(log)
+            if not valid and not self.warning_mode:
+                transaction.set_rollback(True)
+        return valid
+
+    def validate_file(self, log=None):
+        reporter = self.get_progress_reporter(log)
+        try:
+            return self.read_file(log, reporter)
+        finally:
+            if reporter is not None:
+                reporter.close()
+
+    def read_file(self, log, reporter):
+        signals.import_started.send(sender=type(self), importer=self, log=log)
+        with self.open_file(self.file) as csv_file:
+            if not self.start_file(csv_file, reporter):
+                return False
+
+            run_parallel = self.can_run_parallel(csv_file)
+            if run_parallel:
+                data_start = parallel.find_record_end(csv_file.stream, 0)
+                chunks = parallel.validate_chunks(self, data_start, csv_file.encodings, self.workers)
+            else:
+                chunks = ((rows, csv_file.progress) for rows in self.build_chunks(self.csv_reader))
+
+            num_rows = 0
+            for rows, file_progress in chunks:
+                num_rows = self.process_chunk(rows, reporter, file_progress)
+            # workers decode their ranges with their own readers
+            self.end_file(csv_file, reporter, num_rows, decoded=not run_parallel)
+
+        return self.finish_file()
 
-        print(log)
-        processed_rows = 0
-        total_lines = 0
+    async def ais_valid(self, log=None):
+        """
+        Coroutine version of is_valid(). The event loop isn't blocked, but
+        queries run one after another on the thread used by the async ORM
+        (sync_to_async is thread sensitive), so they see the transaction
+        of the caller.
+        """
+        if self.dry_run or self.needs_import_transaction():
+            # the transaction which holds the written rows (or
+            # undoes a dry run) can't be shared between coroutines
+            return await sync_to_async(self.is_valid)(log)
 
-        csv_file = self.file
-        if isinstance(self.file, str):
-            csv_file = self.open_file(self.file)
-        self.csv_file = csv_file.read().decode('UTF-8').splitlines()
-        fieldnames = self.change_headers_mapping()
-        self.csv_reader = csv.DictReader(self.csv_file, delimiter=self.delimiter, fieldnames=fieldnames)
-        # Skip header because we are passing fieldnames
-        next(self.csv_reader)
+        reporter = await sync_to_async(self.get_progress_reporter)(log)
+        try:
+            return await self.aread_file(log, reporter)
+        finally:
+            if reporter is not None:
+                await sync_to_async(reporter.close)()
+
+    async def aread_file(self, log, reporter):
+        await sync_to_async(signals.import_started.send)(sender=type(self), importer=self, log=log)
+        csv_file = await sync_to_async(self.open_file)(self.file)
+        try:
+            if not await sync_to_async(self.start_file)(csv_file, reporter):
+                return False
+
+            chunks = self.read_chunks(self.csv_reader)
+            read_chunk = sync_to_async(next)
+            num_rows = 0
+            while True:
+                chunk = await read_chunk(chunks, None)
+                if chunk is None:
+                    break
+
+                rows = await sync_to_async(self.build_chunk)(chunk)
+                num_rows = await sync_to_async(self.process_chunk)(rows, reporter, csv_file.progress)
+            await sync_to_async(self.end_file)(csv_file, reporter, num_rows)
+        finally:
+            csv_file.close()
+
+        return await sync_to_async(self.finish_file)()
+
+    def start_file(self, csv_file, reporter):
+        if self.read_header(csv_file):
+            return True
+        if reporter is not None:
+            reporter.finish(0)
+        return False
+
+    def process_chunk(self, rows, reporter, file_progress):
+        """
+        Check, write and report the rows of a chunk once they have been
+        built. Return the number of rows read so far.
+        """
+        self.finish_chunk(rows)
+        self.errors.flush()
+        signals.chunk_processed.send(sender=type(self), importer=self, rows=rows)
+
+        num_rows = rows[-1].line_number - 1
+        if reporter is not None:
+            reporter.update(file_progress, num_rows)
+        return num_rows
+
+    def end_file(self, csv_file, reporter, num_rows, decoded=True):
+        if reporter is not None:
+            reporter.finish(num_rows)
+        self.bytes_processed = csv_file.total_bytes or csv_file.bytes_read
+        # unless decoded is false, the whole file has been decoded by csv_file
+        if isinstance(self.file, str) and decoded:
+            self.store_encoding(csv_file)
+
+    def read_header(self, csv_file):
+        self.csv_reader = csv.reader(csv_file, delimiter=self.delimiter)
+        header = next(self.csv_reader, [])
+        self.fieldnames = self.change_headers_mapping(header)
 
         self.validate_header()
         if self.errors:
             return False
 
-        num_lines = len(self.csv_file) - 1 if total_lines == 0 else total_lines
-        # Status progress will be saved 10 times
-        block_lines = int(num_lines / 10) if num_lines >= 10 else 1
+        # rows are parsed as lists, and cells are read by position
+        self.column_indexes = {name: i for i, name in enumerate(self.fieldnames)}
+        self.plan = self.spec.bind(self.context, self.default_values, self.column_indexes)
+        return True
 
-        for line_number, line in enumerate(self.csv_reader, start=2):
-            # line is a dictionary with the fields of csv head as key
-            # and values of the row as value of the dictionary
-            self.process_line(line, line_number)
+    def finish_file(self):
+        self.validate_in_file()
+        return not self.errors
 
-            row = processed_rows + line_number - 1
-            progress = round(row * 100 / num_lines)
-            if log is not None and row % block_lines == 0:
-                log.progress = progress
-                log.num_rows = row
-                print('Saving')
-                log.save()
+    def needs_import_transaction(self):
+        # rows saved while validating are rolled back if the file is not valid
+        writes_rows = (self.chunk_size or self.has_save) and not self.dry_run
+        return bool(writes_rows) and self.commit_scope == 'import'
 
-        self.validate_in_file()
-        if self.errors:
-            if self.has_save and not self.warning_mode:
-                # delete related objects created if there are errors
-                # while processing post_save operations
-                ids = [o.object.id for o in self.list_objs]
-                self.dbModel.objects.filter(id__in=ids).delete()
+    def get_chunk_size(self):
+        # rows saved one by one are built once the previous ones have been
+        # saved, so their pre_save methods and lookups can find them
+        if self.saves_rows_one_by_one():
+            return 1
+        return self.chunk_size or DEFAULT_CHUNK_SIZE
+
+    def saves_rows_one_by_one(self):
+        return self.has_save and not self.spec.bulk_save and not self.dry_run
+
+    def can_run_parallel(self, csv_file):
+        if self.workers <= 1 or not isinstance(self.file, str):
+            return False
+        # rows which are saved one by one or need their
+        # post_save methods can't be sent between processes
+        if (self.has_save and not self.dry_run) or self.keep_rows:
             return False
+        if 'fork' not in parallel.multiprocessing.get_all_start_methods():
+            return False
+        return all(parallel.can_split(file_encoding) for file_encoding in csv_file.encodings)
 
-        return True
+    def read_chunks(self, reader):
+        """
+        Yield the rows of reader, with their line numbers, in chunks.
+        """
+        chunk_size = self.get_chunk_size()
+        chunk = []
+        line_number = 1
+        started = time.perf_counter()
+        for row in reader:
+            # skip blank lines, as csv.DictReader does
+            if not row:
+                continue
+            line_number += 1
+            chunk.append((row, line_number))
+            if len(chunk) >= chunk_size:
+                self.timings.lap('parse', started)
+                yield chunk
+                started = time.perf_counter()
+                chunk = []
+
+        self.timings.lap('parse', started)
+        if chunk:
+            yield chunk
+
+    def build_chunks(self, reader):
+        """
+        Parse, convert and validate the rows of reader in chunks.
+        """
+        for chunk in self.read_chunks(reader):
+            yield self.build_chunk(chunk)
+
+    def build_chunk(self, chunk):
+        prefetched = self.prefetch_relations(chunk)
+        return self.build_rows(chunk, prefetched)
+
+    def build_rows(self, chunk, prefetched):
+        rows = [self.build_row(row, line_number, prefetched) for row, line_number in chunk]
+        if self.spec.pre_save_batch:
+            # rows are validated once their batch pre_save methods are run
+            built = [row for row in rows if row.built]
+            with self.timings.measure('pre_save'):
+                self.exec_batch(self.spec.pre_save_batch, built)
+            for row in built:
+                row.finish()
+        return rows
+
+    def finish_chunk(self, rows):
+        self.check_unique(rows)
+        self.add_rows(rows)
+
+    def add_rows(self, rows):
+        if self.has_save and not self.dry_run and self.can_commit():
+            with self.chunk_transaction(rows):
+                self.save_rows([row for row in rows if row.validated and not row.skip])
+        for row in rows:
+            self.add_row(row)
+
+        if not self.chunk_size:
+            return
+
+        # write the chunk unless it will be rolled back anyway
+        if self.can_write() and self.can_commit():
+            with self.chunk_transaction(self.list_objs):
+                self.write_rows(self.list_objs)
+        self.list_objs = []
+
+    def can_commit(self):
+        # rows written on an import transaction are
+        # rolled back if the file has errors
+        if self.commit_scope == 'import' and self.has_save:
+            return True
+        return self.warning_mode or not self.has_errors()
+
+    @contextmanager
+    def chunk_transaction(self, rows):
+        """
+        On chunk commit scope, write the rows of a chunk in their own
+        transaction (or savepoint), which is committed once they are
+        written or rolled back if writing them fails.
+        """
+        if self.commit_scope != 'chunk' or not rows:
+            yield
+            return
+
+        num_errors = self.count_errors(rows)
+        with transaction.atomic():
+            yield
+            failed = self.count_errors(rows) > num_errors
+            if not self.warning_mode:
+                # the file is not valid, don't keep any row of the chunk
+                failed = failed or any(getattr(row, 'errors', None) for row in rows)
+            if failed:
+                transaction.set_rollback(True)
+
+        if failed and self.warning_mode:
+            first, last = rows[0].line_number, rows[-1].line_number
+            self.add_error(first, _('all fields'), _(
+                'Lines %(first)s to %(last)s have not been saved because of errors.'
+            ) % {'first': first, 'last': last})
+
+    def count_errors(self, rows):
+        return self.errors.total + sum(len(getattr(row, 'errors', None) or []) for row in rows)
+
+    def save_rows(self, rows):
+        """
+        Save the rows of a chunk on Meta.save mode.
+        """
+        if not self.spec.bulk_save:
+            for row in rows:
+                started = time.perf_counter()
+                row.save()
+                started = self.timings.lap('save', started)
+                row.post_save()
+                self.timings.lap('post_save', started)
+            with self.timings.measure('post_save'):
+                self.exec_batch(self.spec.post_save_batch,
+                                [row for row in rows if row.object and row.object.pk is not None])
+            return
+
+        saved = [row for row in rows if row.object and not row.errors and self.spec.create_model]
+        try:
+            with transaction.atomic():
+                with self.timings.measure('write'):
+                    self.get_writer().write([row.object for row in saved])
+                with self.timings.measure('post_save'):
+                    for row in rows:
+                        row.post_save()
+                    # errors are reported when the rows are added
+                    self.exec_batch(self.spec.post_save_batch, saved)
+        except DatabaseError as e:
+            self.add_error(1, "Error Database", {"Error Database": e.args})
+            return
+        self.invalidate_lookups()
+
+    def exec_batch(self, functions, rows):
+        """
+        Run batch methods, which receive a list of rows. Errors raised by
+        them are added to all the rows, but methods can add errors to
+        specific rows with row.add_error().
+        """
+        if not rows:
+            return
+        for f in functions:
+            try:
+                f(rows)
+            except (ValidationError, ValueError, KeyError, ObjectDoesNotExist, DatabaseError) as error:
+                file_name = os.path.split(f.__name__)[-1]
+                for row in rows:
+                    row.add_error(row.line_number, file_name, error)
+
+    def post_save_batch(self, rows):
+        if not self.spec.post_save_batch:
+            return
+        # rows have been added already, so report their new errors
+        num_errors = [len(row.errors) for row in rows]
+        self.exec_batch(self.spec.post_save_batch, rows)
+        for row, count in zip(rows, num_errors):
+            self.errors.extend(row.errors[count:])
+
+    def has_errors(self):
+        return bool(self.errors or self.repeated_unique_together)
+
+    def can_write(self):
+        return not (self.has_save or self.not_create_model or self.dry_run)
+
+    def get_progress_reporter(self, log):
+        if log is None:
+            return None
+        reporter = progress.ProgressReporter(log)
+        reporter.start()
+        return reporter
 
     def validate_header(self):
         if self.errors:
@@ -253,7 +573,7 @@ class CsvModel(ErrorMixin, metaclass=CsvModelMetaclass):
         errors = {}
         for f in self.get_user_visible_fields():
             # Show error If column missing from file and it doesnt have a default
-            if f not in self.csv_reader.fieldnames and f not in self.default_values:
+            if f not in self.fieldnames and f not in self.default_values:
                 errors.update({f: _(self.get_dict_error()[f])})
 
         if errors:
@@ -264,72 +584,235 @@ class CsvModel(ErrorMixin, metaclass=CsvModelMetaclass):
 
     def save(self):
         if self.errors and not self.warning_mode: return self.errors
-        if self.has_save: return
-        if self.not_create_model: return
+        if not self.can_write(): return
+        # on chunked mode rows are written while validating the file
+        if self.chunk_size: return
+
+        if self.commit_scope != 'chunk':
+            self.write_rows(self.list_objs)
+            return
+
+        chunk_size = self.get_chunk_size()
+        for i in range(0, len(self.list_objs), chunk_size):
+            rows = self.list_objs[i:i + chunk_size]
+            with self.chunk_transaction(rows):
+                self.write_rows(rows)
 
+    async def asave(self):
+        """
+        Coroutine version of save(). Rows are written in a single
+        transaction, so they are written from the thread of the async ORM.
+        """
+        return await sync_to_async(self.save)()
+
+    def write_rows(self, rows):
         lines = []
-        for i in self.list_objs:
-            if i.object:
+        for i in rows:
+            if i.object and not getattr(i, 'errors', None):
                 lines.append(i.object)
             else:
                 continue
 
         try:
             with transaction.atomic():
-                self.dbModel.objects.bulk_create(lines, batch_size=20)
+                with self.timings.measure('write'):
+                    self.get_writer().write(lines)
+
+                with self.timings.measure('post_save'):
+                    if self.post_save:
+                        for row in rows:
+                            row.post_save()
+                            if row.errors:
+                                self.errors.extend(row.errors)
 
-                if not self.post_save: return
-                for row in self.list_objs:
-                    row.post_save()
-                    if row.errors:
-                        self.errors.extend(row.errors)
+                    self.post_save_batch([i for i in rows if i.object and i.object.pk is not None])
 
         except DatabaseError as e:
             self.add_error(1, "Error Database", {"Error Database": e.args})
+            return
+        self.invalidate_lookups()
 
         # except Exception as e:
         #     print(*sys.exc_info())
         #     return
 
+    def invalidate_lookups(self):
+        # writers don't send post_save, which drops the lookups of the model
+        cache.invalidate(self.dbModel)
+
+    def get_writer(self):
+        # the writer is kept so batch sizes are tuned across chunks
+        if self.writer is None:
+            upsert = None
+            if self.upsert:
+                upsert = (self.spec.conflict_fields, self.spec.update_fields)
+            # saved rows and post_save methods need the primary keys of the written objects
+            needs_pks = bool(self.post_save or self.spec.post_save_batch or self.has_save)
+            self.writer = writers.get_writer(self.dbModel, self.spec.writer,
+                                             needs_pks=needs_pks,
+                                             batch_size=self.spec.batch_size,
+                                             upsert=upsert)
+        return self.writer
+
+    def prefetch_relations(self, chunk):
+        """
+        Resolve in bulk the values of the relation fields of a chunk,
+        instead of running one query per row and field.
+        """
+        with self.timings.measure('lookups'):
+            return {
+                column.csv_fieldname: column.prefetch(values)
+                for column, values in self.get_prefetch_values(chunk)
+            }
+
+    def get_prefetch_values(self, chunk):
+        for column in self.plan:
+            if column.kind != CELL or column.prefetch is None:
+                continue
 
-    def process_line(self, line, line_number):
-        data = {
-            'line': line,
-            'line_number': line_number,
-            'context': self.context,
-            'meta': self.Meta,
-            'fields': self.fields,
-            'mapping': self.mapping,
-            'validate_unique': self.validate_unique,
-            'append_mode': self.append_mode,
-            'exclude_fields': self.exclude_fields,
-            'default_values': self.default_values,
-        }
-        new_obj = ReadRow(**data)
-        if new_obj.errors:
-            self.errors.extend(new_obj.errors)
-        if not new_obj.skip:
-            self.list_objs.append(new_obj)
+            index = column.index
+            values = {row[index] for row, line_number in chunk if index < len(row) and row[index]}
+            if values:
+                yield column, values
+
+    def build_row(self, row, line_number, prefetched=None):
+        line = RowLine(row, self.column_indexes)
+        return ReadRow(self.spec, self.plan, line=line, line_number=line_number,
+                       context=self.context, prefetched=prefetched, timings=self.timings)
+
+    def add_row(self, row):
+        if row.errors:
+            self.errors.extend(row.errors)
+        if not row.skip:
+            # post_save methods need the whole row to be run by save(),
+            # otherwise only keep what is needed to write the object
+            self.list_objs.append(row if self.keep_rows else RowRecord(row))
+            self.num_rows += 1
+            self.check_unique_together(row)
+
+    def check_unique(self, rows):
+        """
+        Run the unique validation of the model for all the rows of a chunk,
+        using one query per unique constraint instead of one per row.
+        """
+        with self.timings.measure('unique'):
+            rows, checks, date_checks = self.get_unique_checks(rows)
+            existing = [
+                self.get_existing_keys(model_class, attnames, rows_by_key.keys())
+                for model_class, unique_check, attnames, rows_by_key in checks
+            ]
+            self.set_unique_errors(rows, checks, existing, date_checks)
+
+    def get_unique_checks(self, rows):
+        """
+        Return the clean rows of a chunk, and for each unique check of the
+        model the attnames and the rows which have each key.
+        """
+        if not self.validate_unique:
+            return [], [], []
+
+        rows = [row for row in rows if row.is_clean]
+        if not rows:
+            return [], [], []
+
+        checks = []
+        unique_checks, date_checks = rows[0].object._get_unique_checks()
+        for model_class, unique_check in unique_checks:
+            attnames = [self.dbModel._meta.get_field(name).attname for name in unique_check]
+            rows_by_key = {}
+            for row in rows:
+                key = row.get_unique_key(attnames)
+                if key is not None:
+                    rows_by_key.setdefault(key, []).append(row)
+            checks.append((model_class, unique_check, attnames, rows_by_key))
+
+        return rows, checks, date_checks
+
+    def set_unique_errors(self, rows, checks, existing_keys, date_checks):
+        errors = {}
+        for (model_class, unique_check, attnames, rows_by_key), existing in zip(checks, existing_keys):
+            seen = self.dry_run_keys.setdefault(unique_check, set()) if self.dry_run else None
+            for key, key_rows in rows_by_key.items():
+                if key in existing:
+                    pass
+                elif seen is not None:
+                    # the rows of previous chunks aren't written on dry
+                    # runs, so keys repeated on the file are checked here
+                    if key not in seen:
+                        key_rows = key_rows[1:]
+                    seen.add(key)
+                elif self.has_save:
+                    # on Meta.save mode the first row is saved along with
+                    # the rest of the chunk, so the next ones are duplicated
+                    key_rows = key_rows[1:]
+                else:
+                    continue
+
+                error_key = unique_check[0] if len(unique_check) == 1 else NON_FIELD_ERRORS
+                for row in key_rows:
+                    message = row.object.unique_error_message(model_class, unique_check)
+                    errors.setdefault(row, {}).setdefault(error_key, []).append(message)
+
+        if date_checks:
+            for row in rows:
+                row_errors = row.object._perform_date_checks(date_checks)
+                for key, messages in row_errors.items():
+                    errors.setdefault(row, {}).setdefault(key, []).extend(messages)
+
+        for row in rows:
+            if row in errors:
+                row.unique_validation(ValidationError(errors[row]))
+
+    def get_existing_keys(self, model_class, attnames, keys):
+        keys = list(keys)
+        queryset = model_class._default_manager.all()
+        batch_size = max(1, MAX_LOOKUP_PARAMS // len(attnames))
+        existing = set()
+        for i in range(0, len(keys), batch_size):
+            batch = keys[i:i + batch_size]
+            if len(attnames) == 1:
+                lookup = Q(**{attnames[0] + '__in': [key[0] for key in batch]})
+            else:
+                lookup = Q()
+                for key in batch:
+                    lookup |= Q(**dict(zip(attnames, key)))
+            existing.update(queryset.filter(lookup).values_list(*attnames))
+        return existing
+
+    def check_unique_together(self, row):
+        # Only the keys are kept, so rows can be released once
+        # their chunk has been processed
+        if not self.unique_together:
+            return
+        t = row.unique_together
+        if t in self.unique_together_seen:
+            self.repeated_unique_together.append((row.line_number, t))
+        else:
+            self.unique_together_seen.add(t)
 
     def validate_in_file(self):
-        # TODO(@slamora) optimize using Counter???
-        # https://docs.python.org/3/library/collections.html#collections.Counter
         # this method is for check duplicates unique
         # and unique together fields in the same file
         # before save
-        if not hasattr(self.Meta, 'unique_together'):
-            return
-        l_unique_together = {}
-        for i in self.list_objs:
-            # unique_together
-            t = i.unique_together
-            if t in l_unique_together:
-                msg = "Combination of %s %s is repeated."
-                msg = msg % (', '.join(self.Meta.unique_together), t)
-                err = ValidationError({'unique': msg}, code='invalid')
-                self.add_error(i.line_number, 'unique', err)
-            else:
-                l_unique_together[t] = None
+        for line_number, t in self.repeated_unique_together:
+            msg = "Combination of %s %s is repeated."
+            msg = msg % (', '.join(self.spec.unique_together), t)
+            err = ValidationError({'unique': msg}, code='invalid')
+            self.add_error(line_number, 'unique', err)
+        self.repeated_unique_together = []
+
+
+class RowRecord:
+    """
+    What is kept of a row once it has been processed
+    """
+    __slots__ = ('object', 'line_number', 'unique_together')
+
+    def __init__(self, row):
+        # objects of invalid rows are never written
+        self.object = None if row.errors else row.object
+        self.line_number = row.line_number
+        self.unique_together = getattr(row, 'unique_together', None)
 
 
 class ReadRow(ErrorMixin):
@@ -337,123 +820,201 @@ class ReadRow(ErrorMixin):
     This class build a object from the datas to a row
     """
 
-    def __init__(self, fields=None, mapping=None, meta=None, context=None,
-                 line=None, line_number=None, validate_unique=True, append_mode=False,
-                 exclude_fields=None, default_values=None):
-        self.Meta = meta
-        self.fields = fields
-        self.mapping = mapping
+    def __init__(self, spec, plan, context=None, line=None, line_number=None, prefetched=None, timings=None):
+        self.spec = spec
+        self.plan = plan
+        self.Meta = spec.meta
+        self.fields = spec.fields
+        self.mapping = spec.mapping
         self.context = context or {}
         self.line = line
         self.line_number = line_number
-        self.validate_unique = validate_unique
-        self.append_mode = append_mode
-        self.exclude_fields = exclude_fields
-        self.default_values = default_values or {}
+        self.append_mode = spec.append_mode
+        self.exclude_fields = spec.exclude_fields
+        self.prefetched = prefetched or {}
+        self.timings = timings if timings is not None else Timings()
 
         self.data = None
+        self.resolved_fields = []
         self.object = None
         self.skip = False
+        self.built = False
+        self.validated = False
+        self.is_clean = False
         self.errors = []
 
         self.secuence()
 
+    def __getstate__(self):
+        # rows validated by worker processes only send back their results
+        state = self.__dict__.copy()
+        for name in ('spec', 'plan', 'Meta', 'fields', 'mapping', 'context', 'line', 'prefetched', 'data', 'timings'):
+            state.pop(name, None)
+        return state
+
+    def attach(self, importer, offset):
+        """
+        Bind a row received from a worker process to the csv model,
+        moving its line number offset lines forward.
+        """
+        self.spec = importer.spec
+        self.plan = importer.plan
+        self.Meta = self.spec.meta
+        self.fields = self.spec.fields
+        self.mapping = self.spec.mapping
+        self.context = importer.context
+        self.line = None
+        self.prefetched = {}
+        self.data = None
+        self.timings = importer.timings
+
+        self.line_number += offset
+        for error in self.errors:
+            error['line'] += offset
+
     def secuence(self):
         self.get_unique_together()
+        timings = self.timings
         try:
-            self.build_obj()
-            self.create_model()
-            self.pre_save()
-            self.validate()
+            # rows with errors are measured too
+            with timings.measure('to_python'):
+                self.build_obj()
+            with timings.measure('create'):
+                self.create_model()
+            with timings.measure('pre_save'):
+                self.pre_save()
         except ValidationError:
             # stop processing the row if there are errors
             # NOTE: errors should be handled inside the functions
             # because there they have more details
             return
 
-        if hasattr(self.Meta, 'save') and self.Meta.save:
-            self.save()
-            self.post_save()
+        self.built = True
+        # with batch pre_save methods, the csv model
+        # finishes the rows once they have been run
+        if not self.spec.pre_save_batch:
+            self.finish()
+
+    def finish(self):
+        started = time.perf_counter()
+        self.validate()
+        self.timings.lap('clean_fields', started)
+        # unique validation and Meta.save are run by the csv model
+        # once the whole chunk has been validated
+        self.validated = True
 
     def not_create_model(self):
-        return hasattr(self.Meta, 'create_model') and \
-                not self.Meta.create_model
+        return not self.spec.create_model
 
     def build_obj(self):
         data = {}
         if not self.line: return
-        if self.not_create_model(): return
-        for csv_fieldname, field in self.fields.items():
-            model_fieldname = self.mapping[csv_fieldname]
+        if not self.spec.create_model: return
+        per_field = self.timings.per_field
+        for column in self.plan:
+            if per_field:
+                started = time.perf_counter()
+            kind = column.kind
             try:
-                if hasattr(field, 'in_csv') and not field.in_csv:
-                    data[model_fieldname] = field.to_python()
-                    continue
-
-                if csv_fieldname in self.context:
-                    data[model_fieldname] = self.context[csv_fieldname]
-                    continue
-
-                if csv_fieldname in self.default_values:
-                    data[model_fieldname] = self.default_values[csv_fieldname]
-                    continue
-
-                cell = self.line[csv_fieldname]
-                data[model_fieldname] = field.to_python(cell)
+                if kind == CELL:
+                    if column.index is None:
+                        cell = self.line[column.csv_fieldname]
+                    else:
+                        row = self.line.row
+                        cell = row[column.index] if column.index < len(row) else None
+                    # values resolved in bulk for the chunk, keyed by
+                    # the values looked up, without spaces
+                    value = None
+                    prefetched = self.prefetched.get(column.csv_fieldname)
+                    if prefetched and cell:
+                        value = prefetched.get(cell.strip())
+                    if value is None:
+                        value = column.field.to_python(cell)
+
+                    if value is not None and column.is_relation:
+                        self.resolved_fields.append(column.model_fieldname)
+                elif kind == FIXED:
+                    value = column.field.to_python()
+                else:
+                    # value taken from the context or the default values
+                    value = column.value
             except ValidationError as error:
                 # handle the error here because we know which is the
                 # invalid field and we want to provide this info to
                 # the user.
-                self.add_error(self.line_number, csv_fieldname, error)
+                self.add_error(self.line_number, column.csv_fieldname, error)
+                if per_field:
+                    self.timings.lap('to_python.' + column.csv_fieldname, started)
                 raise
-            # except Exception as e:
-            #     print(*sys.exc_info())
-            #     raise # reraises the exception
+            data[column.target] = value
+            if per_field:
+                self.timings.lap('to_python.' + column.csv_fieldname, started)
         self.data = data
 
     def create_model(self):
         if not self.data: return
-        self.object = self.Meta.dbModel(**self.data)
+        self.object = self.spec.db_model(**self.data)
 
     def validate(self):
         if not self.object: return
         try:
-            self.object.clean_fields(exclude=self.exclude_fields)
+            # related objects have just been fetched from the database,
+            # don't query them again to check that they exist
+            exclude = list(self.exclude_fields or []) + self.resolved_fields + self.get_loaded_relations()
+            self.object.clean_fields(exclude=exclude)
             self.object.clean()
-            self.unique_validation()
         except ValidationError as e:
-            field = list(e.message_dict.keys())[0]
-            # Only print errors if field is related to uploaded file,
-            # but if no errors added, add error to prevent a valid file when it isn't
-            if field in list(self.mapping.values()) or len(self.errors) == 0:
-                self.add_error(self.line_number, field, e)
-
-    def unique_validation(self):
-        if self.validate_unique:
-            try:
-                self.object.validate_unique()
-            except ValidationError as e:
-                if self.append_mode:
-                    self.skip = True
-                else:
-                    raise e
+            self.handle_validation_error(e)
+            return
+        self.is_clean = True
+
+    def get_loaded_relations(self):
+        # related objects set from the database (e.g. by pre_save methods) exist
+        names = []
+        for field in self.object._meta.concrete_fields:
+            if not field.is_relation or not field.is_cached(self.object):
+                continue
+            related = field.get_cached_value(self.object)
+            if related is not None and not related._state.adding:
+                names.append(field.name)
+        return names
+
+    def handle_validation_error(self, e):
+        field = list(e.message_dict.keys())[0]
+        # Only print errors if field is related to uploaded file,
+        # but if no errors added, add error to prevent a valid file when it isn't
+        if field in self.spec.model_fieldnames or len(self.errors) == 0:
+            self.add_error(self.line_number, field, e)
+
+    def unique_validation(self, error):
+        if self.append_mode:
+            self.skip = True
+        else:
+            self.handle_validation_error(error)
+
+    def get_unique_key(self, attnames):
+        key = []
+        for attname in attnames:
+            value = getattr(self.object, attname)
+            # same as Model.validate_unique, don't check incomplete keys
+            if value is None or (value == '' and connection.features.interprets_empty_strings_as_nulls):
+                return None
+            key.append(value)
+        return tuple(key)
 
     def save(self):
         if self.errors: return self.errors
         if not self.object: return
-        if hasattr(self.Meta, 'create_model') and not self.Meta.create_model:
+        if not self.spec.create_model:
             return
         self.object.save()
 
     def get_unique_together(self):
         if not self.line: return
-        if not hasattr(self.Meta, 'unique_together'):
+        if self.spec.unique_together is None:
             return
 
-        t = []
-        for u in self.Meta.unique_together:
-            t.append(self.line[u])
-        self.unique_together = tuple(t)
+        self.unique_together = tuple(self.line[u] for u in self.spec.unique_together)
 
     def exec_f(self, f):
         try:
@@ -467,13 +1028,9 @@ class ReadRow(ErrorMixin):
             self.add_error(self.line_number, file_name, error)
 
     def pre_save(self):
-        if not hasattr(self.Meta, 'pre_save'): return
-        for pre in self.Meta.pre_save:
-            f = getattr(self.Meta, pre)
+        for f in self.spec.pre_save:
             self.exec_f(f)
 
     def post_save(self):
-        if not hasattr(self.Meta, 'post_save'): return
-        for post in self.Meta.post_save:
-            f = getattr(self.Meta, post)
+        for f in self.spec.post_save:
             self.exec_f(f)
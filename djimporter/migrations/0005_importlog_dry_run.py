@@ -0,0 +1,18 @@
+# Generated by Django 4.0.10 on 2026-10-18 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djimporter', '0004_importlog_progress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importlog',
+            name='dry_run',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.10 on 2026-10-18 11:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djimporter', '0005_importlog_dry_run'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importlog',
+            name='started_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.0.10 on 2026-10-18 12:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djimporter', '0006_importlog_started_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportLogError',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('log_id', models.IntegerField(db_index=True)),
+                ('line', models.IntegerField(null=True)),
+                ('field', models.CharField(max_length=255)),
+                ('message', models.TextField()),
+                ('count', models.IntegerField(default=1)),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+    ]
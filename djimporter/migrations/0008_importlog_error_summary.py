@@ -0,0 +1,18 @@
+# Generated by Django 4.0.10 on 2026-10-18 12:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djimporter', '0007_importlogerror'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importlog',
+            name='error_summary',
+            field=models.TextField(blank=True),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.0.10 on 2026-10-18 13:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djimporter', '0008_importlog_error_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importlog',
+            name='bytes_processed',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='importlog',
+            name='duration',
+            field=models.DurationField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='importlog',
+            name='num_errors',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='importlog',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='importlog',
+            name='status',
+            field=models.CharField(choices=[('created', 'CREATED'), ('running', 'RUNNING'), ('failed', 'FAILED'), ('partial-with-errors', 'PARTIAL-WITH-ERRORS'), ('completed', 'COMPLETED')], db_index=True, max_length=25),
+        ),
+        migrations.AlterField(
+            model_name='importlog',
+            name='user',
+            field=models.CharField(db_index=True, max_length=512),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.10 on 2026-10-18 14:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djimporter', '0009_importlog_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importlog',
+            name='timings',
+            field=models.TextField(blank=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.0.10 on 2026-10-18 14:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djimporter', '0010_importlog_timings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importlog',
+            name='profile_file',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='importlog',
+            name='profile_summary',
+            field=models.TextField(blank=True),
+        ),
+    ]
@@ -17,22 +17,95 @@ class AbstractBaseLog(models.Model):
         (COMPLETED, 'COMPLETED'),
     )
 
-    status = models.CharField(max_length=25, choices=STATUS_CHOICES)
+    status = models.CharField(max_length=25, choices=STATUS_CHOICES, db_index=True)
     progress = models.SmallIntegerField(default=0)
-    created_at = models.DateTimeField(auto_now_add=True)
-    user = models.CharField(max_length=512)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    user = models.CharField(max_length=512, db_index=True)
 
     errors = models.TextField(blank=True)
+    # number of lines of each error, as json
+    error_summary = models.TextField(blank=True)
     num_rows = models.IntegerField(null=True)
     input_file = models.CharField(max_length=100)
+    # set when the file starts being processed
+    started_at = models.DateTimeField(null=True, blank=True)
+    # the file has only been validated
+    dry_run = models.BooleanField(default=False)
+    # set when the import finishes, so lists don't read the errors
+    num_errors = models.IntegerField(default=0)
+    duration = models.DurationField(null=True, blank=True)
+    bytes_processed = models.BigIntegerField(null=True, blank=True)
+    # seconds spent on each phase of the import, as json
+    timings = models.TextField(blank=True)
+    # profile of the import (see profiling.py), on the default storage
+    profile_file = models.CharField(max_length=255, blank=True)
+    profile_summary = models.TextField(blank=True)
+    # encoding detected on the file, reused when the import runs again
+    encoding = models.CharField(max_length=50, blank=True)
 
     class Meta:
         abstract = True
         ordering = ['-created_at']
 
     def list_errors(self):
+        errors = list(self.get_errors().filter(line__isnull=False).values('line', 'field', 'message'))
+        if errors:
+            return errors
+        # logs of previous versions kept the errors on the errors field
         return json.loads(self.errors or "[]")
 
+    def get_timings(self):
+        return json.loads(self.timings or "{}")
+
+    def list_errors_overflow(self):
+        """
+        Return the errors which have not been kept verbatim,
+        counted by field and message.
+        """
+        return list(self.get_errors().filter(line__isnull=True).values('field', 'message', 'count'))
+
+    def list_error_summary(self):
+        """
+        Return the number of lines of each error (by field and message).
+        """
+        if self.error_summary:
+            return json.loads(self.error_summary)
+
+        # computed for logs without summary
+        errors = [dict(error, count=1) for error in self.list_errors()]
+        errors.extend(self.list_errors_overflow())
+        summary = {}
+        for error in errors:
+            if 'message' in error and 'field' in error:
+                key = (error['field'], error['message'])
+                if key not in summary:
+                    summary[key] = {'field': error['field'], 'message': error['message'], 'line_count': 0}
+                summary[key]['line_count'] += error['count']
+        return list(summary.values())
+
+    def get_errors(self):
+        return ImportLogError.objects.filter(log_id=self.pk)
+
 
 class ImportLog(AbstractBaseLog):
     pass
+
+
+class ImportLogError(models.Model):
+    """
+    Error found while importing a file. Errors beyond DJIMPORTER_MAX_ERRORS
+    are stored without line, counted by field and message.
+    """
+    # the log model can be replaced (IMPORT_LOG_MODEL) so it's referenced by its key
+    log_id = models.IntegerField(db_index=True)
+    line = models.IntegerField(null=True)
+    field = models.CharField(max_length=255)
+    message = models.TextField()
+    count = models.IntegerField(default=1)
+
+    class Meta:
+        ordering = ['id']
+
+
+def delete_log_errors(sender, instance, **kwargs):
+    ImportLogError.objects.filter(log_id=instance.pk).delete()
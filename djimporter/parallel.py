@@ -0,0 +1,189 @@
+"""
+Validate big files using a pool of worker processes.
+
+The file is split in byte ranges which end on a record boundary. Worker
+processes parse, convert and validate the rows of each range (including
+pre_save methods) and send them back, in order, to the csv model, which
+checks unique constraints, reports errors and writes the objects exactly
+as it does when the file is processed serially. Only RANGES_PER_WORKER
+ranges per worker are validated ahead of the csv model, so memory usage
+doesn't depend on the size of the file.
+"""
+import codecs
+import collections
+import csv
+import io
+import itertools
+import multiprocessing
+import os
+
+from django.db import connections
+
+from .readers import CsvFileReader
+
+# Approximate size of the ranges sent to the workers
+RANGE_SIZE = 4 * 1024 * 1024
+
+# Size of the blocks read while looking for record boundaries
+SCAN_SIZE = 1024 * 1024
+
+# Ranges sent to each worker ahead of the ones the csv model is writing,
+# so validated rows don't pile up when writing is slower than validating
+RANGES_PER_WORKER = 2
+
+# State shared with the forked workers
+_state = {}
+_inherited_connections = []
+
+
+def can_split(encoding):
+    """
+    Ranges are found scanning bytes, so every character used by the csv
+    syntax must be encoded as a single byte of the same value.
+    """
+    try:
+        codec = codecs.lookup(encoding)
+    except LookupError:
+        return False
+    if codec.name == 'utf-8-sig':
+        return False
+    return all(char.encode(codec.name) == char.encode('ascii') for char in '\r\n";,\t')
+
+
+def find_record_end(stream, position, quotechar=b'"'):
+    """
+    Return the offset just after the first line break, found from
+    position, which is not inside a quoted field. Quotes are counted
+    from position, so it must be the beginning of a record.
+    """
+    stream.seek(position)
+    in_quotes = False
+    while True:
+        block = stream.read(SCAN_SIZE)
+        if not block:
+            return position
+
+        start = 0
+        while True:
+            index = block.find(b'\n', start)
+            if index == -1:
+                break
+            if (block.count(quotechar, start, index) % 2) == 1:
+                in_quotes = not in_quotes
+            if not in_quotes:
+                return position + index + 1
+            start = index + 1
+
+        if (block.count(quotechar, start) % 2) == 1:
+            in_quotes = not in_quotes
+        position += len(block)
+
+
+def split_ranges(path, start, range_size=None):
+    """
+    Split the file from start in (start, end) ranges of about
+    range_size bytes ending on a record boundary.
+    """
+    range_size = range_size or RANGE_SIZE
+    size = os.path.getsize(path)
+    ranges = []
+    with open(path, 'rb') as stream:
+        while start < size:
+            end = size
+            if start + range_size < size:
+                # records can't be split, so look for the end of
+                # the record which includes start + range_size
+                record_start = find_record_start(stream, start, start + range_size)
+                end = find_record_end(stream, record_start)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def find_record_start(stream, start, position):
+    """
+    Return the beginning of the last record found from start before position.
+    """
+    record_start = start
+    while True:
+        end = find_record_end(stream, record_start)
+        if end > position or end == record_start:
+            return record_start
+        record_start = end
+
+
+def init_worker():
+    # Forked workers must not use the database connections of the parent,
+    # which may be inside a transaction. They are kept referenced so they
+    # are never closed from the worker, and new ones are opened on demand.
+    for alias in connections:
+        connection = connections[alias]
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            # a new connection would open an empty database
+            continue
+        _inherited_connections.append(connection)
+        del connections[alias]
+
+
+def validate_range(bounds):
+    start, end = bounds
+    importer = _state['importer']
+
+    with open(importer.file, 'rb') as stream:
+        stream.seek(start)
+        data = stream.read(end - start)
+
+    encoding, *fallbacks = _state['encodings']
+    with CsvFileReader(io.BytesIO(data), encoding=encoding, fallbacks=fallbacks) as text:
+        reader = csv.reader(text, delimiter=importer.delimiter)
+        return [row for rows in importer.build_chunks(reader) for row in rows]
+
+
+def imap_bounded(pool, func, items, size):
+    """
+    Like Pool.imap, but with at most size items sent to the workers
+    and not consumed yet.
+    """
+    items = iter(items)
+    results = collections.deque()
+    for item in itertools.islice(items, size):
+        results.append(pool.apply_async(func, (item,)))
+    while results:
+        result = results.popleft().get()
+        for item in itertools.islice(items, 1):
+            results.append(pool.apply_async(func, (item,)))
+        yield result
+
+
+def validate_chunks(importer, data_start, encodings, workers):
+    """
+    Yield the validated rows of the file in chunks, like CsvModel.build_chunks,
+    together with the progress of the validation.
+    """
+    ranges = split_ranges(importer.file, data_start)
+    total_bytes = os.path.getsize(importer.file) or 1
+    chunk_size = importer.get_chunk_size()
+
+    _state.update(importer=importer, encodings=encodings)
+    try:
+        context = multiprocessing.get_context('fork')
+        with context.Pool(workers, initializer=init_worker) as pool:
+            offset = 0
+            pending = []
+            for (start, end), rows in zip(ranges, imap_bounded(pool, validate_range, ranges,
+                                                               workers * RANGES_PER_WORKER)):
+                for row in rows:
+                    # workers number the lines from the beginning of its range
+                    row.attach(importer, offset)
+                offset += len(rows)
+                pending.extend(rows)
+
+                progress = round(end * 100 / total_bytes)
+                while len(pending) >= chunk_size:
+                    yield pending[:chunk_size], progress
+                    pending = pending[chunk_size:]
+
+            if pending:
+                yield pending, 100
+    finally:
+        _state.clear()
@@ -0,0 +1,75 @@
+"""
+Profile imports with cProfile.
+
+run_importer profiles an import when it's asked to (profile=True, which
+ImportFormView gets from its form) or, at random, a DJIMPORTER_PROFILE_RATE
+fraction of all of them. The profile is saved on the default storage and
+linked to the log, with a summary of the functions which take most time,
+so slow imports can be studied without their data.
+
+Settings:
+    DJIMPORTER_PROFILE_RATE: fraction of the imports profiled (default 0)
+    DJIMPORTER_PROFILE_DIR: storage directory of the profiles (default 'djimporter/profiles')
+    DJIMPORTER_PROFILE_TOP: number of functions of the summary (default 30)
+"""
+import cProfile
+import io
+import logging
+import marshal
+import posixpath
+import pstats
+import random
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+DEFAULT_DIR = 'djimporter/profiles'
+DEFAULT_TOP = 30
+
+logger = logging.getLogger(__name__)
+
+
+def should_profile(profile=False):
+    if profile:
+        return True
+    rate = getattr(settings, 'DJIMPORTER_PROFILE_RATE', 0)
+    return bool(rate) and random.random() < rate
+
+
+def start():
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def save(log, profiler):
+    """
+    Stop profiler and save its profile, which can be read with
+    pstats.Stats, and its summary on log. Errors of the storage are
+    logged, so the import finishes without the profile file.
+    """
+    profiler.disable()
+    profiler.create_stats()
+    data = marshal.dumps(profiler.stats)
+    log.profile_summary = get_summary(profiler)
+    directory = getattr(settings, 'DJIMPORTER_PROFILE_DIR', DEFAULT_DIR)
+    name = posixpath.join(directory, 'importlog-%s.prof' % log.pk)
+    try:
+        log.profile_file = default_storage.save(name, ContentFile(data))
+    except Exception:
+        logger.exception("The profile of import log %s could not be saved", log.pk)
+
+
+def get_summary(profiler, top=None):
+    if top is None:
+        top = getattr(settings, 'DJIMPORTER_PROFILE_TOP', DEFAULT_TOP)
+    stream = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.strip_dirs().sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top)
+    return stream.getvalue()
+
+
+def delete_log_profile(sender, instance, **kwargs):
+    if instance.profile_file:
+        default_storage.delete(instance.profile_file)
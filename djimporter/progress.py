@@ -0,0 +1,240 @@
+"""
+Report the progress of imports.
+
+A ProgressReporter is throttled by time and by rows: an update is only
+sent once DJIMPORTER_PROGRESS_INTERVAL seconds and DJIMPORTER_PROGRESS_ROWS
+rows have passed since the previous one. Updates are sent to a sink:
+
+    ModelSink (default) writes the progress and num_rows fields of the
+        import log with QuerySet.update(), without saving the whole row.
+    CacheSink keeps them on a cache, so running imports don't write to
+        the database at all.
+
+Imports may run inside a transaction (e.g. chunked imports or csv models
+with Meta.save), which would hide their progress until they finish and
+roll it back with them, so ModelSink writes it on a connection of its own
+meanwhile. On SQLite, which locks the whole database, it's written on the
+transaction of the import.
+
+Besides the progress, sinks provide the throughput (rows per second) and
+the estimated seconds left, which ImportLogGetView returns.
+
+Sinks also mark the log as changed on the cache (as log.save() does), so
+status views waiting for changes only read the log when it has changed.
+This needs a cache shared by the web and the import processes, so status
+views only wait for changes when the cache isn't local (see is_cache_shared).
+
+Settings:
+    DJIMPORTER_PROGRESS_SINK: dotted path of the sink class
+    DJIMPORTER_PROGRESS_INTERVAL: minimum seconds between updates (default 2)
+    DJIMPORTER_PROGRESS_ROWS: minimum rows between updates (default 1000)
+    DJIMPORTER_PROGRESS_CACHE_ALIAS: cache used by CacheSink (default 'default')
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import connections, router
+from django.db.utils import load_backend
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+DEFAULT_INTERVAL = 2
+DEFAULT_ROWS = 1000
+
+# seconds that progress and changes are kept on the cache
+CACHE_TIMEOUT = 24 * 60 * 60
+
+
+def get_cache():
+    return caches[getattr(settings, 'DJIMPORTER_PROGRESS_CACHE_ALIAS', 'default')]
+
+
+def is_cache_shared():
+    """
+    Return whether the changes marked by the import processes can be seen
+    by the web processes, which isn't the case of local memory caches.
+    """
+    return not isinstance(get_cache(), (LocMemCache, DummyCache))
+
+
+def get_change_key(model, pk):
+    return 'djimporter:changed:%s:%s' % (model._meta.label_lower, pk)
+
+
+def notify(log):
+    """
+    Mark log as changed.
+    """
+    get_cache().set(get_change_key(type(log), log.pk), time.time(), CACHE_TIMEOUT)
+
+
+def last_change(model, pk):
+    """
+    Return when the log was changed, or None if it's unknown.
+    """
+    return get_cache().get(get_change_key(model, pk))
+
+
+def log_saved(sender, instance, **kwargs):
+    notify(instance)
+
+
+def get_stats(progress, num_rows, started_at, now=None):
+    """
+    Return the progress of an import, with its throughput and the
+    estimated seconds left, given when it started.
+    """
+    stats = {'progress': progress, 'num_rows': num_rows, 'rows_per_second': None, 'eta': None}
+    if started_at is None:
+        return stats
+
+    now = now or timezone.now()
+    elapsed = (now - started_at).total_seconds()
+    if elapsed > 0 and num_rows:
+        stats['rows_per_second'] = round(num_rows / elapsed, 1)
+    if progress:
+        stats['eta'] = round(elapsed * (100 - progress) / progress)
+    return stats
+
+
+class ModelSink:
+    # databases whose transactions lock the tables read by the status views
+    shared_transaction_vendors = ('sqlite',)
+
+    def __init__(self):
+        self.connection = None
+
+    def start(self, log, started_at):
+        log.started_at = started_at
+        self.update(log, started_at=started_at)
+
+    def write(self, log, stats):
+        log.progress = stats['progress']
+        log.num_rows = stats['num_rows']
+        self.update(log, progress=log.progress, num_rows=log.num_rows)
+
+    def update(self, log, **values):
+        using = router.db_for_write(type(log), instance=log)
+        connection = connections[using]
+        if connection.in_atomic_block and connection.vendor not in self.shared_transaction_vendors:
+            self.update_outside_transaction(using, log, values)
+        else:
+            # don't save the whole row, which includes the errors
+            type(log)._default_manager.using(using).filter(pk=log.pk).update(**values)
+        notify(log)
+
+    def update_outside_transaction(self, using, log, values):
+        if self.connection is None:
+            settings_dict = connections[using].settings_dict
+            self.connection = load_backend(settings_dict['ENGINE']).DatabaseWrapper(settings_dict, using)
+
+        opts = log._meta
+        quote_name = self.connection.ops.quote_name
+        fields = [opts.get_field(name) for name in values]
+        sql = 'UPDATE %s SET %s WHERE %s = %%s' % (
+            quote_name(opts.db_table),
+            ', '.join('%s = %%s' % quote_name(field.column) for field in fields),
+            quote_name(opts.pk.column),
+        )
+        params = [field.get_db_prep_save(values[field.name], connection=self.connection) for field in fields]
+        params.append(opts.pk.get_db_prep_value(log.pk, connection=self.connection))
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def read(self, log):
+        return get_stats(log.progress, log.num_rows, log.started_at)
+
+
+class CacheSink(ModelSink):
+    timeout = CACHE_TIMEOUT
+
+    def get_cache(self):
+        return get_cache()
+
+    def get_key(self, log):
+        return 'djimporter:progress:%s:%s' % (log._meta.label_lower, log.pk)
+
+    def start(self, log, started_at):
+        log.started_at = started_at
+        self.get_cache().set(self.get_key(log), {
+            'progress': 0, 'num_rows': 0, 'started_at': started_at
+        }, self.timeout)
+        notify(log)
+
+    def write(self, log, stats):
+        log.progress = stats['progress']
+        log.num_rows = stats['num_rows']
+        self.get_cache().set(self.get_key(log), dict(stats, started_at=log.started_at), self.timeout)
+        notify(log)
+
+    def read(self, log):
+        data = self.get_cache().get(self.get_key(log))
+        if data is None:
+            return super().read(log)
+        return get_stats(data['progress'], data['num_rows'], data['started_at'])
+
+
+def get_sink():
+    path = getattr(settings, 'DJIMPORTER_PROGRESS_SINK', 'djimporter.progress.ModelSink')
+    return import_string(path)()
+
+
+def read(log):
+    """
+    Return the progress of log, with rows_per_second and eta.
+    """
+    return get_sink().read(log)
+
+
+class ProgressReporter:
+
+    def __init__(self, log, sink=None, interval=None, min_rows=None):
+        self.log = log
+        self.sink = sink or get_sink()
+        if interval is None:
+            interval = getattr(settings, 'DJIMPORTER_PROGRESS_INTERVAL', DEFAULT_INTERVAL)
+        if min_rows is None:
+            min_rows = getattr(settings, 'DJIMPORTER_PROGRESS_ROWS', DEFAULT_ROWS)
+        self.interval = interval
+        self.min_rows = min_rows
+
+        self.last_time = None
+        self.last_rows = 0
+
+    def start(self):
+        self.last_time = time.monotonic()
+        self.last_rows = 0
+        self.sink.start(self.log, timezone.now())
+
+    def is_due(self, num_rows):
+        if self.last_time is None:
+            return True
+        if num_rows - self.last_rows < self.min_rows:
+            return False
+        return time.monotonic() - self.last_time >= self.interval
+
+    def update(self, progress, num_rows):
+        if not self.is_due(num_rows):
+            return
+        self.write(progress, num_rows)
+
+    def finish(self, num_rows):
+        self.write(100, num_rows)
+        self.close()
+
+    def close(self):
+        # the sink can hold a database connection of its own
+        self.sink.close()
+
+    def write(self, progress, num_rows):
+        self.last_time = time.monotonic()
+        self.last_rows = num_rows
+        self.sink.write(self.log, get_stats(progress, num_rows, getattr(self.log, 'started_at', None)))
@@ -0,0 +1,173 @@
+"""
+Streaming readers used by the csv models to iterate uploaded files
+"""
+import codecs
+import io
+import os
+from collections.abc import Mapping
+
+
+class CsvFileReader:
+    """
+    Decode a csv file incrementally.
+
+    The file is never loaded as a whole: lines are decoded on demand
+    from a small buffer, so memory usage does not depend on the size
+    of the file. Progress is computed from the byte offset of the
+    underlying binary stream.
+
+    If fallbacks are given, the file is decoded by a FallbackStream,
+    and encoding is the one which decoded the file in the end.
+    """
+
+    def __init__(self, csvfile, encoding='utf-8', fallbacks=()):
+        self.encodings = [encoding, *fallbacks]
+        self.owns_stream = isinstance(csvfile, str)
+        if self.owns_stream:
+            self.stream = open(csvfile, 'rb')
+        else:
+            self.stream = csvfile
+
+        self.total_bytes = self.get_size()
+        self.decoded = None
+        if fallbacks:
+            self.decoded = FallbackStream(self.stream, self.encodings)
+            buffer, encoding = io.BufferedReader(self.decoded), 'utf-8'
+        else:
+            buffer = self.stream
+        # newline='' is required by the csv module to handle quoted newlines
+        self.text = io.TextIOWrapper(buffer, encoding=encoding, newline='')
+
+    def __iter__(self):
+        return self.text
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def encoding(self):
+        if self.decoded is not None:
+            return self.decoded.encoding
+        return self.encodings[0]
+
+    def get_size(self):
+        try:
+            return os.fstat(self.stream.fileno()).st_size
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            pass
+
+        size = getattr(self.stream, 'size', None)
+        if size is not None:
+            return size
+
+        if self.stream.seekable():
+            position = self.stream.tell()
+            size = self.stream.seek(0, io.SEEK_END)
+            self.stream.seek(position)
+            return size
+
+        return 0
+
+    @property
+    def bytes_read(self):
+        try:
+            return self.stream.tell()
+        except (OSError, ValueError):
+            return 0
+
+    @property
+    def progress(self):
+        if not self.total_bytes:
+            return 0
+        return min(100, round(self.bytes_read * 100 / self.total_bytes))
+
+    def close(self):
+        if self.owns_stream:
+            self.text.close()
+            # a FallbackStream doesn't close the file
+            self.stream.close()
+        else:
+            # don't close a stream that belongs to the caller
+            self.text.detach()
+
+
+class FallbackStream(io.RawIOBase):
+    """
+    Binary stream of the text of stream, encoded as utf-8.
+
+    stream is decoded with the first of encodings. While all the text
+    decoded is ascii, which they all decode alike, bytes which can't be
+    decoded switch to the next encoding instead of failing.
+    """
+
+    def __init__(self, stream, encodings):
+        self.stream = stream
+        self.encodings = list(encodings)
+        self.decoder = codecs.getincrementaldecoder(self.encoding)()
+        self.is_ascii = True
+        self.pending = b''
+
+    @property
+    def encoding(self):
+        return self.encodings[0]
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending:
+            data = self.stream.read(io.DEFAULT_BUFFER_SIZE)
+            self.pending = self.decode(data, final=not data).encode('utf-8')
+            if not data:
+                break
+
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+    def decode(self, data, final):
+        # bytes of an incomplete character, kept by the decoder
+        buffered = self.decoder.getstate()[0]
+        while True:
+            try:
+                text = self.decoder.decode(data, final)
+                break
+            except UnicodeDecodeError:
+                if not self.is_ascii or len(self.encodings) == 1:
+                    raise
+                self.encodings.pop(0)
+                self.decoder = codecs.getincrementaldecoder(self.encoding)()
+                data, buffered = buffered + data, b''
+
+        self.is_ascii = self.is_ascii and text.isascii()
+        return text
+
+
+class RowLine(Mapping):
+    """
+    Read-only dict-like view of a parsed row, which is a plain list,
+    so pre_save and post_save methods can keep using line['column'].
+
+    Like csv.DictReader, missing cells are None.
+    """
+    __slots__ = ('row', 'indexes')
+
+    def __init__(self, row, indexes):
+        self.row = row
+        self.indexes = indexes
+
+    def __getitem__(self, key):
+        index = self.indexes[key]
+        if index < len(self.row):
+            return self.row[index]
+        return None
+
+    def __iter__(self):
+        return iter(self.indexes)
+
+    def __len__(self):
+        return len(self.indexes)
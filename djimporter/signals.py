@@ -0,0 +1,19 @@
+"""
+Signals sent while importing a file.
+
+import_started: sent by a csv model when it starts processing a file,
+    with the importer and log arguments.
+chunk_processed: sent once the rows of a chunk have been validated (and
+    written on chunked mode), with the importer and rows arguments.
+import_finished: sent by run_importer once the log has been updated and
+    the file removed, with the importer (None if it failed to start), log
+    and timings arguments. It's sent with send_robust, so errors raised by
+    receivers are logged (by django.dispatch).
+
+The sender is the csv model class.
+"""
+from django.dispatch import Signal
+
+import_started = Signal()
+chunk_processed = Signal()
+import_finished = Signal()
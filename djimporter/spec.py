@@ -0,0 +1,188 @@
+"""
+Compiled description of a csv model
+"""
+from collections import namedtuple
+from types import MappingProxyType
+
+from django.core.exceptions import FieldDoesNotExist
+
+from .fields import get_prefetch
+
+# How the value of a column is obtained for each row
+FIXED, CONTEXT, DEFAULT, CELL = 'fixed', 'context', 'default', 'cell'
+
+Column = namedtuple('Column', [
+    'csv_fieldname',
+    'model_fieldname',
+    # name used to build the object, it's the attname for fields which return a pk
+    'target',
+    'field',
+    'in_csv',
+    'is_relation',
+    'prefetch',
+])
+
+# index is the position of the column in the rows of the file
+BoundColumn = namedtuple('BoundColumn', ['kind', 'value', 'index'] + list(Column._fields))
+
+
+class ImporterSpec:
+    """
+    Everything a csv model needs to know about its class: fields, mapping,
+    hooks and how to convert each column.
+
+    It is compiled once per class (see CsvModelMetaclass) so neither rows
+    nor views have to introspect the class and its Meta again. It should
+    be treated as immutable.
+    """
+
+    def __init__(self, importer_class):
+        meta = importer_class.Meta
+        self.meta = meta
+        self.db_model = meta.dbModel
+
+        self.fields = MappingProxyType(self.compile_fields(importer_class))
+        self.mapping = MappingProxyType({
+            csv_fieldname: getattr(field, 'match', csv_fieldname)
+            for csv_fieldname, field in self.fields.items()
+        })
+        reverse_mapping = {}
+        for csv_fieldname, model_fieldname in self.mapping.items():
+            reverse_mapping.setdefault(model_fieldname, csv_fieldname)
+        self.reverse_mapping = MappingProxyType(reverse_mapping)
+        self.model_fieldnames = frozenset(self.mapping.values())
+
+        self.extra_fields = tuple(getattr(meta, 'extra_fields', []))
+        self.delimiter = getattr(meta, 'delimiter', ';')
+        self.encoding = getattr(meta, 'encoding', None)
+
+        self.pre_save = tuple(getattr(meta, name) for name in getattr(meta, 'pre_save', []))
+        self.post_save = tuple(getattr(meta, name) for name in getattr(meta, 'post_save', []))
+        self.has_post_save = hasattr(meta, 'post_save')
+        # methods which receive all the rows of a chunk
+        self.pre_save_batch = tuple(getattr(meta, name) for name in getattr(meta, 'pre_save_batch', []))
+        self.post_save_batch = tuple(getattr(meta, name) for name in getattr(meta, 'post_save_batch', []))
+        self.has_save = bool(getattr(meta, 'save', False))
+        # save the rows of a chunk with a single bulk insert on Meta.save mode
+        self.bulk_save = getattr(meta, 'bulk_save', False)
+        self.create_model = getattr(meta, 'create_model', True)
+
+        self.unique_together = getattr(meta, 'unique_together', None)
+        if self.unique_together is not None:
+            self.unique_together = tuple(self.unique_together)
+        self.append_mode = getattr(meta, 'append_mode', False)
+        self.exclude_fields = getattr(meta, 'exclude_fields', None)
+        self.chunk_size = getattr(meta, 'chunk_size', None)
+        self.commit_scope = getattr(meta, 'commit_scope', 'import')
+        self.workers = getattr(meta, 'workers', 1)
+        self.writer = getattr(meta, 'writer', None)
+        self.batch_size = getattr(meta, 'batch_size', None)
+        # measure the time spent converting each field
+        self.field_timings = getattr(meta, 'field_timings', False)
+
+        # 'insert' or 'upsert', which updates the objects with the same conflict_fields
+        self.import_mode = getattr(meta, 'import_mode', 'insert')
+        self.conflict_fields = tuple(getattr(meta, 'conflict_fields', ()))
+        self.update_fields = getattr(meta, 'update_fields', None)
+
+        self.columns = tuple(self.compile_columns())
+        if self.update_fields is None:
+            self.update_fields = self.get_default_update_fields()
+        self.update_fields = tuple(self.update_fields)
+
+    def get_default_update_fields(self):
+        # the fields of the model given by the csv model, but the keys
+        opts = self.db_model._meta
+        fields = []
+        for column in self.columns:
+            name = column.model_fieldname
+            if name in self.conflict_fields or name in fields:
+                continue
+            try:
+                field = opts.get_field(name)
+            except FieldDoesNotExist:
+                continue
+            if field.concrete and not field.primary_key:
+                fields.append(name)
+        return fields
+
+    def compile_fields(self, importer_class):
+        """
+        Only get the names than exist in the field
+        if not exist names enough for build the object
+        when the it try validate the object to do crash
+        """
+        attributes = {}
+        dmodel = {a.name: a for a in self.db_model._meta.get_fields()}
+        # Get all fields than is defined in the class
+        for f in self.meta.fields:
+            if hasattr(importer_class, f):
+                field = getattr(importer_class, f)
+                # inject model on field to be able to access it
+                field.csv_model = self.db_model
+                attributes[f] = field
+            else:
+                attributes[f] = dmodel[f]
+
+        return attributes
+
+    def compile_columns(self):
+        for csv_fieldname, field in self.fields.items():
+            model_fieldname = self.mapping[csv_fieldname]
+            target = model_fieldname
+            if getattr(field, 'pk_only', False):
+                # value is the primary key of the related object
+                try:
+                    target = self.db_model._meta.get_field(model_fieldname).attname
+                except FieldDoesNotExist:
+                    pass
+
+            yield Column(
+                csv_fieldname=csv_fieldname,
+                model_fieldname=model_fieldname,
+                target=target,
+                field=field,
+                in_csv=getattr(field, 'in_csv', True),
+                is_relation=getattr(field, 'is_relation', False),
+                prefetch=get_prefetch(field),
+            )
+
+    def bind(self, context, default_values, indexes=None):
+        """
+        Return the conversion plan of the columns for an import, once
+        the values taken from the context and the defaults (and the
+        position of each column on the file) are known.
+        """
+        indexes = indexes or {}
+        plan = []
+        for column in self.columns:
+            if not column.in_csv:
+                kind, value = FIXED, None
+            elif column.csv_fieldname in context:
+                kind, value = CONTEXT, context[column.csv_fieldname]
+            elif column.csv_fieldname in default_values:
+                kind, value = DEFAULT, default_values[column.csv_fieldname]
+            else:
+                kind, value = CELL, None
+            if kind in (CONTEXT, DEFAULT):
+                # given values are used as they are
+                column = column._replace(target=column.model_fieldname)
+            index = indexes.get(column.csv_fieldname) if kind == CELL else None
+            plan.append(BoundColumn(kind, value, index, *column))
+        return tuple(plan)
+
+    def get_user_visible_fields(self, context=None, extra_fields=None):
+        # extra fields is used to capture the names of the columns used in the pre_save and
+        # post_save methods each csvmodel. Is neccesary define in every Meta of csvmodel one list
+        # of this names if is used in pre_save or post_save
+        # This method get_user_visible_fields is used for validated the header of the file
+        context = context or {}
+        head = list(self.extra_fields if extra_fields is None else extra_fields)
+        for column in self.columns:
+            if not column.in_csv or column.csv_fieldname in context:
+                continue
+            head.append(column.csv_fieldname)
+        return head
+
+    def get_delimiter(self):
+        return self.delimiter
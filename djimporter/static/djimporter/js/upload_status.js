@@ -7,12 +7,20 @@ function getData() {
     let url = $('#js-data').data('importlog-status-url');
         $.ajax({
         url : url,
+        // unchanged status is answered with a 304, without a body
+        ifModified: true,
         dataType: "json",
-        success : function(data) {
-            let status = data['status'];
-            $('#progress_col').html(data['progress']+'%')
-            if (current_status != status)
-                location.reload();
+        success : function(data, textStatus) {
+            if (textStatus != 'notmodified') {
+                let status = data['status'];
+                let progress = data['progress'] + '%';
+                if (status == 'running' && data['eta'] !== null) {
+                    progress += ' (' + data['rows_per_second'] + ' rows/s, ' + data['eta'] + 's left)';
+                }
+                $('#progress_col').html(progress)
+                if (current_status != status)
+                    location.reload();
+            }
             if (current_status == 'created'){
                 setTimeout(getData, 1000);
             } else if (current_status == 'running'){
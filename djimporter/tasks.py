@@ -2,34 +2,48 @@ import json
 import os
 
 from background_task import background
+from django.utils import timezone
 from django.utils.module_loading import import_string
 
-from . import get_importlog_model
+from . import get_importlog_model, profiling, signals
+from .errors import ErrorStore
 
 ImportLog = get_importlog_model()
 
 
 @background(schedule=0)
 def run_importer(csv_model, csv_filepath, log_id, context={}, delimiter=None, headers_mapping=None, warning_mode=False,
-                 default_values=None):
+                 default_values=None, dry_run=False, profile=False):
     """
     csv_model: should be string dotted_path e.g. 'djimporter.FooCsv'
     context: should be serializable
+    dry_run: only validate the file, without importing it
+    profile: run the import with cProfile (see profiling.py)
     """
     importer_class = import_string(csv_model)
     # mark task as running
     log = ImportLog.objects.get(id=log_id)
     log.status = ImportLog.RUNNING
+    log.dry_run = dry_run
     log.save()
+    started_at = timezone.now()
+    profiler = profiling.start() if profiling.should_profile(profile) else None
 
     # run importer
+    importer = None
     try:
         importer = importer_class(
             csv_filepath, context=context, delimiter=delimiter, headers_mapping=headers_mapping, log=log,
-            warning_mode=warning_mode, default_values=default_values
+            warning_mode=warning_mode, default_values=default_values, dry_run=dry_run
         )
         importer.is_valid(log)
         importer.save()
+        # errors are written while importing, write the last ones
+        importer.errors.close()
+        log.error_summary = json.dumps(importer.errors.get_summary())
+        log.num_errors = importer.errors.total
+        log.bytes_processed = importer.bytes_processed
+        log.timings = json.dumps(importer.timings.as_dict())
 
         # update log with import result
         if importer.errors:
@@ -37,23 +51,31 @@ def run_importer(csv_model, csv_filepath, log_id, context={}, delimiter=None, he
                 log.status = ImportLog.PARTIAL_WITH_ERRORS
             else:
                 log.status = ImportLog.FAILED
-
-            log.errors = json.dumps(importer.errors)
         else:
             log.status = ImportLog.COMPLETED
-            log.num_rows = len(importer.list_objs)
+            log.num_rows = importer.num_rows
 
         log.progress = 100
 
 
     except Exception as e:
         # Not controlled errors will be thrown to log
-        errors = [{'line': 1, 'field': 'Internal Error', 'message': e.args}]
+        errors = ErrorStore(log)
+        errors.append({'line': 1, 'field': 'Internal Error', 'message': str(e)})
+        errors.close()
+        log.error_summary = json.dumps(errors.get_summary())
+        log.num_errors = errors.total
         log.status = ImportLog.FAILED
-        log.errors = json.dumps(errors)
         log.progress = 100
 
+    log.duration = timezone.now() - started_at
+    if profiler is not None:
+        profiling.save(log, profiler)
     log.save()
 
     # clean up
     os.remove(csv_filepath)
+
+    # the import has finished, whatever the receivers do (their errors are logged)
+    timings = importer.timings.as_dict() if importer is not None else {}
+    signals.import_finished.send_robust(sender=importer_class, importer=importer, log=log, timings=timings)
@@ -0,0 +1,53 @@
+"""
+Measure the time spent on each phase of an import.
+
+CsvModel.timings adds up the seconds spent by all the rows on:
+
+    encoding: detecting the encoding of the file
+    parse: decoding the file and parsing its rows
+    lookups: resolving the relation fields of each chunk
+    to_python: converting the cells (per field with Meta.field_timings)
+    create: building the objects
+    pre_save: pre_save and pre_save_batch methods
+    clean_fields: validating the objects
+    unique: checking unique constraints
+    write: writing the objects (e.g. bulk_create)
+    save: saving the rows one by one on Meta.save mode
+    post_save: post_save and post_save_batch methods
+
+Rows validated by worker processes (see parallel.py) are measured by the
+workers, so their to_python, create, pre_save and clean_fields times are
+not included.
+"""
+import time
+from contextlib import contextmanager
+
+
+class Timings:
+
+    def __init__(self, per_field=False):
+        self.per_field = per_field
+        self.phases = {}
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+    def lap(self, phase, started):
+        """
+        Add the time since started (a time.perf_counter() value) to
+        phase and return the current time, to start the next one.
+        """
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0) + now - started
+        return now
+
+    @contextmanager
+    def measure(self, phase):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.lap(phase, started)
+
+    def as_dict(self):
+        return {phase: round(seconds, 6) for phase, seconds in self.phases.items()}
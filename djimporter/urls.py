@@ -9,5 +9,7 @@ urlpatterns = [
     path('logs/<int:pk>/', views.ImportDetailView.as_view(), name='importlog-detail'),
     path('logs/<int:pk>/extended', views.ImportDetailExtendedView.as_view(), name='importlog-detail-extended'),
     path('logs/<int:pk>/delete/', views.ImportDeleteView.as_view(), name='importlog-delete'),
-    path('logs/<int:pk>/get/', views.ImportLogGetView.as_view(), name='importlog-get')
+    path('logs/<int:pk>/get/', views.ImportLogGetView.as_view(), name='importlog-get'),
+    path('logs/<int:pk>/events/', views.ImportLogEventsView.as_view(), name='importlog-events'),
+    path('logs/<int:pk>/errors/', views.ImportLogErrorsView.as_view(), name='importlog-errors'),
 ]
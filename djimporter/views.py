@@ -1,14 +1,20 @@
 from django.core.files.storage import default_storage
-from django.http import HttpResponseRedirect, JsonResponse
+from django.core.paginator import Paginator
+from django.db.models import Q
+from django.http import HttpResponseNotModified, HttpResponseRedirect, JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
 from django.urls import reverse
+from django.utils.dateparse import parse_datetime
+from django.utils.http import parse_etags, quote_etag
 from django.views import View
 from django.views.generic.detail import DetailView
 from django.views.generic.edit import DeleteView, FormView
 from django.views.generic.list import ListView
 from urllib.parse import urlencode
 import json
+import time
 
-from . import get_importlog_model
+from . import get_importlog_model, progress
 from .forms import CsvImportForm, UploadDataCsvGuessForm
 from .tasks import run_importer
 
@@ -16,19 +22,67 @@ ImportLog = get_importlog_model()
 
 
 class ListImportsView(ListView):
+    """
+    List the logs by pages, from the newest. Pages are found with the
+    creation date and id of the last log of the previous one (the after
+    parameter), so they cost the same wherever they are. Logs can be
+    filtered by status and user.
+    """
     model = ImportLog
     template_name = "djimporter/importlog_list.html"
     url_detail = 'djimporter:importlog-detail'
     url_delete = 'djimporter:importlog-delete'
+    page_size = 50
+    # columns which can be big and are not listed
+    deferred_fields = ('errors', 'error_summary', 'timings', 'profile_summary')
+
+    def get_queryset(self):
+        queryset = super().get_queryset().defer(*self.deferred_fields).order_by('-created_at', '-pk')
+        for name in ('status', 'user'):
+            value = self.request.GET.get(name)
+            if value:
+                queryset = queryset.filter(**{name: value})
+
+        after = self.parse_cursor(self.request.GET.get('after'))
+        if after is not None:
+            created_at, pk = after
+            queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, pk__lt=pk))
+        return queryset
 
     def get_context_data(self):
-        context = super().get_context_data()
+        # one more log tells if there is a next page
+        logs = list(self.object_list[:self.page_size + 1])
+        context = super().get_context_data(object_list=logs[:self.page_size])
+
+        next_query = None
+        if len(logs) > self.page_size:
+            query = self.request.GET.copy()
+            query['after'] = self.make_cursor(logs[self.page_size - 1])
+            next_query = query.urlencode()
+
         context.update({
             'url_detail': self.url_detail,
             'url_delete': self.url_delete,
+            'next_query': next_query,
         })
         return context
 
+    @staticmethod
+    def make_cursor(log):
+        return '{0}_{1}'.format(log.created_at.isoformat(), log.pk)
+
+    @staticmethod
+    def parse_cursor(cursor):
+        try:
+            created_at, pk = cursor.rsplit('_', 1)
+            created_at = parse_datetime(created_at)
+            pk = int(pk)
+        except (AttributeError, ValueError):
+            return None
+        if created_at is None:
+            return None
+        return created_at, pk
+
 
 class ImportDetailView(DetailView):
     model = ImportLog
@@ -44,16 +98,11 @@ class ImportDetailView(DetailView):
         return context
 
     def prepare_error_summary(self):
-
-        summary_errors = {}
-        for error in self.object.list_errors():
-            if 'message' in error and 'field' in error:
-                unique = '{0}_{1}'.format(error['message'], error['field'])
-                if unique not in summary_errors:
-                    summary_errors[unique] = {'line_count': 0, 'field': error['field'], 'message': error['message']}
-                summary_errors[unique]['line_count'] += 1
-
-        return summary_errors
+        # computed when the import finishes
+        return {
+            '{0}_{1}'.format(error['message'], error['field']): error
+            for error in self.object.list_error_summary()
+        }
 
     def get_status_url(self):
         return reverse("djimporter:importlog-get", args=(self.object.pk,))
@@ -62,7 +111,45 @@ class ImportDetailView(DetailView):
         return reverse(self.url_detail_extended, args=(self.object.pk,))
 
 
-class ImportDetailExtendedView(DetailView):
+class ErrorPageMixin:
+    """
+    Paginate the errors of a log, filtered by the field and
+    message (which contains the given text) GET parameters.
+    """
+    errors_per_page = 100
+    max_errors_per_page = 1000
+
+    def get_errors_page(self, log):
+        field = self.request.GET.get('field')
+        message = self.request.GET.get('message')
+
+        if log.errors:
+            # logs of previous versions kept the errors on the errors field
+            errors = [
+                error for error in log.list_errors()
+                if (not field or error.get('field') == field)
+                and (not message or message.lower() in str(error.get('message', '')).lower())
+            ]
+        else:
+            errors = log.get_errors().filter(line__isnull=False)
+            if field:
+                errors = errors.filter(field=field)
+            if message:
+                errors = errors.filter(message__icontains=message)
+            errors = errors.values('line', 'field', 'message')
+
+        paginator = Paginator(errors, self.get_errors_per_page())
+        return paginator.get_page(self.request.GET.get('page'))
+
+    def get_errors_per_page(self):
+        try:
+            per_page = int(self.request.GET.get('page_size', self.errors_per_page))
+        except ValueError:
+            return self.errors_per_page
+        return max(1, min(per_page, self.max_errors_per_page))
+
+
+class ImportDetailExtendedView(ErrorPageMixin, DetailView):
     model = ImportLog
     template_name = "djimporter/importlog_detail_extended.html"
     url_detail = 'djimporter:importlog-detail'
@@ -71,6 +158,12 @@ class ImportDetailExtendedView(DetailView):
         context = super().get_context_data(**kwargs)
         context["importlog_status_url"] = self.get_status_url()
         context["url_detail"] = self.get_detail_url()
+        context["has_errors"] = bool(self.object.list_error_summary())
+        context["errors_page"] = self.get_errors_page(self.object)
+        # keep the filters on the links to other pages
+        query = self.request.GET.copy()
+        query.pop('page', None)
+        context["errors_query"] = query.urlencode()
 
         return context
 
@@ -82,11 +175,132 @@ class ImportDetailExtendedView(DetailView):
 
 
 class ImportLogGetView(View):
+    """
+    Return the status and progress of a log.
+
+    Responses have an ETag, so requests with a matching If-None-Match
+    get a 304 response. With the wait parameter (seconds, up to max_wait)
+    the response is held until the status or progress change (long poll).
+    While waiting, the log is only read again when it's marked as changed
+    on the cache (see progress.notify), so the wait parameter is ignored
+    unless the cache is shared by the web and the import processes.
+    """
+    # only the fields needed, the errors are not loaded
+    status_fields = ('status', 'progress', 'num_rows', 'started_at')
+    # seconds between checks while waiting for changes
+    poll_interval = 1
+    max_wait = 30
+
+    def get(self, request, *args, **kwargs):
+        data = self.get_status()
+        etag = self.get_etag(data)
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            deadline = time.monotonic() + self.get_wait()
+            data = next(self.watch(data, deadline), None)
+            if data is None:
+                response = HttpResponseNotModified()
+                response['ETag'] = etag
+                return response
+            etag = self.get_etag(data)
+
+        response = JsonResponse(data, safe=False)
+        response['ETag'] = etag
+        return response
+
+    def watch(self, data, deadline):
+        """
+        Yield the status whenever it changes, until the
+        import finishes or deadline (a time.monotonic() value).
+        """
+        etag = self.get_etag(data)
+        changed = progress.last_change(ImportLog, self.kwargs['pk'])
+        while not self.is_finished(data) and time.monotonic() < deadline:
+            time.sleep(self.poll_interval)
+            last_change = progress.last_change(ImportLog, self.kwargs['pk'])
+            if last_change is not None and last_change == changed:
+                # not changed, so don't read the log
+                continue
+            changed = last_change
+            data = self.get_status()
+            if self.get_etag(data) != etag:
+                etag = self.get_etag(data)
+                yield data
+
+    def get_status(self):
+        import_log = get_object_or_404(ImportLog.objects.only(*self.status_fields), pk=self.kwargs['pk'])
+        stats = progress.read(import_log)
+        return {
+            'status': import_log.status,
+            'id': self.kwargs['pk'],
+            'progress': stats['progress'],
+            'num_rows': stats['num_rows'],
+            'rows_per_second': stats['rows_per_second'],
+            'eta': stats['eta'],
+        }
+
+    def get_etag(self, data):
+        return quote_etag('{status}-{progress}-{num_rows}'.format(**data))
+
+    def get_wait(self):
+        if not progress.is_cache_shared():
+            # the log would be read every poll_interval
+            return 0
+        try:
+            wait = float(self.request.GET.get('wait', 0))
+        except ValueError:
+            return 0
+        return max(0, min(wait, self.max_wait))
+
+    def is_finished(self, data):
+        return data['status'] not in (ImportLog.CREATED, ImportLog.RUNNING)
+
+
+class ImportLogEventsView(ImportLogGetView):
+    """
+    Send the status and progress of a log as server-sent events,
+    whenever they change, until the import finishes. The stream is
+    closed after max_stream seconds, and browsers open it again.
+
+    Without a shared cache (see ImportLogGetView) a single event is sent,
+    and browsers open the stream again after retry milliseconds.
+    """
+    max_stream = 300
+    retry = 10000
 
     def get(self, request, *args, **kwargs):
-        import_log = ImportLog.objects.get(pk=self.kwargs['pk'])
-        return JsonResponse({'status': import_log.status, 'id': self.kwargs['pk'], 'progress': import_log.progress},
-                            safe=False)
+        data = self.get_status()
+        response = StreamingHttpResponse(self.stream(data), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        return response
+
+    def stream(self, data):
+        if not progress.is_cache_shared():
+            yield 'retry: %d\n' % self.retry + self.format_event(data)
+            return
+
+        deadline = time.monotonic() + self.max_stream
+        yield self.format_event(data)
+        for data in self.watch(data, deadline):
+            yield self.format_event(data)
+
+    def format_event(self, data):
+        return 'data: %s\n\n' % json.dumps(data)
+
+
+class ImportLogErrorsView(ErrorPageMixin, View):
+    """
+    Return a page of the errors of a log, see ErrorPageMixin.
+    """
+
+    def get(self, request, *args, **kwargs):
+        import_log = get_object_or_404(ImportLog.objects.only('pk', 'errors'), pk=self.kwargs['pk'])
+        page = self.get_errors_page(import_log)
+        return JsonResponse({
+            'count': page.paginator.count,
+            'num_pages': page.paginator.num_pages,
+            'page': page.number,
+            'results': list(page),
+        })
 
 
 class ImportDeleteView(DeleteView):
@@ -103,9 +317,8 @@ class ImportFormView(FormView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        importer_class = self.get_importer_class()
-        importer = importer_class('')
-        context['importer'] = importer
+        # an instance, so overridden get_user_visible_fields and get_delimiter are shown
+        context['importer'] = self.get_importer_class()('')
         return context
 
     def form_valid(self, form):
@@ -136,6 +349,8 @@ class ImportFormView(FormView):
             kwargs['headers_mapping'] = header_mapping
 
         kwargs['warning_mode'] = form.cleaned_data.get('warning_mode', False)
+        kwargs['dry_run'] = form.cleaned_data.get('dry_run', False)
+        kwargs['profile'] = form.cleaned_data.get('profile', False)
 
         default_values = json.loads(
             self.request.POST.get("default_values") or "{}"
@@ -156,6 +371,8 @@ class ImportFormView(FormView):
         headers_mapping = kwargs.get('headers_mapping')
         warning_mode = kwargs.get('warning_mode', False)
         default_values = kwargs.get('default_values', None)
+        dry_run = kwargs.get('dry_run', False)
+        profile = kwargs.get('profile', False)
 
         importer_class = self.get_importer_class()
         task_log = self.create_import_log(csv_file)
@@ -172,7 +389,8 @@ class ImportFormView(FormView):
         context = self.get_importer_context()
         run_importer(dotted_path, csv_path, task_log.id, context=context,
                      delimiter=delimiter, headers_mapping=headers_mapping,
-                     warning_mode=warning_mode, default_values=default_values)
+                     warning_mode=warning_mode, default_values=default_values,
+                     dry_run=dry_run, profile=profile)
 
         return task_log
 
@@ -0,0 +1,403 @@
+"""
+Writers insert the objects built by a csv model in the database.
+
+BulkCreateWriter (the default) uses QuerySet.bulk_create. The other
+writers skip the queryset machinery and load the rows with a single
+statement per batch: ExecuteManyWriter runs a prepared INSERT with
+executemany (e.g. on SQLite) and CopyWriter uses COPY FROM STDIN on
+PostgreSQL. They prepare the values of the fields as bulk_create does,
+but they don't set the primary keys of the inserted objects. When the
+primary keys are needed and bulk inserts don't return them (e.g. on
+MySQL), SaveWriter saves the objects one by one instead.
+
+A writer is chosen by the Meta.writer attribute of the csv model or by
+the vendor of its database. Rows are written in batches as big as the
+database allows (see DatabaseOperations.bulk_batch_size), unless
+Meta.batch_size is given. If it's 'auto', a BatchSizeTuner looks for the
+size which writes faster using the time spent on each batch.
+
+With Meta.import_mode = 'upsert' the writer is wrapped by an UpsertWriter,
+which updates the existing objects instead of inserting them again.
+
+Settings:
+    DJIMPORTER_WRITERS: dict mapping database vendors to writers
+        (classes or dotted paths), e.g. {'postgresql': 'djimporter.writers.CopyWriter'}
+"""
+import datetime
+import io
+import time
+from decimal import Decimal
+from uuid import UUID
+
+from django.conf import settings
+from django.db import connections, router
+from django.db.models import Q
+from django.utils.module_loading import import_string
+
+from .fields import MAX_LOOKUP_PARAMS
+
+
+# Upper bound of the batch sizes when the database doesn't limit them
+MAX_BATCH_SIZE = 10000
+
+# Size of the first batch written with batch_size = 'auto'
+INITIAL_BATCH_SIZE = 100
+
+
+class BatchSizeTuner:
+    """
+    Look for the batch size which spends the least time per row.
+
+    The size is multiplied (or divided) by factor while the time per row
+    improves. When it doesn't, the direction is reversed and the factor
+    reduced, so the size settles around the best one. Batches which take
+    longer than max_latency seconds are always shrunk, to keep
+    transactions and locks short.
+    """
+
+    def __init__(self, initial=INITIAL_BATCH_SIZE, minimum=1, maximum=MAX_BATCH_SIZE,
+                 factor=2.0, max_latency=1.0):
+        self.size = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.factor = factor
+        self.max_latency = max_latency
+        self.direction = 1
+        self.last_rate = None
+
+    def record(self, size, seconds):
+        rate = seconds / size
+        if self.last_rate is not None and rate >= self.last_rate * 0.95:
+            # no improvement, go back with smaller steps
+            self.direction = -self.direction
+            self.factor = max(1.1, self.factor ** 0.5)
+        if seconds > self.max_latency:
+            self.direction = -1
+        self.last_rate = rate
+
+        size = round(size * self.factor ** self.direction)
+        self.size = max(self.minimum, min(self.maximum, size))
+        return self.size
+
+
+class BulkCreateWriter:
+    # primary keys are set on the objects when the backend can return them
+    returns_pks = True
+    # None means the limit of the database
+    max_batch_size = None
+
+    def __init__(self, model, using=None, batch_size=None):
+        self.model = model
+        self.using = using or router.db_for_write(model)
+        self.connection = connections[self.using]
+        self.batch_size = batch_size
+        self.tuner = BatchSizeTuner() if batch_size == 'auto' else None
+
+    @classmethod
+    def supports(cls, model, connection):
+        return True
+
+    def get_max_batch_size(self, objs):
+        if self.max_batch_size is not None:
+            return self.max_batch_size
+        fields = self.model._meta.concrete_fields
+        # PostgreSQL and MySQL don't limit them, and would build a single
+        # statement for all the objects (beyond max_allowed_packet on MySQL)
+        size = min(self.connection.ops.bulk_batch_size(fields, objs), MAX_BATCH_SIZE)
+        return max(size, 1)
+
+    def get_batch_size(self, objs):
+        maximum = self.get_max_batch_size(objs)
+        if self.tuner is not None:
+            return min(self.tuner.size, maximum)
+        if self.batch_size:
+            return min(self.batch_size, maximum)
+        return maximum
+
+    def write(self, objs):
+        position = 0
+        while position < len(objs):
+            size = self.get_batch_size(objs)
+            batch = objs[position:position + size]
+            started = time.perf_counter()
+            self.write_batch(batch)
+            if self.tuner is not None:
+                self.tuner.record(len(batch), time.perf_counter() - started)
+            position += size
+
+    def write_batch(self, objs):
+        self.model._default_manager.using(self.using).bulk_create(objs, batch_size=len(objs))
+
+
+class SaveWriter(BulkCreateWriter):
+    """
+    Save the objects one by one, so they get their primary keys on
+    databases which don't return them from bulk inserts.
+    """
+
+    def get_max_batch_size(self, objs):
+        return MAX_BATCH_SIZE
+
+    def write_batch(self, objs):
+        for obj in objs:
+            obj.save(force_insert=True, using=self.using)
+
+
+class RawInsertWriter(BulkCreateWriter):
+    """
+    Base of the writers which build their own insert statements.
+    """
+    returns_pks = False
+    # rows aren't limited by the number of query parameters,
+    # but a batch is kept in memory while it's sent
+    max_batch_size = MAX_BATCH_SIZE
+    vendor = None
+
+    @classmethod
+    def supports(cls, model, connection):
+        opts = model._meta
+        if cls.vendor is not None and connection.vendor != cls.vendor:
+            return False
+        # multi-table inheritance writes on several tables, and
+        # some fields (e.g. geometries) need their own placeholders
+        if opts.parents:
+            return False
+        return not any(hasattr(field, 'get_placeholder') for field in opts.concrete_fields)
+
+    def write_batch(self, objs):
+        for fields, group in self.group_objs(objs):
+            try:
+                rows = [self.get_values(obj, fields) for obj in group]
+                self.insert(fields, rows)
+            except TypeError:
+                # values this writer can't send
+                BulkCreateWriter(self.model, self.using).write(group)
+                continue
+
+            for obj in group:
+                obj._state.adding = False
+                obj._state.db = self.using
+
+    def group_objs(self, objs):
+        """
+        Split objs by the fields to insert: the auto field
+        is only written if the primary key is given.
+        """
+        opts = self.model._meta
+        with_pk, without_pk = [], []
+        for obj in objs:
+            if obj.pk is None:
+                obj.pk = opts.pk.get_pk_value_on_save(obj)
+            (with_pk if obj.pk is not None else without_pk).append(obj)
+
+        fields = list(opts.concrete_fields)
+        if with_pk:
+            yield fields, with_pk
+        if without_pk:
+            yield [f for f in fields if f is not opts.auto_field], without_pk
+
+    def get_values(self, obj, fields):
+        # same conversions used by bulk_create
+        return [
+            field.get_db_prep_save(field.pre_save(obj, True), connection=self.connection)
+            for field in fields
+        ]
+
+    def insert(self, fields, rows):
+        raise NotImplementedError
+
+
+class ExecuteManyWriter(RawInsertWriter):
+    """
+    Run a prepared INSERT of a single row for all the rows of a batch.
+    """
+
+    def insert(self, fields, rows):
+        quote_name = self.connection.ops.quote_name
+        sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+            quote_name(self.model._meta.db_table),
+            ', '.join(quote_name(field.column) for field in fields),
+            ', '.join(['%s'] * len(fields)),
+        )
+        with self.connection.cursor() as cursor:
+            cursor.executemany(sql, rows)
+
+
+class CopyWriter(RawInsertWriter):
+    """
+    Load the rows of a batch with COPY FROM STDIN (PostgreSQL and psycopg2).
+    """
+    vendor = 'postgresql'
+
+    def insert(self, fields, rows):
+        data = self.format_rows(rows)
+        quote_name = self.connection.ops.quote_name
+        sql = 'COPY %s (%s) FROM STDIN WITH (FORMAT csv)' % (
+            quote_name(self.model._meta.db_table),
+            ', '.join(quote_name(field.column) for field in fields),
+        )
+        with self.connection.cursor() as cursor:
+            cursor.copy_expert(sql, io.StringIO(data))
+
+    @classmethod
+    def format_rows(cls, rows):
+        return ''.join(','.join(cls.format_value(value) for value in row) + '\n' for row in rows)
+
+    @staticmethod
+    def format_value(value):
+        # nulls are unquoted empty values, so every other value is quoted
+        if value is None:
+            return ''
+        if isinstance(value, bool):
+            text = 't' if value else 'f'
+        elif isinstance(value, (datetime.date, datetime.time)):
+            text = value.isoformat()
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            text = '\\x' + bytes(value).hex()
+        elif isinstance(value, (str, int, float, Decimal, UUID)):
+            text = str(value)
+        else:
+            raise TypeError("COPY can't send values of type %s" % type(value).__name__)
+        return '"%s"' % text.replace('"', '""')
+
+
+class UpsertWriter:
+    """
+    Insert the new objects and update the existing ones, matched by the
+    values of conflict_fields.
+
+    Objects are matched in batches against the database, and only the
+    ones whose update_fields have changed are updated, with bulk_update.
+    When the database supports it (Django >= 4.1) new and changed objects
+    are written together with bulk_create(update_conflicts=True), so rows
+    inserted meanwhile by others don't raise IntegrityErrors. Objects
+    repeated on objs are written once, with the values of the last one.
+    """
+
+    def __init__(self, writer, conflict_fields, update_fields, needs_pks=False):
+        self.writer = writer
+        self.model = writer.model
+        self.using = writer.using
+        self.connection = writer.connection
+
+        opts = self.model._meta
+        self.conflict_fields = [opts.get_field(name) for name in conflict_fields]
+        self.update_fields = [opts.get_field(name) for name in update_fields]
+        self.native = (
+            getattr(self.connection.features, 'supports_update_conflicts_with_target', False)
+            and not needs_pks
+        )
+
+    def get_key(self, obj):
+        return tuple(
+            field.to_python(getattr(obj, field.attname)) for field in self.conflict_fields
+        )
+
+    def write(self, objs):
+        # the last object of each key wins
+        unique_objs = {}
+        for obj in objs:
+            unique_objs[self.get_key(obj)] = obj
+        objs = list(unique_objs.values())
+
+        batch_size = max(1, MAX_LOOKUP_PARAMS // len(self.conflict_fields))
+        for position in range(0, len(objs), batch_size):
+            self.write_batch(objs[position:position + batch_size])
+
+    def write_batch(self, objs):
+        existing = self.get_existing(objs)
+        new_objs, changed_objs = [], []
+        for obj in objs:
+            current = existing.get(self.get_key(obj))
+            if current is None:
+                new_objs.append(obj)
+            elif self.has_changed(obj, current[1:]):
+                obj.pk = current[0]
+                changed_objs.append(obj)
+            else:
+                # unchanged objects aren't written again
+                obj.pk = current[0]
+                obj._state.adding = False
+                obj._state.db = self.using
+
+        if self.native:
+            objs = new_objs + changed_objs
+            for obj in changed_objs:
+                # the conflict target decides which row is updated
+                obj.pk = None
+            if objs:
+                self.model._default_manager.using(self.using).bulk_create(
+                    objs,
+                    update_conflicts=True,
+                    unique_fields=[field.name for field in self.conflict_fields],
+                    update_fields=[field.name for field in self.update_fields],
+                )
+            return
+
+        if new_objs:
+            self.writer.write(new_objs)
+        if changed_objs:
+            self.model._default_manager.using(self.using).bulk_update(
+                changed_objs, [field.name for field in self.update_fields]
+            )
+
+    def get_existing(self, objs):
+        """
+        Return the primary key and the update_fields
+        of the existing objects, by key.
+        """
+        keys = {self.get_key(obj) for obj in objs}
+        attnames = [field.attname for field in self.conflict_fields]
+        if len(attnames) == 1:
+            lookup = Q(**{attnames[0] + '__in': [key[0] for key in keys]})
+        else:
+            lookup = Q()
+            for key in keys:
+                lookup |= Q(**dict(zip(attnames, key)))
+
+        values = self.model._default_manager.using(self.using).filter(lookup).values_list(
+            *attnames, 'pk', *[field.attname for field in self.update_fields]
+        )
+        size = len(attnames)
+        return {
+            tuple(field.to_python(value) for field, value in zip(self.conflict_fields, row)): row[size:]
+            for row in values
+        }
+
+    def has_changed(self, obj, values):
+        return any(
+            field.to_python(getattr(obj, field.attname)) != field.to_python(value)
+            for field, value in zip(self.update_fields, values)
+        )
+
+
+def get_writer_class(model, using, writer=None, needs_pks=False):
+    """
+    Return the writer given (or the one configured for the vendor of
+    the database) if it can write model, or BulkCreateWriter.
+    """
+    connection = connections[using]
+    if writer is None:
+        writer = getattr(settings, 'DJIMPORTER_WRITERS', {}).get(connection.vendor)
+    if isinstance(writer, str):
+        writer = import_string(writer)
+
+    if needs_pks and not connection.features.can_return_rows_from_bulk_insert:
+        return SaveWriter
+    if writer is None or not writer.supports(model, connection):
+        return BulkCreateWriter
+    if needs_pks and not writer.returns_pks:
+        return BulkCreateWriter
+    return writer
+
+
+def get_writer(model, writer=None, needs_pks=False, batch_size=None, upsert=None):
+    """
+    upsert is a (conflict_fields, update_fields) tuple to update existing objects.
+    """
+    using = router.db_for_write(model)
+    writer_class = get_writer_class(model, using, writer, needs_pks)
+    writer = writer_class(model, using, batch_size=batch_size)
+    if upsert is not None:
+        writer = UpsertWriter(writer, *upsert, needs_pks=needs_pks)
+    return writer
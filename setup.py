@@ -25,7 +25,8 @@ setup(
     license='BSD-3-Clause',
     packages=find_packages(),
     include_package_data=True,
-    install_requires=["django>=2.2,<4.1", "django4-background-tasks>=1.2.9", "python-magic>=0.4.27"],
+    install_requires=["django>=2.2,<4.1", "asgiref>=3.2", "django4-background-tasks>=1.2.9"],
+    extras_require={"magic": ["python-magic>=0.4.27"]},
     zip_safe=False,
     classifiers=[
         'Development Status :: 4 - Beta',
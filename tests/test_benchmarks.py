@@ -0,0 +1,40 @@
+"""
+Check the csv generator and the comparison of results of the benchmarks
+"""
+import csv
+import os
+import tempfile
+
+from django.test import SimpleTestCase
+
+from benchmarks import generate, run
+
+
+class GenerateTest(SimpleTestCase):
+    def test_generate(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'albums.csv')
+            generate.generate(path, 'albums', 100, invalid=0.5, seed=1)
+            with open(path, newline='') as csv_file:
+                rows = list(csv.reader(csv_file, delimiter=';'))
+
+        self.assertEqual(['name', 'artist', 'release_date', 'num_stars'], rows[0])
+        self.assertEqual(101, len(rows))
+        invalid = [
+            row for row in rows[1:]
+            if row[1].startswith('unknown') or row[2] == 'not a date' or row[3] == 'many'
+        ]
+        self.assertTrue(20 < len(invalid) < 80)
+
+    def test_compare(self):
+        baseline = {'results': [
+            {'scenario': 'chunked', 'rows': 1000, 'rows_per_second': 1000},
+            {'scenario': 'chunked', 'rows': 10000, 'rows_per_second': 1000},
+        ]}
+        results = [
+            {'scenario': 'chunked', 'rows': 1000, 'rows_per_second': 950},
+            {'scenario': 'chunked', 'rows': 10000, 'rows_per_second': 800},
+            {'scenario': 'append_mode', 'rows': 1000, 'rows_per_second': 10},
+        ]
+        regressions = run.compare(results, baseline, threshold=0.1)
+        self.assertEqual([(10000, -0.2)], [(r['rows'], r['change']) for r in regressions])
@@ -4,12 +4,23 @@ serializers based on a given model class.
 These tests deal with ensuring that we correctly map the model fields onto
 an appropriate set of serializer fields for each case.
 """
+import asyncio
+import datetime
+import io
 import os
+import tempfile
+from unittest import mock
 
+from asgiref.sync import sync_to_async
 from django.core.exceptions import ValidationError
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 
-from djimporter import fields, importers
+from djimporter import cache as lookup_cache
+from djimporter import encoding, fields, importers, parallel, signals, writers
+from djimporter.errors import ErrorStore
+from djimporter.models import ImportLog, ImportLogError
 
 from .models import Album, ForeignKeySource, ForeignKeyTarget, Musician, Song
 
@@ -17,6 +28,46 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 TESTDATA_DIR = os.path.join(BASE_DIR, 'data/')
 
+ALBUM_HEADER = "name;artist;release_date;num_stars\n"
+
+
+def get_csv_model(db_model, model_fields, attrs=None, **meta):
+    """
+    Return a new csv model of db_model, with meta as attributes of its Meta class.
+    """
+    meta_class = type('Meta', (), dict(meta, dbModel=db_model, fields=model_fields))
+    name = db_model.__name__ + 'Csv'
+    return importers.CsvModelMetaclass(name, (importers.CsvModel,), dict(attrs or {}, Meta=meta_class))
+
+
+def get_album_csv(**meta):
+    artist = fields.SlugRelatedField(slug_field="name", queryset=Musician.objects.all())
+    model_fields = meta.pop('fields', ['name', 'release_date', 'num_stars', 'artist'])
+    return get_csv_model(Album, model_fields, {'artist': artist}, delimiter=';', **meta)
+
+
+def get_album_file(*artists):
+    """
+    Return a csv file with an album of each artist.
+    """
+    rows = ''.join("a{0};{1};2000-01-01;5\n".format(i, artist) for i, artist in enumerate(artists))
+    return io.BytesIO((ALBUM_HEADER + rows).encode('utf-8'))
+
+
+class AlbumImportTestCase(TestCase):
+    """
+    Imports of albums of the artist "Susan Schmith". The Meta class of the
+    csv models has the attributes given by meta.
+    """
+    meta = {}
+
+    def setUp(self):
+        Musician.objects.create(name="Susan Schmith", instrument="guitar")
+        self.importer_class = self.get_importer_class()
+
+    def get_importer_class(self, **meta):
+        return get_album_csv(**dict(self.meta, **meta))
+
 
 class SlugFieldMapping(TestCase):
     def test_valid(self):
@@ -38,6 +89,74 @@ class SlugFieldMapping(TestCase):
 
         self.assertTrue(importer.is_valid())
 
+    def test_lookups_in_bulk(self):
+        Musician.objects.bulk_create([
+            Musician(name="Susan Schmith", instrument="guitar"),
+            Musician(name="Johan Wolf", instrument="piano"),
+        ])
+
+        class AlbumCsv(importers.CsvModel):
+            artist = fields.SlugRelatedField(slug_field="name", queryset=Musician.objects.all())
+
+            class Meta:
+                delimiter = ';'
+                dbModel = Album
+                fields = ['name', 'release_date', 'num_stars', 'artist']
+
+        rows = ''.join(
+            "a{0};{1};2000-01-01;5\n".format(i, artist)
+            for i, artist in enumerate(["Susan Schmith", "Johan Wolf", "Lola"] * 10)
+        )
+        content = "name;artist;release_date;num_stars\n" + rows
+        importer = AlbumCsv(io.BytesIO(content.encode('utf-8')))
+
+        # one query for the whole chunk, plus a get() for each missing value
+        with self.assertNumQueries(11):
+            self.assertFalse(importer.is_valid())
+        self.assertEqual(10, len(importer.errors))
+        self.assertEqual("No match found for Musician with value Lola", importer.errors[0]['message'])
+
+    def test_overridden_lookups(self):
+        Musician.objects.create(name="Susan Schmith", instrument="guitar")
+
+        class UpperSlugField(fields.SlugRelatedField):
+            def to_python(self, value):
+                return super().to_python(value.title())
+
+        class LowerSlugField(fields.SlugRelatedField):
+            def get(self, value):
+                return self.get_queryset().get(name__iexact=value.strip())
+
+        for field_class in (UpperSlugField, LowerSlugField):
+            class AlbumCsv(importers.CsvModel):
+                artist = field_class(slug_field="name", queryset=Musician.objects.all())
+
+                class Meta:
+                    dbModel = Album
+                    fields = ['name', 'release_date', 'num_stars', 'artist']
+
+            # values aren't resolved in bulk, which would skip the overridden methods
+            self.assertIsNone(AlbumCsv.spec.columns[-1].prefetch)
+            content = "name;artist;release_date;num_stars\naaa;susan schmith;2000-01-01;5\n"
+            importer = AlbumCsv(io.BytesIO(content.encode('utf-8')))
+            self.assertTrue(importer.is_valid(), importer.errors)
+
+    def test_lookup_names(self):
+        Musician.objects.create(name="Susan Schmith", instrument="guitar")
+
+        class AlbumCsv(importers.CsvModel):
+            artist = fields.SlugRelatedField(slug_field="name__iexact", queryset=Musician.objects.all())
+
+            class Meta:
+                dbModel = Album
+                fields = ['name', 'release_date', 'num_stars', 'artist']
+
+        # slugs which end in a lookup can't be looked up in bulk
+        content = "name;artist;release_date;num_stars\naaa;susan schmith;2000-01-01;5\n"
+        importer = AlbumCsv(io.BytesIO(content.encode('utf-8')))
+        self.assertTrue(importer.is_valid(), importer.errors)
+        self.assertEqual("Susan Schmith", importer.list_objs[0].object.artist.name)
+
     def test_missing_slug_related(self):
         class ForeignKeySourceCsv(importers.CsvModel):
             target = fields.SlugRelatedField(
@@ -77,6 +196,9 @@ class NullableSlugFieldTest(TestCase):
 
 
 class CachedSlugFieldTest(TestCase):
+    def setUp(self):
+        lookup_cache.clear()
+
     def test_valid(self):
         ForeignKeyTarget.objects.bulk_create([
             ForeignKeyTarget(name='bar'),
@@ -96,6 +218,96 @@ class CachedSlugFieldTest(TestCase):
 
         self.assertTrue(importer.is_valid(), importer.errors)
 
+    def test_pk_only(self):
+        target = ForeignKeyTarget.objects.create(name='bar')
+        ForeignKeyTarget.objects.create(name='bar2')
+
+        class ForeignKeySourceCsv(importers.CsvModel):
+            target = fields.CachedSlugRelatedField(
+                queryset=ForeignKeyTarget.objects.all(), slug_field='name', pk_only=True)
+
+            class Meta:
+                dbModel = ForeignKeySource
+                fields = ('name', 'target')
+
+        csv_path = os.path.join(TESTDATA_DIR, 'ForeignKeySource_valid.csv')
+        importer = ForeignKeySourceCsv(csv_path)
+
+        # a single query loads the cache, rows don't query their targets
+        with self.assertNumQueries(1):
+            self.assertTrue(importer.is_valid(), importer.errors)
+        importer.save()
+        self.assertEqual(target.pk, ForeignKeySource.objects.get(name='foo').target_id)
+
+    def test_shared_between_imports(self):
+        ForeignKeyTarget.objects.create(name='bar')
+
+        class ForeignKeySourceCsv(importers.CsvModel):
+            target = fields.CachedSlugRelatedField(
+                queryset=ForeignKeyTarget.objects.all(), slug_field='name', pk_only=True)
+
+            class Meta:
+                dbModel = ForeignKeySource
+                fields = ('name', 'target')
+
+        csv_path = os.path.join(TESTDATA_DIR, 'ForeignKeySource_valid.csv')
+        self.assertFalse(ForeignKeySourceCsv(csv_path).is_valid())
+
+        # lookup is invalidated when the referenced model changes
+        ForeignKeyTarget.objects.create(name='bar2')
+        with self.assertNumQueries(1):
+            self.assertTrue(ForeignKeySourceCsv(csv_path).is_valid())
+
+        # following imports don't query the table again
+        with self.assertNumQueries(0):
+            self.assertTrue(ForeignKeySourceCsv(csv_path).is_valid())
+
+    def test_invalidated_by_imports(self):
+        ForeignKeyTarget.objects.create(name='bar')
+
+        class ForeignKeyTargetCsv(importers.CsvModel):
+            class Meta:
+                dbModel = ForeignKeyTarget
+                fields = ('name',)
+
+        class ForeignKeySourceCsv(importers.CsvModel):
+            target = fields.CachedSlugRelatedField(
+                queryset=ForeignKeyTarget.objects.all(), slug_field='name', pk_only=True)
+
+            class Meta:
+                dbModel = ForeignKeySource
+                fields = ('name', 'target')
+
+        csv_path = os.path.join(TESTDATA_DIR, 'ForeignKeySource_valid.csv')
+        self.assertFalse(ForeignKeySourceCsv(csv_path).is_valid())
+
+        # bulk writes don't send post_save, the importer drops the lookup
+        importer = ForeignKeyTargetCsv(io.BytesIO(b"name\nbar2\n"))
+        self.assertTrue(importer.is_valid(), importer.errors)
+        importer.save()
+        self.assertTrue(ForeignKeySourceCsv(csv_path).is_valid())
+
+    def test_lookup_checked_per_chunk(self):
+        ForeignKeyTarget.objects.create(name='bar')
+
+        class ForeignKeySourceCsv(importers.CsvModel):
+            target = fields.CachedSlugRelatedField(
+                queryset=ForeignKeyTarget.objects.all(), slug_field='name', pk_only=True)
+
+            class Meta:
+                dbModel = ForeignKeySource
+                fields = ('name', 'target')
+
+        content = "name;target\n" + "foo; bar \nboo;baz\n" * 5
+        importer = ForeignKeySourceCsv(io.BytesIO(content.encode('utf-8')))
+        with mock.patch.object(lookup_cache, 'get_lookup_key', wraps=lookup_cache.get_lookup_key) as get_key, \
+                mock.patch.object(lookup_cache, 'get_version', wraps=lookup_cache.get_version) as get_version:
+            self.assertFalse(importer.is_valid())
+        # cells with spaces and missing values don't look the lookup up again
+        self.assertEqual(1, get_key.call_count)
+        self.assertEqual(1, get_version.call_count)
+        self.assertEqual([3, 5, 7, 9, 11], [e['line'] for e in importer.errors])
+
     def test_invalid_missing_required_target_value(self):
         ForeignKeyTarget.objects.create(name='bar')
 
@@ -158,3 +370,820 @@ class WarningModeTest(TestCase):
         # as importer is run on warning_mode valid objects will be saved on database
         importer.save()
         self.assertEqual(1, Album.objects.count())
+
+
+class StreamingReaderTest(AlbumImportTestCase):
+    def test_file_object_is_not_closed(self):
+        csv_file = get_album_file("Susan Schmith")
+        importer = self.importer_class(csv_file)
+
+        self.assertTrue(importer.is_valid(), importer.errors)
+        self.assertFalse(csv_file.closed)
+
+    def test_quoted_newline(self):
+        content = 'name;artist;release_date;num_stars\n"a\nb";Susan Schmith;2000-01-01;5\n'
+        importer = self.importer_class(io.BytesIO(content.encode('utf-8')))
+
+        self.assertTrue(importer.is_valid(), importer.errors)
+        importer.save()
+        self.assertEqual("a\nb", Album.objects.get().name)
+
+    def test_progress(self):
+        log = ImportLog.objects.create(status=ImportLog.RUNNING, user="user1", input_file="albums.csv")
+        importer = self.importer_class(get_album_file(*["Susan Schmith"] * 100))
+
+        self.assertTrue(importer.is_valid(log), importer.errors)
+        log.refresh_from_db()
+        self.assertEqual(100, log.progress)
+        self.assertEqual(100, log.num_rows)
+
+
+class ChunkedModeTest(AlbumImportTestCase):
+    meta = {'chunk_size': 2}
+
+    def test_valid(self):
+        importer = self.importer_class(get_album_file(*["Susan Schmith"] * 5))
+
+        self.assertTrue(importer.is_valid(), importer.errors)
+        # rows are written while validating and released afterwards
+        self.assertEqual(5, Album.objects.count())
+        self.assertEqual(5, importer.num_rows)
+        self.assertEqual([], importer.list_objs)
+        importer.save()
+        self.assertEqual(5, Album.objects.count())
+
+    def test_error_rolls_back_written_chunks(self):
+        importer = self.importer_class(get_album_file(*["Susan Schmith"] * 4 + ["Johan Wolf"]))
+
+        self.assertFalse(importer.is_valid())
+        self.assertEqual(1, len(importer.errors))
+        self.assertEqual(6, importer.errors[0]['line'])
+        self.assertEqual(0, Album.objects.count())
+
+    def test_warning_mode(self):
+        importer = self.importer_class(
+            get_album_file("Susan Schmith", "Johan Wolf", "Susan Schmith"), warning_mode=True)
+
+        self.assertFalse(importer.is_valid())
+        self.assertEqual(1, len(importer.errors))
+        self.assertEqual(2, Album.objects.count())
+
+    def test_unique_together_across_chunks(self):
+        importer_class = self.get_importer_class(unique_together=['artist'])
+        importer = importer_class(get_album_file(*["Susan Schmith"] * 3))
+
+        self.assertFalse(importer.is_valid())
+        self.assertEqual([3, 4], [error['line'] for error in importer.errors])
+        self.assertEqual(0, Album.objects.count())
+
+
+class CommitScopeTest(AlbumImportTestCase):
+    meta = {'chunk_size': 2}
+
+    def get_importer(self, artists, warning_mode=False, **meta):
+        return self.get_importer_class(**meta)(get_album_file(*artists), warning_mode=warning_mode)
+
+    def test_save_rolled_back(self):
+        # rows saved one by one are rolled back instead of deleted
+        importer = self.get_importer(["Susan Schmith", "Susan Schmith", "Johan Wolf"], save=True, chunk_size=None)
+
+        self.assertFalse(importer.is_valid())
+        self.assertEqual(0, Album.objects.count())
+
+    def test_chunk_scope(self):
+        artists = ["Susan Schmith", "Susan Schmith", "Susan Schmith", "Johan Wolf"]
+        importer = self.get_importer(artists, commit_scope='chunk')
+
+        self.assertFalse(importer.is_valid())
+        # the first chunk has been committed, the second has errors
+        self.assertEqual(['a0', 'a1'], list(Album.objects.order_by('name').values_list('name', flat=True)))
+
+    def test_failed_chunk_warning_mode(self):
+        def check_name(cls, row):
+            if row.object.name == 'a3':
+                raise ValueError("invalid name")
+
+        importer = self.get_importer(
+            ["Susan Schmith"] * 5, warning_mode=True, commit_scope='chunk', save=True, bulk_save=True,
+            post_save=['check_name'], check_name=classmethod(check_name),
+        )
+
+        self.assertFalse(importer.is_valid())
+        # the chunk with lines 4 and 5 has been rolled back
+        self.assertEqual(
+            ['a0', 'a1', 'a4'], list(Album.objects.order_by('name').values_list('name', flat=True))
+        )
+        self.assertEqual([4, 5], [e['line'] for e in importer.errors])
+
+    def test_save_chunk_scope(self):
+        importer = self.get_importer(["Susan Schmith"] * 5, commit_scope='chunk', chunk_size=None)
+
+        self.assertTrue(importer.is_valid(), importer.errors)
+        with mock.patch.object(importer, 'get_chunk_size', return_value=2):
+            # a transaction (savepoint on tests) per chunk of rows
+            with self.assertNumQueries(3 * 5):
+                importer.save()
+        self.assertEqual(5, Album.objects.count())
+
+
+def add_song(cls, row):
+    Song.objects.create(name=row.object.name, album=row.object)
+
+
+class DryRunTest(AlbumImportTestCase):
+    meta = {'unique_together': ['name'], 'post_save': ['add_song'], 'add_song': classmethod(add_song)}
+
+    def get_file(self, *names):
+        rows = ''.join("{0};Susan Schmith;2000-01-01;5\n".format(name) for name in names)
+        content = ALBUM_HEADER + "bad;Johan Wolf;2000-01-01;5\n" + rows
+        return io.BytesIO(content.encode('utf-8'))
+
+    def assert_dry_run(self, **meta):
+        importer_class = self.get_importer_class(**meta)
+        importer = importer_class(self.get_file("a", "b", "a"), dry_run=True)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertFalse(importer.is_valid())
+            importer.save()
+        # only lookups, inside a savepoint which is rolled back
+        statements = ('SELECT', 'SAVEPOINT', 'ROLLBACK TO SAVEPOINT', 'RELEASE SAVEPOINT')
+        self.assertTrue(all(q['sql'].startswith(statements) for q in queries.captured_queries))
+        self.assertEqual([2, 5], [e['line'] for e in importer.errors])
+        self.assertEqual(0, Album.objects.count())
+        self.assertEqual(0, Song.objects.count())
+
+    def test_dry_run(self):
+        self.assert_dry_run()
+
+    def test_save(self):
+        self.assert_dry_run(save=True)
+
+    def test_chunked(self):
+        self.assert_dry_run(chunk_size=2)
+
+    def test_pre_save_writes(self):
+        def add_artist(cls, row):
+            row.object.artist = Musician.objects.create(name=row.object.name, instrument="piano")
+
+        importer_class = self.get_importer_class(
+            fields=['name', 'release_date', 'num_stars'], pre_save=['add_artist'], add_artist=classmethod(add_artist),
+        )
+        importer = importer_class(get_album_file("Lola"), dry_run=True)
+
+        self.assertTrue(importer.is_valid(), importer.errors)
+        # what pre_save methods write is rolled back
+        self.assertEqual(["Susan Schmith"], list(Musician.objects.values_list('name', flat=True)))
+
+    def test_duplicated_in_file(self):
+        content = b"name;instrument\na;guitar\nb;piano\na;drums\n"
+        for chunk_size in (None, 1):
+            # the same keys make the import fail with an IntegrityError
+            MusicianCsv = get_csv_model(Musician, ['name', 'instrument'], chunk_size=chunk_size)
+            importer = MusicianCsv(io.BytesIO(content), dry_run=True)
+
+            self.assertFalse(importer.is_valid())
+            self.assertEqual([(4, 'name')], [(e['line'], e['field']) for e in importer.errors])
+
+    def test_valid(self):
+        importer = self.importer_class(get_album_file("Susan Schmith"), dry_run=True)
+
+        self.assertTrue(importer.is_valid(), importer.errors)
+        self.assertEqual(1, importer.num_rows)
+        importer.save()
+        self.assertEqual(0, Album.objects.count())
+
+
+class ParallelModeTest(AlbumImportTestCase):
+    meta = {'chunk_size': 7}
+
+    def setUp(self):
+        super().setUp()
+
+        rows = []
+        for i in range(60):
+            artist = "Johan Wolf" if i % 9 == 0 else "Susan Schmith"
+            num_stars = "x" if i % 13 == 0 else "5"
+            # quoted line breaks can't be used to split the file
+            name = '"a{0}\n;b"'.format(i) if i % 5 == 0 else "a{0}".format(i)
+            rows.append("{0};{1};2000-01-01;{2}\n".format(name, artist, num_stars))
+            if i % 11 == 0:
+                rows.append("\n")
+        content = ALBUM_HEADER + ''.join(rows)
+
+        with tempfile.NamedTemporaryFile('wb', suffix='.csv', delete=False) as csv_file:
+            csv_file.write(content.encode('utf-8'))
+        self.path = csv_file.name
+        self.addCleanup(os.remove, self.path)
+
+    def get_importer(self, workers, **kwargs):
+        return self.get_importer_class(workers=workers)(self.path, **kwargs)
+
+    def test_split_ranges(self):
+        ranges = parallel.split_ranges(self.path, 0, range_size=100)
+
+        self.assertGreater(len(ranges), 1)
+        with open(self.path, 'rb') as csv_file:
+            content = csv_file.read()
+        self.assertEqual(len(content), ranges[-1][1])
+        for start, end in ranges:
+            # no range ends inside a quoted field
+            self.assertEqual(0, content[:end].count(b'"') % 2)
+
+    def test_bounded_ranges(self):
+        sent = []
+
+        class Pool:
+            def apply_async(self, func, args):
+                sent.append(args[0])
+                return mock.Mock(get=lambda: func(*args))
+
+        results = parallel.imap_bounded(Pool(), str, range(10), 3)
+        self.assertEqual('0', next(results))
+        # a range is sent when one is consumed
+        self.assertEqual([0, 1, 2, 3], sent)
+        self.assertEqual([str(i) for i in range(1, 10)], list(results))
+
+    @mock.patch.object(parallel, 'RANGE_SIZE', 200)
+    def test_same_errors_as_serial(self):
+        serial = self.get_importer(1)
+        self.assertFalse(serial.is_valid())
+
+        importer = self.get_importer(3)
+        with mock.patch.object(parallel, 'validate_chunks', wraps=parallel.validate_chunks) as validate:
+            self.assertFalse(importer.is_valid())
+        validate.assert_called_once()
+
+        self.assertEqual(serial.errors, importer.errors)
+        self.assertEqual(serial.num_rows, importer.num_rows)
+
+    @mock.patch.object(parallel, 'RANGE_SIZE', 200)
+    def test_warning_mode(self):
+        importer = self.get_importer(3, warning_mode=True)
+
+        self.assertFalse(importer.is_valid())
+        importer.save()
+        # rows with errors are reported but the rest are written
+        self.assertEqual(len({e['line'] for e in importer.errors}), 60 - Album.objects.count())
+        self.assertEqual(49, Album.objects.count())
+
+
+class AsyncImportTest(AlbumImportTestCase):
+    def setUp(self):
+        super().setUp()
+        Musician.objects.create(name="Johan Wolf", instrument="piano")
+
+    async def test_same_errors_as_sync(self):
+        artists = ["Susan Schmith", "Lola", "Johan Wolf", "Lola"]
+        importer = self.importer_class(get_album_file(*artists))
+        serial = self.importer_class(get_album_file(*artists))
+
+        self.assertFalse(await importer.ais_valid())
+        self.assertFalse(await sync_to_async(serial.is_valid)())
+        self.assertEqual(serial.errors, importer.errors)
+
+    async def test_concurrent_imports(self):
+        log = await sync_to_async(ImportLog.objects.create)(
+            status=ImportLog.RUNNING, user="user1", input_file="albums.csv")
+        first = self.importer_class(get_album_file(*["Susan Schmith", "Johan Wolf"] * 3))
+        second = self.importer_class(get_album_file("Johan Wolf"))
+
+        results = await asyncio.gather(first.ais_valid(log), second.ais_valid())
+        self.assertEqual([True, True], results)
+        await asyncio.gather(first.asave(), second.asave())
+
+        self.assertEqual(7, await sync_to_async(Album.objects.count)())
+        await sync_to_async(log.refresh_from_db)()
+        self.assertEqual((100, 6), (log.progress, log.num_rows))
+
+
+class WritersTest(AlbumImportTestCase):
+    def get_importer(self, importer_class=None):
+        content = (
+            ALBUM_HEADER +
+            '"a ""b""";Susan Schmith;2000-01-01;5\n'
+            'c;Susan Schmith;2001-02-03;4\n'
+        )
+        importer_class = importer_class or self.importer_class
+        return importer_class(io.BytesIO(content.encode('utf-8')))
+
+    def test_default(self):
+        self.assertIsInstance(self.get_importer().get_writer(), writers.BulkCreateWriter)
+
+    @override_settings(DJIMPORTER_WRITERS={'sqlite': 'djimporter.writers.ExecuteManyWriter'})
+    def test_execute_many(self):
+        importer = self.get_importer()
+        self.assertIsInstance(importer.get_writer(), writers.ExecuteManyWriter)
+
+        self.assertTrue(importer.is_valid(), importer.errors)
+        with self.assertNumQueries(3):
+            # savepoint, insert and release
+            importer.save()
+        self.assertEqual(
+            [('a "b"', datetime.date(2000, 1, 1), 5), ('c', datetime.date(2001, 2, 3), 4)],
+            list(Album.objects.order_by('name').values_list('name', 'release_date', 'num_stars'))
+        )
+
+    def test_meta_writer(self):
+        def check_pk(cls, row):
+            assert row.object.pk is not None
+
+        AlbumCsv = self.get_importer_class(writer=writers.ExecuteManyWriter)
+        AlbumPostSaveCsv = self.get_importer_class(
+            writer=writers.ExecuteManyWriter, post_save=['check_pk'], check_pk=classmethod(check_pk))
+
+        self.assertIsInstance(self.get_importer(AlbumCsv).get_writer(), writers.ExecuteManyWriter)
+        # post_save methods need the primary keys
+        self.assertIsInstance(self.get_importer(AlbumPostSaveCsv).get_writer(), writers.BulkCreateWriter)
+
+    def test_bulk_insert_without_pks(self):
+        pks = []
+
+        def get_pks(cls, rows):
+            pks.extend(row.object.pk for row in rows)
+
+        importer = self.get_importer(self.get_importer_class(post_save_batch=['get_pks'], get_pks=classmethod(get_pks)))
+        self.assertTrue(importer.is_valid(), importer.errors)
+        # e.g. MySQL, objects are saved one by one to get their primary keys
+        features = type(connection.features)
+        with mock.patch.object(features, 'can_return_rows_from_bulk_insert', new_callable=mock.PropertyMock,
+                               return_value=False):
+            self.assertIsInstance(importer.get_writer(), writers.SaveWriter)
+            importer.save()
+        self.assertEqual(sorted(Album.objects.values_list('pk', flat=True)), sorted(pks))
+
+    def test_unsupported_vendor(self):
+        writer = writers.get_writer(Album, writers.CopyWriter)
+        self.assertIsInstance(writer, writers.BulkCreateWriter)
+
+    def test_batch_size(self):
+        objs = [Album() for _ in range(1000)]
+        writer = writers.get_writer(Album)
+        fields = Album._meta.concrete_fields
+        # sqlite limits the number of parameters of a query
+        self.assertEqual(connection.ops.bulk_batch_size(fields, objs), writer.get_batch_size(objs))
+        self.assertLess(writer.get_batch_size(objs), 1000)
+
+        self.assertEqual(50, writers.get_writer(Album, batch_size=50).get_batch_size(objs))
+        writer = writers.get_writer(Album, batch_size=100000)
+        self.assertEqual(connection.ops.bulk_batch_size(fields, objs), writer.get_batch_size(objs))
+
+    def test_unlimited_batch_size(self):
+        # PostgreSQL and MySQL return all the objects
+        objs = [Album() for _ in range(writers.MAX_BATCH_SIZE + 1)]
+        with mock.patch.object(connection.ops, 'bulk_batch_size', lambda fields, objs: len(objs)):
+            writer = writers.get_writer(Album)
+            self.assertEqual(writers.MAX_BATCH_SIZE, writer.get_batch_size(objs))
+            self.assertEqual(10, writer.get_batch_size(objs[:10]))
+
+    def test_meta_batch_size(self):
+        importer = self.get_importer(self.get_importer_class(batch_size=1))
+        self.assertTrue(importer.is_valid(), importer.errors)
+        with self.assertNumQueries(4):
+            # savepoint, two inserts and release
+            importer.save()
+
+    def test_batch_size_tuner(self):
+        # time per row is the lowest with batches of about 2200 rows
+        tuner = writers.BatchSizeTuner(initial=10)
+        for _ in range(30):
+            size = tuner.size
+            tuner.record(size, 0.05 + size * 1e-4 + size ** 2 * 1e-8)
+        self.assertTrue(1100 <= tuner.size <= 4500, tuner.size)
+
+        # slow batches are shrunk
+        tuner = writers.BatchSizeTuner(initial=1000, max_latency=1)
+        tuner.record(1000, 0.5)
+        self.assertEqual(2000, tuner.size)
+        tuner.record(2000, 1.5)
+        self.assertLess(tuner.size, 2000)
+
+    def test_copy_format(self):
+        row = [None, '', 'a "b",\nc', True, 3, datetime.date(2000, 1, 1), b'\x01']
+        self.assertEqual(
+            ',"","a ""b"",\nc","t","3","2000-01-01","\\x01"\n',
+            writers.CopyWriter.format_rows([row])
+        )
+        with self.assertRaises(TypeError):
+            writers.CopyWriter.format_value(['a'])
+
+
+class UpsertModeTest(TestCase):
+    def setUp(self):
+        Musician.objects.bulk_create([
+            Musician(name="Susan Schmith", instrument="guitar"),
+            Musician(name="Johan Wolf", instrument="piano"),
+        ])
+
+        class MusicianCsv(importers.CsvModel):
+            class Meta:
+                dbModel = Musician
+                fields = ['name', 'instrument']
+                import_mode = 'upsert'
+                conflict_fields = ['name']
+
+        self.importer_class = MusicianCsv
+
+    def test_upsert(self):
+        content = "name;instrument\nSusan Schmith;drums\nJohan Wolf;piano\nLola;bass\nLola;sax\n"
+        importer = self.importer_class(io.BytesIO(content.encode('utf-8')))
+        susan = Musician.objects.get(name="Susan Schmith")
+
+        self.assertTrue(importer.is_valid(), importer.errors)
+        self.assertEqual(['instrument'], list(importer.spec.update_fields))
+        # savepoint, match, insert, update of the changed rows and release
+        with self.assertNumQueries(5):
+            importer.save()
+
+        self.assertEqual(
+            [("Johan Wolf", "piano"), ("Lola", "sax"), ("Susan Schmith", "drums")],
+            list(Musician.objects.order_by('name').values_list('name', 'instrument'))
+        )
+        self.assertEqual(susan.pk, Musician.objects.get(name="Susan Schmith").pk)
+
+    def test_unchanged(self):
+        content = "name;instrument\nSusan Schmith;guitar\n"
+        importer = self.importer_class(io.BytesIO(content.encode('utf-8')))
+
+        self.assertTrue(importer.is_valid(), importer.errors)
+        # savepoint, match and release
+        with self.assertNumQueries(3):
+            importer.save()
+
+    def test_conflict_fields_required(self):
+        class MusicianCsv(importers.CsvModel):
+            class Meta:
+                dbModel = Musician
+                fields = ['name', 'instrument']
+                import_mode = 'upsert'
+
+        with self.assertRaises(AssertionError):
+            MusicianCsv(io.BytesIO(b''))
+
+
+def set_artists(cls, rows):
+    artist = Musician.objects.get(name=cls.context['artist'])
+    for row in rows:
+        row.object.artist = artist
+
+
+def add_songs(cls, rows):
+    assert all(row.object.pk for row in rows)
+    Song.objects.bulk_create([Song(name=row.object.name, album=row.object) for row in rows])
+
+
+class BatchMethodsTest(AlbumImportTestCase):
+    meta = {
+        'fields': ['name', 'release_date', 'num_stars'],
+        'pre_save_batch': ['set_artists'],
+        'post_save_batch': ['add_songs'],
+        'set_artists': classmethod(set_artists),
+        'add_songs': classmethod(add_songs),
+    }
+
+    def get_importer(self, artist="Susan Schmith", **meta):
+        content = "name;release_date;num_stars\na;2000-01-01;5\nb;2001-01-01;4\nc;2002-01-01;3\n"
+        csv_file = io.BytesIO(content.encode('utf-8'))
+        return self.get_importer_class(**meta)(csv_file, context={'artist': artist})
+
+    def test_batch_methods(self):
+        importer = self.get_importer()
+
+        # rows are validated after pre_save_batch
+        with self.assertNumQueries(1):
+            self.assertTrue(importer.is_valid(), importer.errors)
+        # savepoint, insert, insert of the songs and release
+        with self.assertNumQueries(4):
+            importer.save()
+        self.assertEqual(['a', 'b', 'c'], list(Song.objects.order_by('name').values_list('album__name', flat=True)))
+
+    def test_batch_errors(self):
+        importer = self.get_importer(artist="Johan Wolf")
+
+        self.assertFalse(importer.is_valid())
+        self.assertEqual([2, 3, 4], [e['line'] for e in importer.errors if e['field'] == 'set_artists'])
+
+    def test_bulk_save(self):
+        importer = self.get_importer(save=True, bulk_save=True)
+
+        # import savepoint, pre_save_batch, savepoint, insert, insert of the songs and releases
+        with self.assertNumQueries(7):
+            self.assertTrue(importer.is_valid(), importer.errors)
+        self.assertEqual(3, Album.objects.count())
+        self.assertEqual(3, Song.objects.count())
+
+    def test_save(self):
+        importer = self.get_importer(save=True)
+
+        # import savepoint, then for each row pre_save_batch, its
+        # insert and the insert of its song, and release
+        with self.assertNumQueries(11):
+            self.assertTrue(importer.is_valid(), importer.errors)
+        self.assertEqual(3, Song.objects.count())
+
+
+class UniqueValidationTest(TestCase):
+    def setUp(self):
+        Musician.objects.bulk_create([
+            Musician(name="Susan Schmith", instrument="guitar"),
+            Musician(name="Johan Wolf", instrument="piano"),
+        ])
+
+    def get_importer(self, **meta):
+        MusicianCsv = get_csv_model(Musician, ['name', 'instrument'], **meta)
+        content = "name;instrument\nSusan Schmith;guitar\nLola;drums\nJohan Wolf;piano\n"
+        return MusicianCsv(io.BytesIO(content.encode('utf-8')))
+
+    def test_existing_rows(self):
+        importer = self.get_importer()
+
+        # a single query checks the whole chunk
+        with self.assertNumQueries(1):
+            self.assertFalse(importer.is_valid())
+        self.assertEqual(
+            [(2, 'name', 'Musician with this Name already exists.'),
+             (4, 'name', 'Musician with this Name already exists.')],
+            [(e['line'], e['field'], e['message']) for e in importer.errors]
+        )
+
+    def test_append_mode(self):
+        importer = self.get_importer(append_mode=True)
+
+        with self.assertNumQueries(1):
+            self.assertTrue(importer.is_valid(), importer.errors)
+        self.assertEqual(1, importer.num_rows)
+        importer.save()
+        self.assertEqual(3, Musician.objects.count())
+
+    def test_meta_save_duplicated_in_file(self):
+        MusicianCsv = get_csv_model(Musician, ['name', 'instrument'], save=True)
+        content = "name;instrument\nLola;drums\nLola;drums\n"
+        importer = MusicianCsv(io.BytesIO(content.encode('utf-8')))
+
+        self.assertFalse(importer.is_valid())
+        self.assertEqual([3], [e['line'] for e in importer.errors])
+
+    def test_meta_save_previous_rows(self):
+        def copy_instrument(cls, row):
+            if row.line['like']:
+                row.object.instrument = Musician.objects.get(name=row.line['like']).instrument
+
+        MusicianCsv = get_csv_model(
+            Musician, ['name', 'instrument'], save=True, extra_fields=['like'],
+            pre_save=['copy_instrument'], copy_instrument=classmethod(copy_instrument),
+        )
+        content = "name;instrument;like\nLola;drums;\nPaco;;Lola\n"
+        importer = MusicianCsv(io.BytesIO(content.encode('utf-8')))
+
+        # each row is built once the previous ones have been saved
+        self.assertTrue(importer.is_valid(), importer.errors)
+        self.assertEqual('drums', Musician.objects.get(name="Paco").instrument)
+
+
+class ImporterSpecTest(TestCase):
+    def test_compiled_once_per_class(self):
+        class AlbumCsv(importers.CsvModel):
+            artist = fields.SlugRelatedField(slug_field="name", queryset=Musician.objects.all())
+            release = fields.CharField(match='release_date')
+
+            class Meta:
+                dbModel = Album
+                fields = ['name', 'release', 'num_stars', 'artist']
+
+        class ExtendedAlbumCsv(AlbumCsv):
+            class Meta(AlbumCsv.Meta):
+                extra_fields = ['comments']
+
+        spec = AlbumCsv.spec
+        self.assertIs(spec, AlbumCsv('').spec)
+        self.assertIs(spec, AlbumCsv('').spec)
+        self.assertIsNot(spec, ExtendedAlbumCsv.spec)
+
+        self.assertEqual('release_date', spec.mapping['release'])
+        self.assertEqual('release', spec.reverse_mapping['release_date'])
+        self.assertEqual(['name', 'release', 'num_stars', 'artist'], spec.get_user_visible_fields())
+        self.assertEqual(
+            ['comments', 'name', 'release', 'num_stars', 'artist'],
+            ExtendedAlbumCsv.spec.get_user_visible_fields()
+        )
+
+
+class CompactRowsTest(TestCase):
+    def test_pre_save_line(self):
+        musician = Musician.objects.create(name="Susan Schmith", instrument="guitar")
+
+        class AlbumCsv(importers.CsvModel):
+            class Meta:
+                dbModel = Album
+                fields = ['name', 'release_date', 'num_stars']
+                extra_fields = ['artist']
+                pre_save = ['set_artist']
+
+                @classmethod
+                def set_artist(cls, readrow):
+                    readrow.object.artist = Musician.objects.get(name=readrow.line['artist'])
+
+        csv_path = os.path.join(TESTDATA_DIR, 'albums.csv')
+        importer = AlbumCsv(csv_path, warning_mode=True)
+
+        self.assertFalse(importer.is_valid())
+        self.assertEqual([3], [e['line'] for e in importer.errors])
+        # only the object, line number and unique key are kept
+        self.assertTrue(all(isinstance(row, importers.RowRecord) for row in importer.list_objs))
+        self.assertFalse(hasattr(importer.list_objs[0], '__dict__'))
+
+        importer.save()
+        self.assertEqual(musician, Album.objects.get(name='aaa').artist)
+
+    def test_short_rows(self):
+        class SongCsv(importers.CsvModel):
+            class Meta:
+                dbModel = Song
+                fields = ('name', 'album')
+
+        content = "name;album\n\naloja\n\nsingle\n"
+        importer = SongCsv(io.BytesIO(content.encode('utf-8')))
+
+        self.assertTrue(importer.is_valid(), importer.errors)
+        self.assertEqual([2, 3], [row.line_number for row in importer.list_objs])
+
+
+class ErrorStoreTest(TestCase):
+    @override_settings(DJIMPORTER_MAX_ERRORS=3)
+    def test_capped_errors(self):
+        class AlbumCsv(importers.CsvModel):
+            artist = fields.SlugRelatedField(slug_field="name", queryset=Musician.objects.all())
+
+            class Meta:
+                dbModel = Album
+                fields = ['name', 'release_date', 'num_stars', 'artist']
+
+        rows = ''.join("a{0};Lola;2000-01-01;5\n".format(i) for i in range(10))
+        content = "name;artist;release_date;num_stars\n" + rows
+        log = ImportLog.objects.create(status=ImportLog.RUNNING, user="user1", input_file="albums.csv")
+        importer = AlbumCsv(io.BytesIO(content.encode('utf-8')), log=log)
+
+        self.assertFalse(importer.is_valid(log))
+        self.assertEqual(10, importer.errors.total)
+        self.assertEqual([2, 3, 4], [e['line'] for e in importer.errors])
+        self.assertEqual([{
+            'field': 'artist', 'message': "No match found for Musician with value Lola", 'line_count': 10,
+        }], importer.errors.get_summary())
+
+        importer.errors.close()
+        self.assertEqual([2, 3, 4], [e['line'] for e in log.list_errors()])
+        self.assertEqual([{
+            'field': 'artist', 'message': "No match found for Musician with value Lola", 'count': 7,
+        }], log.list_errors_overflow())
+        self.assertEqual('', ImportLog.objects.get(pk=log.pk).errors)
+
+        log.delete()
+        self.assertFalse(ImportLogError.objects.exists())
+
+    @override_settings(DJIMPORTER_MAX_ERRORS=1, DJIMPORTER_MAX_ERROR_KEYS=2)
+    def test_capped_keys(self):
+        store = ErrorStore()
+        store.extend(
+            {'line': i, 'field': 'num_stars', 'message': "“x{0}” value must be an integer.".format(i)}
+            for i in range(10)
+        )
+        store.append({'line': 11, 'field': 'artist', 'message': "No match found"})
+
+        self.assertEqual(11, store.total)
+        # messages beyond the first ones are counted by field
+        self.assertEqual([
+            {'field': 'num_stars', 'message': "“x0” value must be an integer.", 'line_count': 1},
+            {'field': 'num_stars', 'message': "“x1” value must be an integer.", 'line_count': 1},
+            {'field': 'num_stars', 'message': "Other errors", 'line_count': 8},
+            {'field': 'artist', 'message': "Other errors", 'line_count': 1},
+        ], store.get_summary())
+        self.assertEqual(3, len(store.overflow))
+
+
+class TimingsTest(TestCase):
+    def test_phases_and_signals(self):
+        Musician.objects.create(name="Susan Schmith", instrument="guitar")
+
+        class AlbumCsv(importers.CsvModel):
+            artist = fields.SlugRelatedField(slug_field="name", queryset=Musician.objects.all())
+
+            class Meta:
+                dbModel = Album
+                fields = ['name', 'release_date', 'num_stars', 'artist']
+                chunk_size = 2
+                field_timings = True
+
+        rows = ''.join("a{0};Susan Schmith;2000-01-01;5\n".format(i) for i in range(5))
+        content = "name;artist;release_date;num_stars\n" + rows
+        importer = AlbumCsv(io.BytesIO(content.encode('utf-8')))
+
+        started, chunks = mock.Mock(), mock.Mock()
+        signals.import_started.connect(started, sender=AlbumCsv)
+        signals.chunk_processed.connect(chunks, sender=AlbumCsv)
+        try:
+            self.assertTrue(importer.is_valid(), importer.errors)
+        finally:
+            signals.import_started.disconnect(started, sender=AlbumCsv)
+            signals.chunk_processed.disconnect(chunks, sender=AlbumCsv)
+
+        self.assertEqual(1, started.call_count)
+        self.assertEqual([2, 2, 1], [len(call.kwargs['rows']) for call in chunks.call_args_list])
+
+        timings = importer.timings.as_dict()
+        for phase in ('parse', 'lookups', 'to_python', 'to_python.artist', 'create', 'clean_fields', 'unique', 'write'):
+            self.assertIn(phase, timings)
+        self.assertNotIn('save', timings)
+
+    def test_invalid_rows(self):
+        importer_class = get_album_csv(field_timings=True)
+        importer = importer_class(get_album_file("Lola", "Paco"))
+
+        self.assertFalse(importer.is_valid())
+        # the time spent on rows which fail is measured too
+        timings = importer.timings.as_dict()
+        for phase in ('to_python', 'to_python.artist'):
+            self.assertIn(phase, timings)
+
+
+class EncodingDetectionTest(TestCase):
+    def write_file(self, data):
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(fd, 'wb') as stream:
+            stream.write(data)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_bom(self):
+        content = "name;artist\naaa;Susan\n"
+        self.assertEqual('utf-8-sig', encoding.detect(self.write_file(content.encode('utf-8-sig'))))
+        self.assertEqual('utf-16', encoding.detect(self.write_file(content.encode('utf-16'))))
+        self.assertEqual('utf-32', encoding.detect(self.write_file(content.encode('utf-32'))))
+
+    @override_settings(DJIMPORTER_ENCODING_SAMPLE_SIZE=64)
+    @mock.patch.object(encoding, 'Magic', None)
+    def test_fallback_checks_head_and_tail(self):
+        rows = ''.join("a{0};Susan Schmith\n".format(i) for i in range(100))
+        # samples can cut characters
+        self.assertEqual('utf-8', encoding.detect(self.write_file(("àéíòú;" * 50 + rows).encode('utf-8'))))
+        # the head is ascii, but the tail isn't utf-8
+        path = self.write_file((rows + "Gisèle;Müller\n").encode('cp1252'))
+        self.assertEqual('cp1252', encoding.detect(path))
+        with override_settings(DJIMPORTER_ENCODINGS=['utf-8', 'ascii']):
+            self.assertEqual('latin-1', encoding.detect(path))
+        self.assertEqual(['cp1252', 'latin-1'], encoding.get_encodings(path))
+
+    def test_encoding_stored_on_log(self):
+        Musician.objects.create(name="Gisèle", instrument="guitar")
+
+        class AlbumCsv(importers.CsvModel):
+            artist = fields.SlugRelatedField(slug_field="name", queryset=Musician.objects.all())
+
+            class Meta:
+                dbModel = Album
+                fields = ['name', 'release_date', 'num_stars', 'artist']
+
+        content = "name;artist;release_date;num_stars\naaa;Gisèle;2000-01-01;5\n"
+        path = self.write_file(content.encode('cp1252'))
+        log = ImportLog.objects.create(status=ImportLog.RUNNING, user="user1", input_file="albums.csv")
+
+        importer = AlbumCsv(path, log=log)
+        with mock.patch.object(encoding, 'Magic', None):
+            self.assertTrue(importer.is_valid(log), importer.errors)
+        self.assertEqual('cp1252', ImportLog.objects.get(pk=log.pk).encoding)
+
+        # the encoding isn't detected again
+        with mock.patch.object(encoding, 'get_encodings') as get_encodings:
+            self.assertTrue(AlbumCsv(path, log=log).is_valid(log))
+        get_encodings.assert_not_called()
+
+    @override_settings(DJIMPORTER_ENCODING_SAMPLE_SIZE=64)
+    @mock.patch.object(encoding, 'Magic', None)
+    def test_fallback_after_samples(self):
+        Musician.objects.create(name="Susan", instrument="piano")
+        Musician.objects.create(name="Gisèle", instrument="guitar")
+
+        class AlbumCsv(importers.CsvModel):
+            artist = fields.SlugRelatedField(slug_field="name", queryset=Musician.objects.all())
+
+            class Meta:
+                dbModel = Album
+                fields = ['name', 'release_date', 'num_stars', 'artist']
+
+        rows = ''.join("a{0};Susan;2000-01-01;5\n".format(i) for i in range(1000))
+        content = "name;artist;release_date;num_stars\n" + rows + "aaa;Gisèle;2000-01-01;5\n" + rows
+        path = self.write_file(content.encode('cp1252'))
+        # only the middle of the file isn't ascii
+        self.assertEqual(['utf-8', 'cp1252', 'latin-1'], encoding.get_encodings(path))
+
+        log = ImportLog.objects.create(status=ImportLog.RUNNING, user="user1", input_file="albums.csv")
+        importer = AlbumCsv(path, log=log)
+        self.assertTrue(importer.is_valid(log), importer.errors)
+        self.assertEqual(2001, len(importer.list_objs))
+        self.assertEqual('Gisèle', importer.list_objs[1000].object.artist.name)
+        self.assertEqual('cp1252', ImportLog.objects.get(pk=log.pk).encoding)
+
+        # once some text isn't ascii, the encoding can't change
+        head = "name;artist;release_date;num_stars\nb;Gisèle;2000-01-01;5\n"
+        path = self.write_file(head.encode('utf-8') + (rows + "aaa;Gisèle;2000-01-01;5\n" + rows).encode('cp1252'))
+        importer = AlbumCsv(path)
+        with self.assertRaises(UnicodeDecodeError):
+            importer.is_valid()
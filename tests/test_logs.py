@@ -1,10 +1,32 @@
 """
 This tests is a collection of test for check the model and views logs
 """
-from django.test import TestCase
+import datetime
+import io
+import json
+import os
+import pstats
+import tempfile
+from unittest import mock
+
+from django.db import transaction
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
 from django.urls import reverse
+from django.utils import timezone
+
+from djimporter import importers, progress, signals
+from djimporter.models import ImportLog, ImportLogError
+from djimporter.tasks import run_importer
+from djimporter.views import ImportFormView
+
+from .models import Musician
 
-from djimporter.models import ImportLog
+
+class MusicianCsv(importers.CsvModel):
+    class Meta:
+        dbModel = Musician
+        fields = ['name', 'instrument']
+        encoding = 'utf-8'
 
 
 class TestLogs(TestCase):
@@ -20,11 +42,68 @@ class TestLogs(TestCase):
         res = self.client.get(url)
         self.assertEqual(res.status_code, 200)
 
+    def test_entrylogs_list_pages(self):
+        ImportLog.objects.bulk_create([
+            ImportLog(status=ImportLog.COMPLETED, user="user2", input_file="File_%s.csv" % i) for i in range(5)
+        ])
+        url = reverse('djimporter:importlog-list')
+        with mock.patch('djimporter.views.ListImportsView.page_size', 2):
+            res = self.client.get(url, {'user': 'user2'})
+            self.assertEqual(2, len(res.context['object_list']))
+            self.assertNotIn('errors', res.context['object_list'][0].__dict__)
+
+            seen = [log.pk for log in res.context['object_list']]
+            while res.context['next_query']:
+                res = self.client.get(url + '?' + res.context['next_query'])
+                seen.extend(log.pk for log in res.context['object_list'])
+        expected = ImportLog.objects.filter(user='user2').order_by('-created_at', '-pk')
+        self.assertEqual(list(expected.values_list('pk', flat=True)), seen)
+
     def test_entrylog_id(self):
         url = reverse('djimporter:importlog-detail', args=[self.log_id])
         res = self.client.get(url)
         self.assertEqual(res.status_code, 200)
 
+    def test_entrylog_error_summary(self):
+        ImportLogError.objects.bulk_create([
+            ImportLogError(log_id=self.log_id, line=2, field='name', message='Required'),
+            ImportLogError(log_id=self.log_id, line=3, field='name', message='Required'),
+            ImportLogError(log_id=self.log_id, line=None, field='name', message='Required', count=5),
+        ])
+        url = reverse('djimporter:importlog-detail', args=[self.log_id])
+        res = self.client.get(url)
+        summary = list(res.context['summary'].values())
+        self.assertEqual([{'line_count': 7, 'field': 'name', 'message': 'Required'}], summary)
+
+    def test_entrylog_stored_summary(self):
+        summary = [{'field': 'name', 'message': 'Required', 'line_count': 1000000}]
+        ImportLog.objects.filter(id=self.log_id).update(error_summary=json.dumps(summary))
+        url = reverse('djimporter:importlog-detail', args=[self.log_id])
+        # the errors are not read
+        with self.assertNumQueries(1):
+            res = self.client.get(url)
+        self.assertEqual(summary, list(res.context['summary'].values()))
+
+    def test_entrylog_errors(self):
+        ImportLogError.objects.bulk_create([
+            ImportLogError(log_id=self.log_id, line=line, field=field, message='Required')
+            for line in range(2, 12) for field in ('name', 'artist')
+        ])
+        url = reverse('djimporter:importlog-errors', args=[self.log_id])
+        res = self.client.get(url, {'field': 'artist', 'page_size': 3, 'page': 2})
+        data = res.json()
+        self.assertEqual((10, 4, 2), (data['count'], data['num_pages'], data['page']))
+        self.assertEqual([5, 6, 7], [error['line'] for error in data['results']])
+        self.assertEqual({'artist'}, {error['field'] for error in data['results']})
+
+        res = self.client.get(url, {'message': 'missing'})
+        self.assertEqual(0, res.json()['count'])
+
+        url = reverse('djimporter:importlog-detail-extended', args=[self.log_id])
+        res = self.client.get(url, {'field': 'name'})
+        self.assertEqual(100, res.context['errors_page'].paginator.per_page)
+        self.assertEqual(10, len(res.context['errors_page']))
+
     def test_entrylog_delete_get(self):
         url = reverse('djimporter:importlog-delete', args=[self.log_id])
         res = self.client.get(url)
@@ -36,3 +115,255 @@ class TestLogs(TestCase):
         res = self.client.post(url)
         self.assertEqual(res.status_code, 302)
         self.assertFalse(ImportLog.objects.filter(id=self.log_id).exists())
+
+    def test_entrylog_get(self):
+        started_at = timezone.now() - datetime.timedelta(seconds=10)
+        ImportLog.objects.filter(id=self.log_id).update(
+            status=ImportLog.RUNNING, started_at=started_at, progress=25, num_rows=500)
+
+        url = reverse('djimporter:importlog-get', args=[self.log_id])
+        res = self.client.get(url)
+        self.assertEqual(res.status_code, 200)
+        data = res.json()
+        self.assertEqual((ImportLog.RUNNING, 25, 500), (data['status'], data['progress'], data['num_rows']))
+        self.assertAlmostEqual(50, data['rows_per_second'], delta=5)
+        self.assertAlmostEqual(30, data['eta'], delta=3)
+
+    def test_entrylog_get_not_modified(self):
+        url = reverse('djimporter:importlog-get', args=[self.log_id])
+        res = self.client.get(url)
+        etag = res['ETag']
+
+        # the errors are not loaded
+        with self.assertNumQueries(1) as queries:
+            res = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, res.status_code)
+        self.assertNotIn('errors', queries.captured_queries[0]['sql'])
+
+        ImportLog.objects.filter(id=self.log_id).update(progress=10)
+        res = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, res.status_code)
+        self.assertNotEqual(etag, res['ETag'])
+
+    @mock.patch.object(progress, 'is_cache_shared', return_value=True)
+    def test_entrylog_get_wait(self, is_cache_shared):
+        url = reverse('djimporter:importlog-get', args=[self.log_id])
+        etag = self.client.get(url)['ETag']
+        reporter = progress.ProgressReporter(self.log)
+
+        # the log changes while the request waits
+        with mock.patch('time.sleep', side_effect=lambda seconds: reporter.write(40, 400)) as sleep:
+            res = self.client.get(url, {'wait': 10}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(1, sleep.call_count)
+        self.assertEqual((40, 400), (res.json()['progress'], res.json()['num_rows']))
+
+        # nothing changes, so the log is not read again
+        etag = res['ETag']
+        with mock.patch('time.monotonic', side_effect=[0, 0, 5, 20]), mock.patch('time.sleep'):
+            with self.assertNumQueries(1):
+                res = self.client.get(url, {'wait': 10}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, res.status_code)
+
+    def test_entrylog_get_wait_local_cache(self):
+        url = reverse('djimporter:importlog-get', args=[self.log_id])
+        etag = self.client.get(url)['ETag']
+
+        # changes on a local cache can't be seen, so it doesn't wait
+        with mock.patch('time.sleep') as sleep:
+            res = self.client.get(url, {'wait': 10}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, res.status_code)
+        sleep.assert_not_called()
+
+    def test_entrylog_events(self):
+        ImportLog.objects.filter(id=self.log_id).update(status=ImportLog.COMPLETED, progress=100)
+        url = reverse('djimporter:importlog-events', args=[self.log_id])
+        res = self.client.get(url)
+        self.assertEqual('text/event-stream', res['Content-Type'])
+        events = b''.join(res.streaming_content).decode().split('\n\n')
+        self.assertEqual(2, len(events))
+        # without a shared cache browsers open the stream again later
+        retry, data = events[0].split('\n')
+        self.assertEqual('retry: 10000', retry)
+        self.assertEqual(ImportLog.COMPLETED, json.loads(data[len('data: '):])['status'])
+
+
+class ImportFormViewTest(TestCase):
+    def test_importer_info(self):
+        class UpperMusicianCsv(MusicianCsv):
+            def get_user_visible_fields(self):
+                return [name.upper() for name in super().get_user_visible_fields()]
+
+        view = ImportFormView(importer_class=UpperMusicianCsv)
+        view.setup(RequestFactory().get('/'))
+        importer = view.get_context_data()['importer']
+        self.assertEqual(['NAME', 'INSTRUMENT'], importer.get_user_visible_fields())
+        self.assertEqual(';', importer.get_delimiter())
+
+
+class RunImporterTest(TestCase):
+    def test_counters(self):
+        log = ImportLog.objects.create(status=ImportLog.CREATED, user="user1", input_file="musicians.csv")
+        content = b"name;instrument\nSusan;guitar\n;piano\nJohan;\n"
+        with tempfile.NamedTemporaryFile(suffix='.csv', delete=False) as csv_file:
+            csv_file.write(content)
+
+        finished = mock.Mock()
+        signals.import_finished.connect(finished, sender=MusicianCsv)
+        try:
+            run_importer.now('tests.test_logs.MusicianCsv', csv_file.name, log.id, warning_mode=True)
+        finally:
+            signals.import_finished.disconnect(finished, sender=MusicianCsv)
+
+        self.assertEqual(1, finished.call_count)
+        self.assertEqual(log.pk, finished.call_args.kwargs['log'].pk)
+        log.refresh_from_db()
+        self.assertIn('parse', log.get_timings())
+        self.assertEqual(ImportLog.PARTIAL_WITH_ERRORS, log.status)
+        self.assertEqual(2, log.num_errors)
+        self.assertEqual(len(content), log.bytes_processed)
+        self.assertIsNotNone(log.duration)
+        self.assertEqual(2, sum(error['line_count'] for error in log.list_error_summary()))
+        self.assertEqual([3, 4], [error['line'] for error in log.list_errors()])
+        self.assertFalse(os.path.exists(csv_file.name))
+
+    def test_failing_receiver(self):
+        log = ImportLog.objects.create(status=ImportLog.CREATED, user="user1", input_file="musicians.csv")
+        with tempfile.NamedTemporaryFile(suffix='.csv', delete=False) as csv_file:
+            csv_file.write(b"name;instrument\nSusan;guitar\n")
+
+        def finished(**kwargs):
+            raise ValueError
+
+        signals.import_finished.connect(finished, sender=MusicianCsv)
+        try:
+            with self.assertLogs('django.dispatch', 'ERROR'):
+                run_importer.now('tests.test_logs.MusicianCsv', csv_file.name, log.id)
+        finally:
+            signals.import_finished.disconnect(finished, sender=MusicianCsv)
+
+        log.refresh_from_db()
+        self.assertEqual(ImportLog.COMPLETED, log.status)
+        self.assertFalse(os.path.exists(csv_file.name))
+
+    def test_profile(self):
+        log = ImportLog.objects.create(status=ImportLog.CREATED, user="user1", input_file="musicians.csv")
+        with tempfile.NamedTemporaryFile(suffix='.csv', delete=False) as csv_file:
+            csv_file.write(b"name;instrument\nSusan;guitar\n")
+
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            run_importer.now('tests.test_logs.MusicianCsv', csv_file.name, log.id, profile=True)
+
+            log.refresh_from_db()
+            self.assertEqual(ImportLog.COMPLETED, log.status)
+            self.assertIn('(is_valid)', log.profile_summary)
+            path = os.path.join(media_root, log.profile_file)
+            self.assertGreater(pstats.Stats(path).total_calls, 0)
+
+            url = reverse('djimporter:importlog-detail-extended', args=[log.pk])
+            self.assertContains(self.client.get(url), log.profile_file)
+
+            log.delete()
+            self.assertFalse(os.path.exists(path))
+
+    def test_profile_storage_error(self):
+        log = ImportLog.objects.create(status=ImportLog.CREATED, user="user1", input_file="musicians.csv")
+        with tempfile.NamedTemporaryFile(suffix='.csv', delete=False) as csv_file:
+            csv_file.write(b"name;instrument\nSusan;guitar\n")
+
+        with mock.patch('djimporter.profiling.default_storage.save', side_effect=OSError):
+            with self.assertLogs('djimporter.profiling', 'ERROR'):
+                run_importer.now('tests.test_logs.MusicianCsv', csv_file.name, log.id, profile=True)
+
+        log.refresh_from_db()
+        self.assertEqual(ImportLog.COMPLETED, log.status)
+        self.assertEqual('', log.profile_file)
+        self.assertIn('(is_valid)', log.profile_summary)
+        self.assertFalse(os.path.exists(csv_file.name))
+
+
+class ProgressReporterTest(TestCase):
+
+    def setUp(self):
+        self.log = ImportLog.objects.create(status=ImportLog.RUNNING, user="user1", input_file="File_one.csv")
+
+    def test_throttled(self):
+        reporter = progress.ProgressReporter(self.log, interval=60, min_rows=100)
+        with self.assertNumQueries(1):
+            reporter.start()
+        with mock.patch('time.monotonic', return_value=reporter.last_time + 120):
+            # not enough rows
+            with self.assertNumQueries(0):
+                reporter.update(10, 50)
+            # a single update of progress and num_rows
+            with self.assertNumQueries(1) as queries:
+                reporter.update(20, 150)
+        self.assertNotIn('errors', queries.captured_queries[0]['sql'])
+        # not enough time
+        with self.assertNumQueries(0):
+            reporter.update(30, 300)
+
+        reporter.finish(400)
+        self.log.refresh_from_db()
+        self.assertEqual((100, 400), (self.log.progress, self.log.num_rows))
+        self.assertIsNotNone(self.log.started_at)
+
+    @override_settings(DJIMPORTER_PROGRESS_SINK='djimporter.progress.CacheSink')
+    def test_cache_sink(self):
+        reporter = progress.ProgressReporter(self.log, interval=0, min_rows=0)
+        with self.assertNumQueries(0):
+            reporter.start()
+            reporter.update(50, 100)
+
+        self.log.refresh_from_db()
+        self.assertEqual(0, self.log.progress)
+        stats = progress.read(self.log)
+        self.assertEqual((50, 100), (stats['progress'], stats['num_rows']))
+        self.assertIsNotNone(stats['eta'])
+
+    def test_header_error(self):
+        importer = MusicianCsv(io.BytesIO(b"name\nLola\n"), log=self.log)
+
+        self.assertFalse(importer.is_valid(self.log))
+        self.log.refresh_from_db()
+        self.assertEqual(100, self.log.progress)
+
+
+class ProgressTransactionTest(TransactionTestCase):
+
+    @mock.patch.object(progress.ModelSink, 'shared_transaction_vendors', ())
+    def test_written_outside_transaction(self):
+        log = ImportLog.objects.create(status=ImportLog.RUNNING, user="user1", input_file="File_one.csv")
+        reporter = progress.ProgressReporter(log, interval=0, min_rows=0)
+
+        try:
+            with transaction.atomic():
+                reporter.start()
+                reporter.update(50, 100)
+                raise ValueError
+        except ValueError:
+            pass
+
+        # the progress isn't rolled back with the import
+        log.refresh_from_db()
+        self.assertEqual((50, 100), (log.progress, log.num_rows))
+        self.assertIsNotNone(log.started_at)
+        reporter.sink.close()
+
+    @mock.patch.object(progress.ModelSink, 'shared_transaction_vendors', ())
+    def test_closed_on_errors(self):
+        def fail(cls, row):
+            raise RuntimeError
+
+        log = ImportLog.objects.create(status=ImportLog.RUNNING, user="user1", input_file="File_one.csv")
+        FailingCsv = type('FailingCsv', (MusicianCsv,), {'Meta': type('Meta', (MusicianCsv.Meta,), {
+            'chunk_size': 1, 'pre_save': ['fail'], 'fail': classmethod(fail),
+        })})
+        importer = FailingCsv(io.BytesIO(b"name;instrument\nLola;drums\n"), log=log)
+
+        with mock.patch.object(progress.ModelSink, 'close', autospec=True,
+                               side_effect=progress.ModelSink.close) as close:
+            with self.assertRaises(RuntimeError):
+                importer.is_valid(log)
+        # the connection used to write the progress is closed
+        close.assert_called_once()
+        self.assertIsNone(close.call_args.args[0].connection)